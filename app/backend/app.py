@@ -1,22 +1,34 @@
 #!/usr/bin/env python
 
+import argparse
 import asyncio
+import functools
 import json
+import multiprocessing
 import os
 import ssl
 import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from typing import List, Tuple
 
 import numpy as np
 import websockets
 
-from scripts.convert import (get_default_position_at, get_update_free_zones,
-                             jsonize, parse_trajectory_data)
+from scripts.convert import (frame_index_ranges, get_default_position_at,
+                             get_update_free_zones, jsonize,
+                             pack_binary_message, parse_trajectory_data)
 from scripts.paths import get_available_videos
-from scripts.solve_trajectory import find_orientations, find_positions
-from scripts.state_management import unique_ID, update_canvas_state
-from scripts.utils import orientation_slerp
+from scripts.read_scene_data import configure_scene_cache
+from scripts.solve_trajectory import (find_group_motion_paths,
+                                      find_orientations, find_positions)
+from scripts.state_management import (CanvasJobSlots, unique_ID,
+                                      update_canvas_state)
+from scripts.tracking_position import (configure_motion_path_memory_budget,
+                                       configure_motion_path_strategy,
+                                       configure_trajectory_basis)
+from scripts.utils import (SolveCancelled, configure_thread_budget,
+                           orientation_slerp)
 
 
 try:
@@ -29,23 +41,41 @@ async def send_canvas_message(
         canvas_id    : int,
         status       : str,
         message      : str,
-        frame_indices: List,
-        positions    : List = None,
-        orientations : List = None,  ): 
+        frame_indices: np.ndarray,
+        positions    : np.ndarray = None,
+        orientations : np.ndarray = None,
+        binary       : bool = False  ): 
+
+    print(f"Sending result for canvas {canvas_id} to websocket server. Status = {status}.")
+
+    if binary:
+        # Binary framing (negotiated by the client): frame index ranges and raw float32 buffers
+        header = {
+                    "status": status,
+                    "message": message,
+                    "canvasID": canvas_id,
+                    "frameRanges": frame_index_ranges(frame_indices)
+                }
+        buffers = {}
+        if positions is not None:
+            buffers['positions'] = positions
+        if orientations is not None:
+            buffers['orientations'] = orientations
+
+        await websocket.send(pack_binary_message(header, buffers))
+        return
 
     json_message = {
                 "status": status,
                 "message": message,
                 "canvasID": canvas_id,
-                "frameIndices": frame_indices
+                "frameIndices": np.asarray(frame_indices).tolist()
             }
     if positions is not None:
-        json_message['positions'] = positions
+        json_message['positions'] = np.asarray(positions).tolist()
 
     if orientations is not None:
-        json_message['orientations'] = orientations
-
-    print(f"Sending result for canvas {canvas_id} to websocket server. Status = {status}.")
+        json_message['orientations'] = np.asarray(orientations).tolist()
 
     await websocket.send(
         json.dumps(
@@ -53,36 +83,280 @@ async def send_canvas_message(
         ))
 
 
-async def handle_exception(websocket, error_message, status="ERROR"):
+async def handle_exception(websocket, error_message, status="ERROR", canvas_id=None):
     print("Error:", error_message)
     message = {
                 "status": status,
                 "message": error_message
             }
+    if canvas_id is not None:
+        # The client stops waiting for the results of this canvas
+        message["canvasID"] = canvas_id
     
     await websocket.send(
         json.dumps(
             message
         ))
 
-async def handler(websocket):
+async def send_update_free_zones(websocket, canvas_id, clip_length, position_segments, orientation_segments, binary=False):
+    '''
+    Sends the frames that don't need an update (not in dirty segments) for a dynamic canvas, before it is solved.
+    '''
+    frames_that_dont_need_update_pos = get_update_free_zones(position_segments, clip_length)
+    frames_that_dont_need_update_rot = get_update_free_zones(orientation_segments, clip_length)
+
+    if len(frames_that_dont_need_update_pos) > 0:
+        # Send message about non updated frames
+        await send_canvas_message(
+            websocket, 
+            canvas_id, 
+            status = "ESTIMATION_POSITION_UNCHANGED", 
+            message = "",
+            frame_indices = frames_that_dont_need_update_pos,
+            binary = binary)
+
+    if len(frames_that_dont_need_update_rot) > 0:
+        # Send message about non updated frames
+        await send_canvas_message(
+            websocket, 
+            canvas_id, 
+            status = "ESTIMATION_ORIENTATION_UNCHANGED", 
+            message = "",
+            frame_indices = frames_that_dont_need_update_rot,
+            binary = binary)
+
+
+async def send_dynamic_trajectory(websocket, canvas_id, clip, clip_length, camera_data, orientation_kfs, orientation_segments, quality, positions_result, state_per_canvas, solver_pool, cancel_event, binary=False):
+    '''
+    Sends (and records) the positions found for a dynamic canvas by find_positions, then solves and sends its orientations.
+    Nothing is sent once cancel_event is set (the request was superseded).
+    '''
+    loop = asyncio.get_running_loop()
+    trajectory, trajectory_frames, velocities, matching_weights, tracking_cache, motion_path_plans = positions_result
+
+    # Only send (and record) results of the latest request
+    if cancel_event.is_set():
+        return
+
+    await send_canvas_message(
+            websocket, 
+            canvas_id, 
+            status = "ESTIMATION_POSITION_SUCCESS", 
+            message = f"Found a 3D trajectory for canvas {canvas_id}{' (preview)' if quality == 'preview' else ''}." + "".join(f" Tracking: {plan['summary']}." for plan in motion_path_plans),
+            frame_indices = trajectory_frames,
+            positions = trajectory,
+            binary = binary)
+
+    update_canvas_state(state_per_canvas, clip, canvas_id, clip_length, positions=trajectory * camera_data["down_scale_factor"], indices=trajectory_frames, tracking_cache=tracking_cache)
+    update_canvas_state(state_per_canvas, clip, canvas_id, clip_length, velocities=velocities, orientation_matching_weights=matching_weights)
+
+    try:
+        orientations_per_range = await loop.run_in_executor(
+            solver_pool,
+            find_orientations,
+            orientation_kfs, 
+            velocities, 
+            matching_weights,
+            orientation_segments,
+            cancel_event
+        )
+    except SolveCancelled:
+        print(f"Cancelled orientation solve for canvas {canvas_id} (superseded by a newer request).")
+        return
+
+    for (orientations, segment) in zip(orientations_per_range, orientation_segments):
+        idx_range = np.arange(segment["start"], segment["end"] + 1)
+
+        if cancel_event.is_set():
+            return
+
+
+        if len(idx_range) > 0 and segment["dirty"]:
+            # print(idx_range, orientations.shape, segment["dirty"])
+
+            await send_canvas_message(
+                websocket, 
+                canvas_id, 
+                status = "ESTIMATION_ORIENTATION_SUCCESS", 
+                message = f"Found orientations for canvas {canvas_id}, segment [{segment['start']}, {segment['end']}].",
+                frame_indices = idx_range,
+                orientations = orientations.reshape((len(idx_range), -1)),
+                binary = binary)
+
+            update_canvas_state(state_per_canvas, clip, canvas_id, clip_length, orientations=orientations)
+
+
+def shared_paths_of_clip(shared_tracking_cache, clip):
+    # Only the paths of the clip are sent to the worker process
+    return {key: interval_path for key, interval_path in shared_tracking_cache.items() if key[0] == clip} if shared_tracking_cache is not None else None
+
+
+async def find_batch_motion_paths(data_per_canvas, state_per_canvas, solver_pool, cancel_event, shared_tracking_cache):
+    '''
+    Finds the motion paths of the dynamic canvases of a batch (INFER_TRAJECTORY_BATCH action) as a group in one worker process (see find_group_motion_paths),
+    so that the intervals they share are solved once, and adds them to shared_tracking_cache: the position solves of the canvases (see infer_trajectory) then find all their paths there.
+    Malformed and static canvases are left to their own jobs.
+    '''
+    loop = asyncio.get_running_loop()
+
+    clip = None
+    requests = []
+    for data in data_per_canvas:
+        try:
+            mvt_type, clip, _, _, position_kfs, _, position_segments, _, quality = parse_trajectory_data(data)
+        except Exception:
+            continue
+        if mvt_type == "dynamic":
+            previous_state = state_per_canvas.get(unique_ID(clip, data["canvasID"]), {})
+            requests.append((position_kfs, position_segments, quality, previous_state.get("tracking_cache", {})))
+
+    # A single canvas has nothing to share
+    if len(requests) < 2:
+        return
+
+    tracking_cache = await loop.run_in_executor(solver_pool, find_group_motion_paths, clip, requests, cancel_event, shared_paths_of_clip(shared_tracking_cache, clip))
+    shared_tracking_cache.update(tracking_cache)
+
+
+async def infer_trajectory(websocket, data, state_per_canvas, solver_pool, cancel_event, binary=False, shared_tracking_cache=None, batch=None):
+    '''
+    Solves for the trajectory of one canvas (INFER_TRAJECTORY action) and sends the results.
+    cancel_event is set when a newer request for the same canvas supersedes this one: the solve then stops early and nothing more is sent.
+    Results are sent with the binary framing if binary is set (see pack_binary_message).
+    shared_tracking_cache holds the motion paths of keyframe-to-keyframe intervals found for the canvases of the connection: the solve reuses those of identical intervals,
+    and the paths it finds are added to it.
+    If the request is part of a batch (see CanvasBatch), the positions are solved once the motion paths of the batch are found (see find_batch_motion_paths).
+    '''
+    loop = asyncio.get_running_loop()
+    canvas_id = data["canvasID"]
+
+    try:
+        mvt_type, clip, clip_length, camera_data, position_kfs, orientation_kfs, position_segments, orientation_segments, quality = parse_trajectory_data(data)
+    except Exception as e:
+        await handle_exception(websocket, "Malformed input message. " + str(e), "ESTIMATION_FAILURE")
+        return
+
+    # Initialize state
+    update_canvas_state(state_per_canvas, clip, canvas_id, clip_length)
+    # try:
+    if mvt_type == "static":
+        res = camera_data["res"]
+
+        pos_keyframes = [kf for kf in position_kfs if ("pos_3d" in kf.keys()) or ("pos_2d" in kf.keys())]
+
+        if len(pos_keyframes) >= 1:
+            print(f"Using only first keyframe of {len(pos_keyframes)} given keyframes.")
+            kf = pos_keyframes[0]
+            # Reads the 3D maps of the clip, which are only loaded by the worker processes
+            pt_3d = await loop.run_in_executor(solver_pool, get_default_position_at, kf, clip) / camera_data["down_scale_factor"]
+            trajectory = np.tile(pt_3d, clip_length).reshape((-1,3))
+
+            await send_canvas_message(
+                websocket, 
+                canvas_id, 
+                status = "ESTIMATION_POSITION_SUCCESS", 
+                message = f"Found a static position for canvas {canvas_id}.",
+                frame_indices = np.arange(clip_length),
+                positions = trajectory,
+                binary = binary)
+
+        else:
+            await send_canvas_message(
+                    websocket, 
+                    canvas_id, 
+                    status = "ESTIMATION_POSITION_UNCHANGED", 
+                    message = f"Please add at least 1 position keyrame for canvas {canvas_id}.",
+                    frame_indices = np.arange(clip_length),
+                    binary = binary)
+
+
+        orientation_trajectory = orientation_slerp(orientation_kfs, start_frame=0, end_frame=clip_length-1)
+
+        await send_canvas_message(
+                websocket, 
+                canvas_id, 
+                status = "ESTIMATION_ORIENTATION_SUCCESS", 
+                message = f"Found a static orientation for canvas {canvas_id}.",
+                frame_indices = np.arange(clip_length),
+                orientations = orientation_trajectory.reshape((clip_length, -1)),
+                binary = binary)
+
+    elif mvt_type == "dynamic":
+
+        await send_update_free_zones(websocket, canvas_id, clip_length, position_segments, orientation_segments, binary)
+
+        if batch is not None:
+            # The motion paths of the batch are added to shared_tracking_cache
+            await batch.wait()
+
+        # Solves run in the worker pool so that the event loop keeps serving other connections
+        try:
+            positions_result = await loop.run_in_executor(
+                solver_pool,
+                find_positions,
+                clip, 
+                camera_data, 
+                position_kfs, 
+                position_segments,
+                state_per_canvas[unique_ID(clip, canvas_id)],
+                quality,
+                cancel_event,
+                shared_paths_of_clip(shared_tracking_cache, clip)
+            )
+        except SolveCancelled:
+            print(f"Cancelled position solve for canvas {canvas_id} (superseded by a newer request).")
+            return
+
+        if shared_tracking_cache is not None:
+            tracking_cache = positions_result[4]
+            shared_tracking_cache.update(tracking_cache)
+
+        await send_dynamic_trajectory(websocket, canvas_id, clip, clip_length, camera_data, orientation_kfs, orientation_segments, quality, positions_result, state_per_canvas, solver_pool, cancel_event, binary)
+
+    else :
+        print("Error: Unrecognized movement type")
+
+    # except Exception as e:
+    #     await handle_exception(websocket, "Couldn't solve for trajectory or orientations. " + str(e), "ESTIMATION_FAILURE")
+    #     return
+
+
+async def handler(websocket, solver_pool, create_cancel_event):
 
     state_per_canvas = {}
+    # Motion paths of keyframe-to-keyframe intervals found for all canvases of the connection (see find_motion_path), so that canvases with identical intervals reuse them
+    shared_tracking_cache = {}
+    canvas_jobs = CanvasJobSlots(
+        lambda data, cancel_event, batch: infer_trajectory(websocket, data, state_per_canvas, solver_pool, cancel_event, binary_protocol, shared_tracking_cache, batch),
+        create_cancel_event,
+        # Solves that fail (other than cancelled ones) are reported, otherwise the client would wait for their results
+        lambda data, error: handle_exception(websocket, f"Couldn't solve for the trajectory of canvas {data['canvasID']}. " + str(error), "ESTIMATION_FAILURE", data["canvasID"]),
+        # The motion paths of the canvases of a batch are found as a group
+        lambda data_per_canvas, cancel_event: find_batch_motion_paths(data_per_canvas, state_per_canvas, solver_pool, cancel_event, shared_tracking_cache))
+
+    # JSON messages by default, the client can ask for binary messages in its first message (for old frontends compatibility)
+    binary_protocol = False
+    is_first_message = True
 
     while True:
         try:
             message = await websocket.recv()
         except websockets.exceptions.ConnectionClosedOK:
             print("Closed connection.")
+            canvas_jobs.cancel_all()
             break
         except websockets.exceptions.ConnectionClosedError:
             print("Closed connection.")
+            canvas_jobs.cancel_all()
             break
         # async for message in websocket:
         print("=" * width)
         print("Received websocket message.")
         data = json.loads(message)
 
+        can_set_protocol = is_first_message
+        is_first_message = False
+
         try:
             action = data["action"]
         except Exception as e:
@@ -91,7 +365,22 @@ async def handler(websocket):
 
         print(f"Requested action = {action}")
 
-        if action == "GET_VIDEO_LIST":
+        if action == "SET_PROTOCOL":
+            if not can_set_protocol:
+                await handle_exception(websocket, "The protocol can only be set in the first message of a connection.")
+                continue
+            binary_protocol = data.get("protocol") == "binary"
+            print(f"Using {'binary' if binary_protocol else 'JSON'} protocol for this connection.")
+            await websocket.send(
+                json.dumps(
+                    {
+                        "status": "PROTOCOL",
+                        "message": f"Results will be sent as {'binary' if binary_protocol else 'JSON'} messages.",
+                        "protocol": "binary" if binary_protocol else "json"
+                    }
+                ))
+
+        elif action == "GET_VIDEO_LIST":
             # Return the list of videos available in the server
             vids = get_available_videos()
             # print(vids)
@@ -104,7 +393,9 @@ async def handler(websocket):
                     }
                 ))
         elif action == "INIT_STATE":
+            canvas_jobs.cancel_all()
             state_per_canvas.clear()
+            shared_tracking_cache.clear()
             print("Reset backend canvas state log.")
 
         elif action == "EXPORT_KEYFRAMES":
@@ -116,7 +407,7 @@ async def handler(websocket):
                 continue
 
             try:
-                mvt_type, clip, clip_length, camera_data, position_kfs, orientation_kfs, position_segments, orientation_segments  = parse_trajectory_data(data)
+                mvt_type, clip, clip_length, camera_data, position_kfs, orientation_kfs, position_segments, orientation_segments, quality = parse_trajectory_data(data)
             except Exception as e:
                 await handle_exception(websocket, "Malformed input message. " + str(e), "ESTIMATION_FAILURE")
                 continue
@@ -138,138 +429,67 @@ async def handler(websocket):
                 await handle_exception(websocket, "Malformed input message. " + str(e), "ESTIMATION_FAILURE")
                 continue
 
+            # Latest wins: this supersedes any queued request for the canvas and cancels its running solve
+            canvas_jobs.submit(unique_ID(data.get("clip"), canvas_id), data)
+
+        elif action == "INFER_TRAJECTORY_BATCH":
+            # Several canvases of the same clip: {"clip", "canvases": [per canvas, the fields of an INFER_TRAJECTORY message]}
             try:
-                mvt_type, clip, clip_length, camera_data, position_kfs, orientation_kfs, position_segments, orientation_segments  = parse_trajectory_data(data)
+                clip = data["clip"]
+                data_per_canvas = [dict(canvas_data, clip=clip) for canvas_data in data["canvases"]]
+                canvas_uids = [unique_ID(clip, canvas_data["canvasID"]) for canvas_data in data_per_canvas]
             except Exception as e:
                 await handle_exception(websocket, "Malformed input message. " + str(e), "ESTIMATION_FAILURE")
                 continue
 
-            # Initialize state
-            update_canvas_state(state_per_canvas, clip, canvas_id, clip_length)
-            # try:
-            if mvt_type == "static":
-                res = camera_data["res"]
-
-                pos_keyframes = [kf for kf in position_kfs if ("pos_3d" in kf.keys()) or ("pos_2d" in kf.keys())]
-
-                if len(pos_keyframes) >= 1:
-                    print(f"Using only first keyframe of {len(pos_keyframes)} given keyframes.")
-                    kf = pos_keyframes[0]
-                    pt_3d = get_default_position_at(kf, clip) / camera_data["down_scale_factor"]
-                    trajectory = np.tile(pt_3d, clip_length).reshape((-1,3))
-
-                    await send_canvas_message(
-                        websocket, 
-                        canvas_id, 
-                        status = "ESTIMATION_POSITION_SUCCESS", 
-                        message = f"Found a static position for canvas {canvas_id}.",
-                        frame_indices = np.arange(clip_length).tolist(),
-                        positions = trajectory.tolist())
-
-                else:
-                    await send_canvas_message(
-                            websocket, 
-                            canvas_id, 
-                            status = "ESTIMATION_POSITION_UNCHANGED", 
-                            message = f"Please add at least 1 position keyrame for canvas {canvas_id}.",
-                            frame_indices = np.arange(clip_length).tolist())
-
-
-                orientation_trajectory = orientation_slerp(orientation_kfs, start_frame=0, end_frame=clip_length-1)
-
-                await send_canvas_message(
-                        websocket, 
-                        canvas_id, 
-                        status = "ESTIMATION_ORIENTATION_SUCCESS", 
-                        message = f"Found a static orientation for canvas {canvas_id}.",
-                        frame_indices = np.arange(clip_length).tolist(),
-                        orientations = orientation_trajectory.reshape((clip_length, -1)).tolist())
-
-            elif mvt_type == "dynamic":
-
-                # Determine which index ranges need an update...
-                frames_that_dont_need_update_pos = get_update_free_zones(position_segments, clip_length)
-                frames_that_dont_need_update_rot = get_update_free_zones(orientation_segments, clip_length)
-
-                if len(frames_that_dont_need_update_pos) > 0:
-                    # Send message about non updated frames
-                    await send_canvas_message(
-                        websocket, 
-                        canvas_id, 
-                        status = "ESTIMATION_POSITION_UNCHANGED", 
-                        message = "",
-                        frame_indices = frames_that_dont_need_update_pos.tolist())
-
-                if len(frames_that_dont_need_update_rot) > 0:
-                    # Send message about non updated frames
-                    await send_canvas_message(
-                        websocket, 
-                        canvas_id, 
-                        status = "ESTIMATION_ORIENTATION_UNCHANGED", 
-                        message = "",
-                        frame_indices = frames_that_dont_need_update_rot.tolist())
-
-                trajectory, velocities, matching_weights = find_positions(
-                    clip, 
-                    camera_data, 
-                    position_kfs, 
-                    position_segments,
-                    state_per_canvas[unique_ID(clip, canvas_id)]    
-                )
-
-                await send_canvas_message(
-                        websocket, 
-                        canvas_id, 
-                        status = "ESTIMATION_POSITION_SUCCESS", 
-                        message = f"Found a 3D trajectory for canvas {canvas_id}.",
-                        frame_indices = np.arange(len(trajectory)).tolist(),
-                        positions = trajectory.tolist())
-
-                update_canvas_state(state_per_canvas, clip, canvas_id, clip_length, positions=trajectory * camera_data["down_scale_factor"], velocities=velocities, orientation_matching_weights=matching_weights, indices=np.arange(len(trajectory)))
-
-                orientations_per_range = find_orientations(
-                    orientation_kfs, 
-                    velocities, 
-                    matching_weights,
-                    orientation_segments
-                )
-
-                for (orientations, segment) in zip(orientations_per_range, orientation_segments):
-                    idx_range = np.arange(segment["start"], segment["end"] + 1)
-
-
-                    if len(idx_range) > 0 and segment["dirty"]:
-                        # print(idx_range, orientations.shape, segment["dirty"])
-
-                        await send_canvas_message(
-                            websocket, 
-                            canvas_id, 
-                            status = "ESTIMATION_ORIENTATION_SUCCESS", 
-                            message = f"Found orientations for canvas {canvas_id}, segment [{segment['start']}, {segment['end']}].",
-                            frame_indices = idx_range.tolist(),
-                            orientations = orientations.reshape((len(idx_range), -1)).tolist())
-
-                        update_canvas_state(state_per_canvas, clip, canvas_id, clip_length, orientations=orientations)
-                        
-
-            else :
-                print("Error: Unrecognized movement type")
-
-            # except Exception as e:
-            #     await handle_exception(websocket, "Couldn't solve for trajectory or orientations. " + str(e), "ESTIMATION_FAILURE")
-            #     continue
-
+            canvas_jobs.submit_batch(list(zip(canvas_uids, data_per_canvas)))
 
         else:
             print("unrecognized action", data["action"])
 
 
 
-async def main():
-    print("Starting backend server. Waiting for websocket messages... (Press Ctrl + C to quit)")
-    async with websockets.serve(handler, "", 8001):
-        await asyncio.Future()  # run forever
+def configure_solver_process(scene_cache_bytes, solver_threads, motion_path_memory_bytes, motion_path_strategy, trajectory_basis):
+    configure_scene_cache(scene_cache_bytes)
+    configure_thread_budget(solver_threads)
+    configure_motion_path_memory_budget(motion_path_memory_bytes)
+    configure_motion_path_strategy(**motion_path_strategy)
+    configure_trajectory_basis(trajectory_basis)
+
+
+async def main(args):
+    mp_context = multiprocessing.get_context(args.start_method)
+    # Each process keeps its own cache of scene data
+    scene_cache_bytes = args.scene_cache_mb * 1024**2
+    # ... and its own budget of threads, shared by the solves it runs
+    solver_threads = args.solver_threads if args.solver_threads is not None else max(1, os.cpu_count() // args.workers)
+    # ... and a memory budget for its motion path solves
+    motion_path_memory_bytes = args.memory_budget_mb * 1024**2 if args.memory_budget_mb is not None else None
+    # ... and a strategy for its exact motion path solves
+    motion_path_strategy = {"edge_mode": args.edge_mode, "pyramid_levels": args.pyramid_levels, "window_radius": args.window_radius}
+    configure_solver_process(scene_cache_bytes, solver_threads, motion_path_memory_bytes, motion_path_strategy, args.trajectory_basis)
+    # The manager provides cancellation flags that can be shared with the worker processes
+    with mp_context.Manager() as manager, ProcessPoolExecutor(max_workers=args.workers, mp_context=mp_context, initializer=configure_solver_process, initargs=(scene_cache_bytes, solver_threads, motion_path_memory_bytes, motion_path_strategy, args.trajectory_basis)) as solver_pool:
+        print(f"Solving trajectories in a pool of {args.workers} worker processes (start method = {args.start_method}, {solver_threads} threads per process).")
+        print("Starting backend server. Waiting for websocket messages... (Press Ctrl + C to quit)")
+        async with websockets.serve(functools.partial(handler, solver_pool=solver_pool, create_cancel_event=manager.Event), "", 8001):
+            await asyncio.Future()  # run forever
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes solving trajectories concurrently")
+    # Forked workers inherit the modules already imported by the server, spawned ones import them again (several seconds each, mostly pymanopt)
+    parser.add_argument('--start-method', type=str, default="fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn", choices=multiprocessing.get_all_start_methods(), help="start method of the worker processes (defaults to fork where available)")
+    parser.add_argument('--solver-threads', type=int, default=None, help="number of threads each worker process can use to solve trajectories (defaults to the number of CPUs divided by the number of workers)")
+    parser.add_argument('--memory-budget-mb', type=int, default=None, help="memory budget (in MB) of each motion path solve, solves that would use more switch to cheaper strategies (defaults to no budget)")
+    parser.add_argument('--edge-mode', type=str, default="auto", choices=["auto", "dense", "knn", "lifted", "precomputed"], help="edges of the exact motion path solves: the precomputed motion graph of the clip if there is one, dense edges otherwise (auto), or the given edge mode")
+    parser.add_argument('--pyramid-levels', type=int, default=1, help="number of levels of the coarse-to-fine exact motion path solves (defaults to a single resolution)")
+    parser.add_argument('--window-radius', type=float, default=None, help="half-size (in pixels of the feature grid) of the search windows around the keyframes of the exact motion path solves (defaults to no search window)")
+    parser.add_argument('--trajectory-basis', type=str, default="frames", choices=["frames", "spline"], help="unknowns of the trajectory optimization: one point per frame, or the control points of a cubic B-spline with adaptive knots (fewer unknowns on long shots)")
+    parser.add_argument('--scene-cache-mb', type=int, default=4096, help="memory budget (in MB) of the scene data cache of each process, least recently used clips are evicted first")
+
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
\ No newline at end of file
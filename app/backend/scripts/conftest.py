@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+
+from . import read_scene_data
+from .read_scene_data import scene_cache
+
+
+def write_synthetic_clip(data_folder, video_name, nb_frames=24, maps_res=(24, 18), features_res=(24, 18), feature_dim=8, feature_noise=1.0, motion_graph_k=16, seed=0):
+    '''
+    Writes the backend data of a small synthetic clip (same files as the preprocessing, see preprocess/prepare_all.py):
+    a slowly moving, slightly noisy depth surface seen by a translating camera, with noisy image features (the nodes kept after pruning change from frame to frame).
+    The masks are all set so that flows are always safe (the keyframe velocities don't depend on their neighbours).
+    '''
+    rng = np.random.default_rng(seed)
+    video_path = os.path.join(data_folder, video_name)
+    os.makedirs(video_path)
+
+    maps_res_x, maps_res_y = maps_res
+    nb_pixels = maps_res_x * maps_res_y
+    np.save(os.path.join(video_path, "maps_dim.npy"), np.array([nb_frames, maps_res_x, maps_res_y], dtype=np.uint64))
+
+    # Flat index x * res_y + y (see index_into_data)
+    xs, ys = np.meshgrid(np.arange(maps_res_x) / maps_res_x, np.arange(maps_res_y) / maps_res_y, indexing="ij")
+    xs, ys = xs.flatten(), ys.flatten()
+    depth = 2 + 0.3 * np.sin(3 * xs) * np.cos(2 * ys)
+    positions = np.memmap(os.path.join(video_path, "pos.memmap"), dtype=np.float64, mode="w+", shape=(nb_frames, nb_pixels, 3))
+    flows = np.memmap(os.path.join(video_path, "flow.memmap"), dtype=np.float64, mode="w+", shape=(nb_frames, nb_pixels, 3))
+    for t in range(nb_frames):
+        positions[t] = np.column_stack([(xs - 0.5) * depth + 0.01 * t, (ys - 0.5) * depth, depth]) + rng.normal(0, 0.002, (nb_pixels, 3))
+    for t in range(nb_frames):
+        flows[t] = positions[min(t + 1, nb_frames - 1)] - positions[t] + rng.normal(0, 0.003, (nb_pixels, 3))
+    positions.flush()
+    flows.flush()
+
+    features_res_x, features_res_y = features_res
+    nb_feature_pixels = features_res_x * features_res_y
+    np.savez(os.path.join(video_path, "masks.npz"), masks=np.ones((nb_frames, nb_feature_pixels), dtype=bool), res=features_res)
+    np.save(os.path.join(video_path, "features_dim.npy"), np.array([nb_frames, features_res_x, features_res_y, feature_dim], dtype=np.uint64))
+    features = np.memmap(os.path.join(video_path, "features.memmap"), dtype=np.float32, mode="w+", shape=(nb_frames, nb_feature_pixels, feature_dim))
+    base_features = rng.normal(0, 1, (nb_feature_pixels, feature_dim))
+    for t in range(nb_frames):
+        features[t] = base_features + rng.normal(0, feature_noise, (nb_feature_pixels, feature_dim))
+    features.flush()
+
+    W, H = 320, 240
+    K = np.array([[300., 0, W / 2], [0, 300., H / 2], [0, 0, 1]])
+    np.savez(
+        os.path.join(video_path, "cameras.npz"),
+        Ks=np.tile(K, (nb_frames, 1, 1)), Rs=np.tile(np.eye(3), (nb_frames, 1, 1)), ts=np.outer(np.arange(nb_frames), [0.001, 0, 0]),
+        res=np.array([W, H]), down_scale_factor=np.array(1.0), near=np.array(0.1), far=np.array(10.0))
+
+    # Motion graph (see preprocess/motion_graph.py), here the feature and maps resolutions are the same
+    graph_shape = (nb_frames - 1, nb_pixels, motion_graph_k)
+    np.save(os.path.join(video_path, "motion_graph_dim.npy"), np.array(graph_shape, dtype=np.uint64))
+    indices = np.memmap(os.path.join(video_path, "motion_graph_indices.memmap"), dtype=np.int32, mode="w+", shape=graph_shape)
+    weights = np.memmap(os.path.join(video_path, "motion_graph_weights.memmap"), dtype=np.float32, mode="w+", shape=graph_shape)
+    for t in range(nb_frames - 1):
+        distances, neighbours = cKDTree(positions[t + 1]).query(positions[t] + flows[t], k=motion_graph_k)
+        indices[t] = neighbours
+        weights[t] = distances**2
+    indices.flush()
+    weights.flush()
+
+
+@pytest.fixture(scope="session")
+def synthetic_clip(tmp_path_factory):
+    '''
+    Name of a synthetic clip, written in a temporary data folder used by the scene data readers for the whole test session.
+    '''
+    data_folder = str(tmp_path_factory.mktemp("data"))
+    write_synthetic_clip(data_folder, "synthetic")
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(read_scene_data, "backend_data_root_folder", data_folder)
+        scene_cache.clear()
+        yield "synthetic"
+        scene_cache.clear()
@@ -3,8 +3,7 @@ import numpy as np
 import os
 from pathlib import Path
 
-from .read_scene_data import get_3D_point
-from .paths import backend_data_root_folder
+from .read_scene_data import get_3D_point, get_cameras
 
 def windowing_matrix(hres, vres, y_up=True):
     if y_up:
@@ -44,9 +43,14 @@ def parse_trajectory_data(data):
     keyframes = data["keyframes"]
     position_segments = data["positionSegments"]
     orientation_segments = data["orientationSegments"]
+    # "preview" asks for a fast approximate tracking (e.g. while dragging a keyframe), "exact" for the exact solve
+    quality = data.get("quality", "exact")
+    if quality not in ("exact", "preview"):
+        raise ValueError(f"Unsupported quality '{quality}'")
 
     # Load data associated with this video
-    camera_data = np.load(os.path.join(backend_data_root_folder, video_name, "cameras.npz"))
+    # (only the cameras: the other scene data is only read by the solver worker processes)
+    camera_data = get_cameras(video_name)
 
     res = camera_data["res"]
 
@@ -110,7 +114,7 @@ def parse_trajectory_data(data):
     position_segments = np.array(position_segments)[np.argsort([segment['start'] for segment in position_segments])]
     orientation_segments = np.array(orientation_segments)[np.argsort([segment['start'] for segment in orientation_segments])]
 
-    return mvt_type, video_name, clip_length, camera_data, position_kfs, orientation_kfs, position_segments, orientation_segments
+    return mvt_type, video_name, clip_length, camera_data, position_kfs, orientation_kfs, position_segments, orientation_segments, quality
 
 def get_default_position_at(kf, clip):
     if "pos_3d" in kf.keys():
@@ -163,4 +167,49 @@ def dejsonize(keyframes):
             else:
                 json_kf[prop] = kf[prop]
         kfs.append(json_kf)
-    return kfs
\ No newline at end of file
+    return kfs
+
+
+def frame_index_ranges(frame_indices):
+    '''
+    Compresses a list of frame indices into a list of [start, end] ranges (both inclusive) of consecutive indices.
+    '''
+    frame_indices = np.asarray(frame_indices, dtype=int)
+    if len(frame_indices) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(frame_indices) != 1)
+    starts = np.concatenate([frame_indices[:1], frame_indices[breaks + 1]])
+    ends = np.concatenate([frame_indices[breaks], frame_indices[-1:]])
+    return np.column_stack([starts, ends]).tolist()
+
+def pack_binary_message(header, buffers):
+    '''
+    Packs a message for the binary websocket protocol:
+        - header length in bytes (uint32, little-endian)
+        - JSON header, padded with spaces to a multiple of 4 bytes
+        - raw little-endian float32 buffers, one after the other
+
+    The header lists the buffers as {name, offset (in bytes, from the end of the header), length (nb of floats), shape}.
+
+    Args:
+        header (dict): JSON-serializable message content
+        buffers (dict): arrays to send as float32 buffers, by name
+
+    Returns:
+        bytes: the binary message
+    '''
+    header = dict(header)
+    header["buffers"] = []
+
+    payload = []
+    offset = 0
+    for name, array in buffers.items():
+        array = np.ascontiguousarray(array, dtype='<f4')
+        header["buffers"].append({"name": name, "offset": offset, "length": array.size, "shape": list(array.shape)})
+        payload.append(array.tobytes())
+        offset += array.nbytes
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 4)
+
+    return np.uint32(len(header_bytes)).astype('<u4').tobytes() + header_bytes + b"".join(payload)
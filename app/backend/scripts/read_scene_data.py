@@ -1,5 +1,10 @@
-import numpy as np
 import os
+import struct
+import threading
+import zipfile
+from collections import OrderedDict, deque
+
+import numpy as np
 
 from .paths import backend_data_root_folder
 
@@ -12,6 +17,10 @@ def index_into_data(pixels, pixel_res, data_res):
     flat_indices = np.ravel_multi_index([rescaled_pixels[:, 0], rescaled_pixels[:, 1]], (data_res[0], data_res[1]))
     return flat_indices
 
+def get_cameras(video_clip):
+    with np.load(os.path.join(backend_data_root_folder, video_clip, "cameras.npz")) as camera_archive:
+        return dict(camera_archive)
+
 def get_maps_dims(video_clip):
     return np.load(os.path.join(backend_data_root_folder, video_clip, "maps_dim.npy"))
 
@@ -38,12 +47,359 @@ def get_features(video_clip, nb_frames, features_res, latent_dimension):
     feats = np.memmap(os.path.join(backend_data_root_folder, video_clip, "features.memmap"), mode='r', shape=archive_shape, dtype=np.float32)
     return feats
 
+def get_motion_graph(video_clip):
+    '''
+    Reads the sparse motion graph precomputed for a clip (see preprocess/motion_graph.py), if there is one.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: indices of the k nearest pixels at t+1 of each pixel at t (int32) and the edge weights (float32), both with dimensions (nb_frames - 1, res_x * res_y, k).
+            None if the motion graph was not precomputed.
+    '''
+    dims_path = os.path.join(backend_data_root_folder, video_clip, "motion_graph_dim.npy")
+    if not os.path.exists(dims_path):
+        return None
+
+    archive_shape = tuple(int(d) for d in np.load(dims_path))
+    indices = np.memmap(os.path.join(backend_data_root_folder, video_clip, "motion_graph_indices.memmap"), mode='r', shape=archive_shape, dtype=np.int32)
+    weights = np.memmap(os.path.join(backend_data_root_folder, video_clip, "motion_graph_weights.memmap"), mode='r', shape=archive_shape, dtype=np.float32)
+    return indices, weights
+
+
+def load_npz_array(npz_path, name):
+    '''
+    Reads an array of a numpy archive. If the archive is not compressed (np.savez), the array is memory-mapped instead of read,
+    so that only the pages we use are loaded.
+
+    Args:
+        npz_path (str): path to the .npz archive
+        name (str): name of the array in the archive
+
+    Returns:
+        np.ndarray: the array (a read-only np.memmap if possible)
+    '''
+    with zipfile.ZipFile(npz_path) as archive:
+        member = archive.getinfo(f"{name}.npy")
+
+    if member.compress_type != zipfile.ZIP_STORED:
+        with np.load(npz_path) as npz_archive:
+            return npz_archive[name]
+
+    with open(npz_path, "rb") as f:
+        # The array file starts after the local file header of the member (30 bytes + name + extra field)
+        f.seek(member.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", f.read(4))
+        f.seek(member.header_offset + 30 + name_length + extra_length)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            dtype = None
+        offset = f.tell()
+
+    if dtype is None or dtype.hasobject:
+        with np.load(npz_path) as npz_archive:
+            return npz_archive[name]
+
+    return np.memmap(npz_path, mode='r', dtype=dtype, shape=shape, order='F' if fortran_order else 'C', offset=offset)
+
+
+def compute_feature_squared_norms(features):
+    '''
+    Squared L2 norms of image features.
+
+    Args:
+        features (np.ndarray): an array with dimensions (nb frames, nb pixels, latent dimension)
+
+    Returns:
+        np.ndarray: an array with dimensions (nb frames, nb pixels)
+    '''
+    features = features.astype(np.float64)
+    return np.einsum('tpd,tpd->tp', features, features)
+
+
+class FramePrefetcher:
+    '''
+    Reads ahead frames of memory-mapped arrays (frames along the first axis) in a background thread, so that solves iterating over frames
+    don't block on the page faults of cold memory maps (e.g. on the first solve of a clip, or with data on a network disk).
+    Frames are read into the page cache, that is shared with the memory maps of the solves.
+
+    Solves call fetch(t, ...) before using frame t: this waits for the frame if it is being read, and schedules the reading of the next frames.
+    hits counts the frames that were already read when they were needed, stalls the frames that were not (being read, or not prefetched).
+    '''
+
+    def __init__(self, arrays, depth=4, max_tracked_frames=4096):
+        '''
+        Args:
+            arrays (dict): memory-mapped arrays by name (arrays that are not memory-mapped are ignored)
+            depth (int, optional): number of frames read ahead. Defaults to 4.
+            max_tracked_frames (int, optional): number of frames (of all arrays) for which we remember that they were read. Defaults to 4096.
+        '''
+        self.depth = depth
+        self.max_tracked_frames = max_tracked_frames
+        self.hits = 0
+        self.stalls = 0
+
+        # Name => (file descriptor, offset of the first frame in the file, bytes per frame, number of frames)
+        self._files = {}
+        for name, array in arrays.items():
+            if isinstance(array, np.memmap) and array.flags.c_contiguous and array.ndim > 0:
+                self._files[name] = (os.open(array.filename, os.O_RDONLY), array.offset, array.strides[0], len(array))
+
+        # (name, frame) => event set when the frame is read, in the order they were scheduled
+        self._frames = OrderedDict()
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def fetch(self, t, names, step=1):
+        '''
+        Waits for frame t of the given arrays to be read (if it is being prefetched) and prefetches the next frames t + step, ..., t + depth * step.
+
+        Args:
+            t (int): frame that is about to be used
+            names (Tuple[str]): names of the arrays that are about to be used
+            step (int, optional): direction of the iteration over frames (1 forward, -1 backward). Defaults to 1.
+        '''
+        events = []
+        with self._condition:
+            if self._closed:
+                return
+
+            for name in names:
+                if name not in self._files:
+                    continue
+                event = self._frames.get((name, t))
+                if event is not None and event.is_set():
+                    self.hits += 1
+                else:
+                    self.stalls += 1
+                    if event is not None:
+                        events.append(event)
+
+                for next_t in range(t + step, t + (self.depth + 1) * step, step):
+                    self._schedule(name, next_t)
+
+            if self._thread is None and len(self._queue) > 0:
+                self._thread = threading.Thread(target=self._read_frames, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+        for event in events:
+            event.wait()
+
+    def _schedule(self, name, t):
+        fd, offset, frame_nbytes, nb_frames = self._files[name]
+        if not 0 <= t < nb_frames:
+            return
+        if (name, t) in self._frames:
+            self._frames.move_to_end((name, t))
+            return
+
+        # Ask the kernel to start reading right away, the background thread waits for the pages
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, offset + t * frame_nbytes, frame_nbytes, os.POSIX_FADV_WILLNEED)
+
+        event = threading.Event()
+        self._frames[(name, t)] = event
+        self._queue.append((name, t, event))
+
+        while len(self._frames) > self.max_tracked_frames:
+            _, evicted_event = self._frames.popitem(last=False)
+            # Nobody can wait for a frame we forget about
+            evicted_event.set()
+
+    def _read_frames(self):
+        buffer = None
+        while True:
+            with self._condition:
+                while len(self._queue) == 0 and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                name, t, event = self._queue.popleft()
+
+            if not event.is_set():
+                fd, offset, frame_nbytes, _ = self._files[name]
+                if buffer is None or len(buffer) < frame_nbytes:
+                    buffer = bytearray(frame_nbytes)
+                try:
+                    # Blocking read, without the GIL
+                    if hasattr(os, "preadv"):
+                        os.preadv(fd, [memoryview(buffer)[:frame_nbytes]], offset + t * frame_nbytes)
+                    elif hasattr(os, "pread"):
+                        os.pread(fd, frame_nbytes, offset + t * frame_nbytes)
+                except OSError as e:
+                    print(f"Prefetcher: could not read frame {t} of {name}: {e}")
+
+            event.set()
+
+    def stats(self):
+        with self._condition:
+            return {"hits": self.hits, "stalls": self.stalls}
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            # Release solves waiting for frames that won't be read
+            for event in self._frames.values():
+                event.set()
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        for fd, *_ in self._files.values():
+            os.close(fd)
+
+
+class Scene:
+    '''
+    All data read for one video clip: cameras, maps/features dimensions and memory-mapped masks, 3D maps and image features
+    (and the precomputed sparse motion graph, if there is one).
+    '''
+
+    def __init__(self, video_clip):
+        self.video_clip = video_clip
+
+        self.cameras = get_cameras(video_clip)
+
+        self.maps_dims = get_maps_dims(video_clip)
+        total_nb_frames, maps_res_x, maps_res_y = self.maps_dims
+        self.maps_res = (maps_res_x, maps_res_y)
+
+        self.masks = load_npz_array(os.path.join(backend_data_root_folder, video_clip, "masks.npz"), "masks")
+
+        self.positions = get_positions(video_clip, total_nb_frames, self.maps_res)
+        self.flows = get_flows(video_clip, total_nb_frames, self.maps_res)
+
+        self.features_dims = get_features_dims(video_clip)
+        T, res_x, res_y, d_feat = self.features_dims
+        self.features = get_features(video_clip, T, (res_x, res_y), d_feat)
+
+        self.motion_graph = get_motion_graph(video_clip)
+
+        # Solves prefetch the frames of the maps/features they are about to use
+        self.prefetcher = FramePrefetcher({"positions": self.positions, "flows": self.flows, "features": self.features, "masks": self.masks})
+
+        # Computed on demand, frame by frame (see feature_squared_norms)
+        self._feature_squared_norms = None
+        self._has_feature_squared_norms = np.zeros(len(self.features), dtype=bool)
+        self._lock = threading.Lock()
+
+    def feature_squared_norms(self, first_frame_idx=0, last_frame_idx=None, chunk_size=64) -> np.ndarray:
+        '''
+        Squared L2 norm of the image feature at each pixel of frames [first_frame_idx, last_frame_idx], computed once per frame (on first use).
+
+        Args:
+            first_frame_idx (int, optional): first frame. Defaults to 0.
+            last_frame_idx (int, optional): last frame. Defaults to None (the last frame of the clip).
+            chunk_size (int, optional): number of frames read at once while computing the norms. Defaults to 64.
+
+        Returns:
+            np.ndarray: an array with dimensions (nb frames, res_x * res_y)
+        '''
+        if last_frame_idx is None:
+            last_frame_idx = len(self.features) - 1
+
+        with self._lock:
+            if self._feature_squared_norms is None:
+                # Pages of frames that are never used are never allocated
+                self._feature_squared_norms = np.empty(self.features.shape[:2])
+
+            missing_frames = first_frame_idx + np.flatnonzero(~self._has_feature_squared_norms[first_frame_idx:last_frame_idx + 1])
+            for start in range(0, len(missing_frames), chunk_size):
+                chunk_frames = missing_frames[start:start + chunk_size]
+                self._feature_squared_norms[chunk_frames] = compute_feature_squared_norms(self.features[chunk_frames])
+            self._has_feature_squared_norms[missing_frames] = True
+
+            return self._feature_squared_norms[first_frame_idx:last_frame_idx + 1]
+
+    def close(self):
+        self.prefetcher.close()
+
+    @property
+    def nbytes(self):
+        # Only the arrays loaded in memory are counted: the pages of memory-mapped arrays (maps, features, motion graph, and masks of uncompressed archives)
+        # belong to the page cache, they are reclaimed by the OS and evicting the scene would not free them
+        arrays = list(self.cameras.values()) + [self.masks, self._has_feature_squared_norms]
+        # Only the norms of the frames computed so far use memory
+        nb_bytes_norms = np.count_nonzero(self._has_feature_squared_norms) * self.features.shape[1] * np.dtype(np.float64).itemsize
+        return sum(array.nbytes for array in arrays if not isinstance(array, np.memmap)) + nb_bytes_norms
+
+
+class SceneCache:
+    '''
+    Keeps the Scene of recently used clips, so that requests don't reload the same files.
+    The least recently used scenes are evicted when the memory they use (see Scene.nbytes) goes over max_bytes (the most recent scene is always kept).
+    Scenes grow after they are loaded (norms of image features), so the budget is checked again on each access.
+    '''
+
+    def __init__(self, max_bytes=4 * 1024**3):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._scenes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, video_clip) -> Scene:
+        with self._lock:
+            if video_clip in self._scenes:
+                self.hits += 1
+                self._scenes.move_to_end(video_clip)
+            else:
+                self.misses += 1
+                self._scenes[video_clip] = Scene(video_clip)
+                print(f"Scene cache: loaded data of clip {video_clip} ({self._summary()}).")
+
+            while len(self._scenes) > 1 and self.nbytes > self.max_bytes:
+                evicted_clip, evicted_scene = self._scenes.popitem(last=False)
+                evicted_scene.close()
+                print(f"Scene cache: evicted data of clip {evicted_clip}.")
+
+            return self._scenes[video_clip]
+
+    @property
+    def nbytes(self):
+        return sum(scene.nbytes for scene in self._scenes.values())
+
+    def _summary(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self._scenes)} clips, {self.nbytes / 1024**2:.1f}MB in cache"
+
+    def summary(self):
+        with self._lock:
+            return self._summary()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "clips": list(self._scenes.keys()), "nbytes": self.nbytes,
+                    "prefetch": {video_clip: scene.prefetcher.stats() for video_clip, scene in self._scenes.items()}}
+
+    def clear(self):
+        with self._lock:
+            for scene in self._scenes.values():
+                scene.close()
+            self._scenes.clear()
+
+
+# Shared by all connections (and all solves) running in this process
+scene_cache = SceneCache()
+
+def configure_scene_cache(max_bytes):
+    scene_cache.max_bytes = max_bytes
+
+def get_scene(video_clip) -> Scene:
+    return scene_cache.get(video_clip)
+
 
 def get_3D_point(video_clip, pt, frame_idx, res_x, res_y):
 
-    total_nb_frames, maps_res_x, maps_res_y = get_maps_dims(video_clip)
-    archive_res = (maps_res_x, maps_res_y)
-    pos_3d_archive = get_positions(video_clip, total_nb_frames, archive_res)
+    scene = get_scene(video_clip)
+    archive_res = scene.maps_res
+    pos_3d_archive = scene.positions
 
     pos_3d = pos_3d_archive[(frame_idx, index_into_data(pt.reshape((1, 2)), (res_x, res_y), archive_res))]
     
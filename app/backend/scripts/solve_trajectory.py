@@ -1,20 +1,118 @@
 import os
 import sys
 import time
+from collections import ChainMap
 
 import numpy as np
 
 from .convert import get_default_position_at
+from .read_scene_data import scene_cache
 from .tracking_orientation import optimize_frames
-from .tracking_position import find_motion_path, optimize_trajectory
-from .utils import orientation_slerp
+from .tracking_position import (find_motion_path, optimize_trajectory,
+                                plan_motion_path)
+from .utils import orientation_slerp, raise_if_cancelled
 
 try:
     width = os.get_terminal_size().columns 
 except:
     width = 20
 
-def find_positions(clip, camera_data, position_keyframes, segments, previous_state):
+def get_dirty_frame_ranges(segments, clip_length):
+    '''
+    Merges dirty segments into contiguous frame ranges.
+
+    Args:
+        segments (List[dict]): segments with "start", "end" frames and "dirty" flag
+        clip_length (int)
+
+    Returns:
+        dirty_ranges (List[Tuple[int, int]]): first and last frame of each range, in order
+    '''
+    is_dirty = np.zeros(clip_length, dtype=bool)
+    for segment in segments:
+        if segment["dirty"]:
+            is_dirty[segment["start"]:segment["end"] + 1] = True
+
+    # Start and end of runs of dirty frames
+    changes = np.diff(np.concatenate([[0], is_dirty.astype(int), [0]]))
+    return list(zip(np.flatnonzero(changes == 1), np.flatnonzero(changes == -1) - 1))
+
+
+def get_tracking_ranges(segments):
+    '''
+    Merges the dirty segments that require 3D tracking into contiguous frame ranges, each range is tracked in one go by find_motion_path.
+
+    Args:
+        segments (List[dict]): segments with "start", "end" frames, "mode" (0 for linear interpolation) and "dirty" flag
+
+    Returns:
+        tracking_ranges (List[np.ndarray]): frame indices of each range, in order
+    '''
+    tracking_ranges = []
+    for segment in segments:
+        idx_range = np.arange(segment["start"], segment["end"] + 1)
+        if not segment["dirty"] or len(idx_range) == 0 or segment["mode"] == 0:
+            continue
+        if len(tracking_ranges) > 0 and tracking_ranges[-1][-1] == idx_range[0]:
+            tracking_ranges[-1] = np.append(tracking_ranges[-1], idx_range[1:])
+        else:
+            tracking_ranges.append(idx_range)
+    return tracking_ranges
+
+
+def track_range(clip, position_keyframes, idx_range, quality, path_cache, cancel_event=None):
+    '''
+    Finds the motion path of a range of frames given by get_tracking_ranges, with the strategy chosen by plan_motion_path.
+
+    Returns:
+        initial_positions (np.ndarray), soft_velocity_cstr (np.ndarray): 3D positions and flows along the path at each frame of the range (see find_motion_path)
+        plan (dict): strategy used for the solve (see plan_motion_path)
+    '''
+    # - Select keyframes
+    # Keep only keyframe that are in range
+    kf_indices = np.array([kf['t'] for kf in position_keyframes])
+    kf_mask = np.isin(kf_indices, idx_range)
+    position_keyframes_subset = np.array(position_keyframes)[kf_mask]
+
+    print("-" * (width // 2))
+    print("Solving tracking for indices:", idx_range)
+    print("with keyframes:", position_keyframes_subset)
+
+
+    # Check the memory needed by the solve, and switch to a cheaper strategy if it doesn't fit in the memory budget of the process
+    # (exact solves use the precomputed motion graph of the clip if there is one, see configure_motion_path_strategy)
+    plan = plan_motion_path(
+        clip,
+        position_keyframes_subset,
+        first_frame_idx=idx_range[0],
+        last_frame_idx=idx_range[-1],
+        prune_nodes=0.9,
+        # Previews use the (approximate) beam search
+        solver="beam" if quality == "preview" else "dp")
+    print("Motion path plan:", plan["summary"])
+
+    initial_positions, soft_velocity_cstr = find_motion_path(
+        clip, 
+        position_keyframes_subset, 
+        prune_nodes=plan["prune_nodes"],
+        feature_similarity_weight=0,
+        targets_feature_similarity_weight=0.0,
+        proximity_weight=1.0,
+        first_frame_idx=idx_range[0],
+        last_frame_idx=idx_range[-1],
+        solver=plan["solver"],
+        edge_mode=plan["edge_mode"],
+        pyramid_levels=plan["pyramid_levels"],
+        window_radius=plan["window_radius"],
+        max_workers=plan["max_workers"],
+        max_memory_bytes=plan["max_memory_bytes"],
+        path_cache=path_cache,
+        cancel_event=cancel_event)
+
+    return initial_positions, soft_velocity_cstr, plan
+
+
+def find_positions(clip, camera_data, position_keyframes, segments, previous_state, quality="exact", cancel_event=None, shared_tracking_cache=None):
     print("-" * width)
     print("POSITIONS SOLVE")
 
@@ -32,9 +130,6 @@ def find_positions(clip, camera_data, position_keyframes, segments, previous_sta
 
     kf_indices = np.array([kf['t'] for kf in position_keyframes])
 
-    # Form contiguous segments that require 3D tracking:
-    tracking_segments = []
-
     for segment in segments:
         idx_range = np.arange(segment["start"], segment["end"] + 1)
         if not segment["dirty"]:
@@ -75,45 +170,68 @@ def find_positions(clip, camera_data, position_keyframes, segments, previous_sta
                 initial_positions[idx_range] = traj_range
 
                 is_presolved[idx_range] = True
-            else:
-                # Register that this index range requires tracking:
-                # (we create contiguous index ranges to solve each contiguous range in one go)
-                if len(tracking_segments) > 0 and tracking_segments[-1][-1] == idx_range[0]:
-                    tracking_segments[-1] = np.append(tracking_segments[-1], idx_range[1:])
-                else:
-                    tracking_segments.append(idx_range)
-                    
+
+    # Form contiguous segments that require 3D tracking (each one is solved in one go)
+    tracking_segments = get_tracking_ranges(segments)
+
+    # Paths of keyframe-to-keyframe intervals found by previous solves of this canvas:
+    # entries outside of the ranges we track now stay valid, the others are replaced by the intervals of this solve
+    previous_tracking_cache = previous_state.get("tracking_cache", {})
+    tracking_cache = {
+        key: interval_path for key, interval_path in previous_tracking_cache.items()
+        if not any(key[1] < idx_range[-1] and key[2] > idx_range[0] for idx_range in tracking_segments)
+    }
+
+    motion_path_plans = []
+
     for idx_range in tracking_segments:
-        # - Select keyframes
-        # Keep only keyframe that are in range
-        kf_mask = np.isin(kf_indices, idx_range)
-        position_keyframes_subset = np.array(position_keyframes)[kf_mask]
-
-        print("-" * (width // 2))
-        print("Solving tracking for indices:", idx_range)
-        print("with keyframes:", position_keyframes_subset)
-
-
-        initial_positions_i, soft_velocity_cstr_i = find_motion_path(
-            clip, 
-            position_keyframes_subset, 
-            prune_nodes=0.9,
-            feature_similarity_weight=0,
-            targets_feature_similarity_weight=0.0,
-            proximity_weight=1.0,
-            first_frame_idx=idx_range[0],
-            last_frame_idx=idx_range[-1])
+        initial_positions_i, soft_velocity_cstr_i, plan = track_range(
+            clip, position_keyframes, idx_range, quality,
+            # Paths found for other canvases with the same intervals can be reused too
+            ChainMap(tracking_cache, previous_tracking_cache, shared_tracking_cache if shared_tracking_cache is not None else {}),
+            cancel_event)
+        motion_path_plans.append(plan)
 
         soft_velocity_cstr[idx_range] = soft_velocity_cstr_i
         initial_positions[idx_range] = initial_positions_i
 
     print(f"Motion graph search time (all segments): {time.time() - start}")
+
+    raise_if_cancelled(cancel_event)
     
 
     # Optimize trajectory
+    # Only dirty frame ranges are solved, with the positions (from the previous state) just outside of each range as boundary constraints
     start_opt = time.time()
-    pts_opt = optimize_trajectory(clip, position_keyframes, soft_velocity_cstr, initial_positions, is_presolved)
-    # pts_opt = initial_positions
+    clip_length = len(soft_velocity_cstr)
+    dirty_ranges = get_dirty_frame_ranges(segments, clip_length)
+    boundary_frames = [t for first_t, last_t in dirty_ranges for t in (first_t - 1, last_t + 1) if 0 <= t < clip_length]
+    positions_solved = previous_state.get("positions_solved", np.zeros(clip_length, dtype=bool))
+    if not np.all(positions_solved[boundary_frames]):
+        # Some boundary positions were never solved (eg, first solve of the canvas): solve the whole clip
+        print("Boundary positions are missing, solving the whole trajectory")
+        dirty_ranges = [(0, clip_length - 1)]
+
+    pts_opt = np.empty((0, 3))
+    solved_frames = np.empty(0, dtype=int)
+    for first_t, last_t in dirty_ranges:
+        range_first_t = max(first_t - 1, 0)
+        range_last_t = min(last_t + 1, clip_length - 1)
+        is_presolved_range = is_presolved[range_first_t:range_last_t + 1].copy()
+        # Boundary positions are hard constraints
+        if range_first_t < first_t:
+            is_presolved_range[0] = True
+        if range_last_t > last_t:
+            is_presolved_range[-1] = True
+        print(f"Optimizing trajectory for indices: [{first_t}, {last_t}]")
+        pts_range = optimize_trajectory(
+            clip, position_keyframes,
+            soft_velocity_cstr[range_first_t:range_last_t + 1],
+            initial_positions[range_first_t:range_last_t + 1],
+            is_presolved_range,
+            first_frame_idx=range_first_t)
+        pts_opt = np.row_stack([pts_opt, pts_range[first_t - range_first_t:last_t - range_first_t + 1]])
+        solved_frames = np.append(solved_frames, np.arange(first_t, last_t + 1))
 
     pts_opt /= down_scale_factor
     print(f"Trajectory optimization time: {time.time() - start_opt}")
@@ -129,12 +247,49 @@ def find_positions(clip, camera_data, position_keyframes, segments, previous_sta
         matching_weights = np.clip(np.linalg.norm(soft_velocity_cstr, axis = 1) / velocity_scale, 0, 1)
 
     print(f"Overall time trajectory optimization: {time.time() - start}")
+    print(f"Scene cache: {scene_cache.summary()}")
+
+
+    return pts_opt, solved_frames, soft_velocity_cstr, matching_weights, tracking_cache, motion_path_plans
+
+
+def find_group_motion_paths(clip, requests, cancel_event=None, shared_tracking_cache=None):
+    '''
+    Finds the motion paths of several dynamic canvases of a clip as a group (INFER_TRAJECTORY_BATCH action), before their positions are solved by find_positions.
+    All intervals are solved in this process with one path cache: the clip data is loaded once, and an interval shared by several canvases
+    (same endpoint keyframes) is solved once, including the costs of its nodes.
+
+    Args:
+        clip (str)
+        requests (List[tuple]): per canvas, the position keyframes, position segments, quality and tracking cache of its previous solves
+        cancel_event (optional): event checked during the solves, they raise SolveCancelled as soon as it is set. Defaults to None.
+        shared_tracking_cache (dict, optional): paths of intervals found for the other canvases of the connection. Defaults to None.
+
+    Returns:
+        tracking_cache (dict): path of each interval of the canvases (see find_motion_path), find_positions reuses them when they are in its shared_tracking_cache
+    '''
+    print("-" * width)
+    print(f"MOTION PATHS SOLVE ({len(requests)} canvases)")
+
+    start = time.time()
+
+    tracking_cache = {}
+    for position_keyframes, segments, quality, previous_tracking_cache in requests:
+        position_keyframes = [kf for kf in position_keyframes if ("pos_3d" in kf.keys()) or ("pos_2d" in kf.keys())]
+        for idx_range in get_tracking_ranges(segments):
+            track_range(
+                clip, position_keyframes, idx_range, quality,
+                # Intervals already solved for the previous canvases of the group are found in tracking_cache
+                ChainMap(tracking_cache, previous_tracking_cache, shared_tracking_cache if shared_tracking_cache is not None else {}),
+                cancel_event)
 
+    print(f"Motion graph search time ({len(requests)} canvases, {len(tracking_cache)} intervals): {time.time() - start}")
+    print(f"Scene cache: {scene_cache.summary()}")
 
-    return pts_opt, soft_velocity_cstr, matching_weights
+    return tracking_cache
 
 
-def find_orientations(orientation_keyframes, target_vectors, matching_weights, segments):
+def find_orientations(orientation_keyframes, target_vectors, matching_weights, segments, cancel_event=None):
     print("-" * width)
     print("ORIENTATIONS SOLVE")
 
@@ -151,6 +306,7 @@ def find_orientations(orientation_keyframes, target_vectors, matching_weights, s
     kf_indices = np.array([kf['t'] for kf in orientation_keyframes])
 
     for segment in segments:
+        raise_if_cancelled(cancel_event)
         idx_range = np.arange(segment["start"], segment["end"] + 1)
         if segment["dirty"] and len(idx_range) > 0:
             print(f"Considering subproblem for indices: [{segment['start']}, {segment['end']}]")
@@ -198,7 +354,8 @@ def find_orientations(orientation_keyframes, target_vectors, matching_weights, s
                     discontinuity_threshold=0.2,
                     W_match=1, W_smooth=10,
                     stride=stride,
-                    quiet=True)
+                    quiet=True,
+                    cancel_event=cancel_event)
         else:
             print("Skipping indices (no update):", idx_range)
             opt_frames_i = np.array([])
@@ -1,10 +1,16 @@
+import asyncio
+import functools
+import traceback
+
 import numpy as np
 
+from .utils import SolveCancelled
+
 
 def unique_ID(clip, canvasID):
     return f"{clip}_{canvasID}"
 
-def update_canvas_state(state_per_canvas, clip, canvasID, clip_length, positions=None, orientations=None, velocities=None, orientation_matching_weights=None, indices=None):
+def update_canvas_state(state_per_canvas, clip, canvasID, clip_length, positions=None, orientations=None, velocities=None, orientation_matching_weights=None, indices=None, tracking_cache=None):
     id = unique_ID(clip, canvasID)
     if id in state_per_canvas.keys():
         previous_state = state_per_canvas[id]
@@ -14,13 +20,18 @@ def update_canvas_state(state_per_canvas, clip, canvasID, clip_length, positions
             "positions": np.tile(np.zeros(3), (clip_length, 1)),
             "orientations": np.tile(np.eye(3), (clip_length, 1, 1)),
             "velocities": np.tile(np.zeros(3), (clip_length, 1)),
-            "orientation_matching_weights": np.zeros(clip_length)
+            "orientation_matching_weights": np.zeros(clip_length),
+            # Frames whose position was solved by this server (only those can be boundary positions of a dirty range solve, see find_positions)
+            "positions_solved": np.zeros(clip_length, dtype=bool),
+            # Motion path of each keyframe-to-keyframe interval, reused when its keyframes don't change (see find_motion_path)
+            "tracking_cache": {}
         }
     new_state = {
         "positions": positions,
         "orientations": orientations,
         "velocities": velocities,
-        "orientation_matching_weights": orientation_matching_weights
+        "orientation_matching_weights": orientation_matching_weights,
+        "positions_solved": None if positions is None else np.ones(len(positions), dtype=bool)
     }
     state = {}
 
@@ -32,4 +43,120 @@ def update_canvas_state(state_per_canvas, clip, canvasID, clip_length, positions
             else:
                 state[k] = new_state[k]
 
+    state["tracking_cache"] = previous_state["tracking_cache"] if tracking_cache is None else tracking_cache
+
     state_per_canvas[id] = state
+
+
+class CanvasBatch:
+    '''
+    Work shared by the canvases of a batch request (eg, finding the motion paths of all canvases as a group), started as soon as the batch is submitted.
+    The jobs of the canvases wait for it (see wait) before solving the rest of their own request.
+    It is cancelled when none of its canvases needs it anymore (their requests were all superseded or cancelled).
+    '''
+
+    def __init__(self, run_batch, requests, cancel_event):
+        '''
+        Args:
+            run_batch (Callable): coroutine function run_batch(data_per_canvas, cancel_event) that does the shared work
+            requests (dict): request (data) per canvas uid
+            cancel_event: event used to cancel the shared work
+        '''
+        self.canvas_uids = set(requests.keys())
+        self.cancel_event = cancel_event
+        self.task = asyncio.ensure_future(run_batch(list(requests.values()), cancel_event))
+        # Failures are reported by the jobs of the canvases (a job may never wait for the shared work)
+        self.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    async def wait(self):
+        # Shielded: a job that stops waiting doesn't cancel the work shared with the other canvases
+        return await asyncio.shield(self.task)
+
+    def release(self, canvas_uid):
+        self.canvas_uids.discard(canvas_uid)
+        if len(self.canvas_uids) == 0 and not self.task.done():
+            self.cancel_event.set()
+
+
+class CanvasJobSlots:
+    '''
+    Keeps one job slot per canvas: at most one running solve and at most one queued request.
+    Submitting a request for a canvas replaces its queued request and cancels its running solve,
+    so that when the user fires many requests in a row (eg, while dragging a keyframe) only the latest one is solved and answered.
+    '''
+
+    def __init__(self, run_job, create_cancel_event, on_error=None, run_batch=None):
+        '''
+        Args:
+            run_job (Callable): coroutine function run_job(data, cancel_event, batch) that solves a request, batch is the CanvasBatch of the request (None if it was submitted on its own)
+            create_cancel_event (Callable): returns a new event used to cancel a running job (it must be shareable with the solver processes)
+            on_error (Callable, optional): coroutine function on_error(data, exception) run when a job fails (but not when it is cancelled), eg to report the failure to the client. Defaults to None.
+            run_batch (Callable, optional): coroutine function run_batch(data_per_canvas, cancel_event) that does the work shared by the canvases of a batch (see CanvasBatch). Defaults to None (no shared work).
+        '''
+        self.run_job = run_job
+        self.create_cancel_event = create_cancel_event
+        self.on_error = on_error
+        self.run_batch = run_batch
+        # (task, cancel event, batch) of the running job of each canvas
+        self.running = {}
+        # (data, batch) of the queued request of each canvas
+        self.pending = {}
+
+    def submit(self, canvas_uid, data, batch=None):
+        if canvas_uid in self.running:
+            if canvas_uid in self.pending:
+                print(f"Dropping queued request for {canvas_uid} (superseded).")
+                self._release(canvas_uid, self.pending[canvas_uid][1])
+            self.pending[canvas_uid] = (data, batch)
+            # Cooperatively cancel the running solve
+            _, cancel_event, running_batch = self.running[canvas_uid]
+            cancel_event.set()
+            self._release(canvas_uid, running_batch)
+        else:
+            self._start(canvas_uid, data, batch)
+
+    def submit_batch(self, requests):
+        '''
+        Submits requests for several canvases (list of (canvas_uid, data)).
+        The work shared by the canvases (see run_batch) is started once for the batch, then each canvas is a job of its own (see submit),
+        so that the canvases are solved in parallel by the worker processes, their results are sent as soon as they are found,
+        and a newer request for one canvas only cancels the solve of this canvas.
+        '''
+        # Latest request wins for canvases listed several times
+        requests = dict(requests)
+        batch = None
+        if self.run_batch is not None and len(requests) > 0:
+            batch = CanvasBatch(self.run_batch, requests, self.create_cancel_event())
+        for canvas_uid, data in requests.items():
+            self.submit(canvas_uid, data, batch)
+
+    def cancel_all(self):
+        for canvas_uid, (_, batch) in self.pending.items():
+            self._release(canvas_uid, batch)
+        self.pending.clear()
+        for canvas_uid, (_, cancel_event, batch) in self.running.items():
+            cancel_event.set()
+            self._release(canvas_uid, batch)
+
+    def _start(self, canvas_uid, data, batch=None):
+        cancel_event = self.create_cancel_event()
+        task = asyncio.ensure_future(self.run_job(data, cancel_event, batch))
+        self.running[canvas_uid] = (task, cancel_event, batch)
+        task.add_done_callback(functools.partial(self._on_done, canvas_uid, data))
+
+    def _on_done(self, canvas_uid, data, task):
+        _, _, batch = self.running.pop(canvas_uid)
+        self._release(canvas_uid, batch)
+        if not task.cancelled() and task.exception() is not None and not isinstance(task.exception(), SolveCancelled):
+            print(f"Error: solve for {canvas_uid} failed.")
+            traceback.print_exception(task.exception())
+            if self.on_error is not None:
+                asyncio.ensure_future(self.on_error(data, task.exception()))
+        if canvas_uid in self.pending:
+            self._start(canvas_uid, *self.pending.pop(canvas_uid))
+
+    @staticmethod
+    def _release(canvas_uid, batch):
+        # The canvas doesn't need the work shared by its batch anymore
+        if batch is not None:
+            batch.release(canvas_uid)
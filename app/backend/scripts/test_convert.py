@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+import pytest
+
+from .convert import frame_index_ranges, pack_binary_message
+
+# Run with:
+# cd app/backend
+# python3 -m pytest -q scripts
+
+
+def decode_binary_message(message):
+    '''
+    Same decoding as decodeBinaryMessage in the web app (frontend/src/websocket.js).
+    '''
+    header_length = np.frombuffer(message, dtype='<u4', count=1)[0]
+    header = json.loads(message[4:4 + header_length].decode("utf-8"))
+    payload_offset = 4 + header_length
+
+    for buffer in header["buffers"]:
+        # new Float32Array(buffer, byteOffset, length) requires an offset aligned to 4 bytes
+        assert (payload_offset + buffer["offset"]) % 4 == 0
+        header[buffer["name"]] = np.frombuffer(message, dtype='<f4', count=buffer["length"], offset=payload_offset + buffer["offset"])
+
+    header["frameIndices"] = [i for start, end in header["frameRanges"] for i in range(start, end + 1)]
+
+    return header
+
+
+@pytest.mark.parametrize("frame_indices, expected_ranges", [
+    ([], []),
+    ([7], [[7, 7]]),
+    ([0, 1, 2, 3], [[0, 3]]),
+    ([0, 1, 2, 5, 7, 8], [[0, 2], [5, 5], [7, 8]]),
+])
+def test_frame_index_ranges(frame_indices, expected_ranges):
+    assert frame_index_ranges(frame_indices) == expected_ranges
+    assert frame_index_ranges(np.array(frame_indices, dtype=np.int64)) == expected_ranges
+
+
+@pytest.mark.parametrize("frame_indices", [[], [7], [0, 1, 2, 5, 7, 8]])
+@pytest.mark.parametrize("canvas_id", [3, "canvas-é"])
+def test_binary_message_round_trip(frame_indices, canvas_id):
+    rng = np.random.default_rng(0)
+    positions = rng.normal(size=(len(frame_indices), 3))
+    orientations = rng.normal(size=(len(frame_indices), 9))
+    header = {"status": "ESTIMATION_POSITION_SUCCESS", "message": "Found a 3D trajectory.", "canvasID": canvas_id, "frameRanges": frame_index_ranges(frame_indices)}
+
+    message = decode_binary_message(pack_binary_message(header, {"positions": positions, "orientations": orientations}))
+
+    assert message["status"] == header["status"]
+    assert message["message"] == header["message"]
+    assert message["canvasID"] == canvas_id
+    assert message["frameIndices"] == frame_indices
+    assert [buffer["shape"] for buffer in message["buffers"]] == [[len(frame_indices), 3], [len(frame_indices), 9]]
+    np.testing.assert_array_equal(message["positions"], positions.astype(np.float32).ravel())
+    np.testing.assert_array_equal(message["orientations"], orientations.astype(np.float32).ravel())
+
+
+def test_binary_message_without_buffers():
+    header = {"status": "ESTIMATION_POSITION_UNCHANGED", "message": "", "canvasID": 0, "frameRanges": [[0, 9]]}
+    packed = pack_binary_message(header, {})
+
+    message = decode_binary_message(packed)
+
+    assert message["buffers"] == []
+    assert message["frameIndices"] == list(range(10))
+    assert len(packed) % 4 == 0
@@ -0,0 +1,189 @@
+import numpy as np
+import pytest
+
+from . import read_scene_data
+from .conftest import write_synthetic_clip
+from .read_scene_data import FramePrefetcher, Scene, SceneCache, load_npz_array
+
+# Run with:
+# cd app/backend
+# python3 -m pytest -q scripts
+
+
+nb_frames = 6
+features_res = (24, 18)
+
+
+@pytest.fixture
+def clips(tmp_path, monkeypatch):
+    data_folder = str(tmp_path)
+    for video_name in ("a", "b", "c"):
+        write_synthetic_clip(data_folder, video_name, nb_frames=nb_frames)
+    monkeypatch.setattr(read_scene_data, "backend_data_root_folder", data_folder)
+    return ["a", "b", "c"]
+
+
+def test_scene_nbytes_counts_loaded_arrays(clips):
+    scene = Scene(clips[0])
+    try:
+        # Cameras, and the flags of the computed feature norms (masks of an uncompressed archive are memory-mapped)
+        loaded_nbytes = sum(array.nbytes for array in scene.cameras.values()) + nb_frames
+        assert scene.nbytes == loaded_nbytes
+        assert scene.nbytes < scene.positions.nbytes
+
+        # Norms are counted as they are computed
+        scene.feature_squared_norms(1, 3)
+        assert scene.nbytes == loaded_nbytes + 3 * np.prod(features_res) * 8
+    finally:
+        scene.close()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 64])
+def test_feature_squared_norms_by_chunks(clips, chunk_size):
+    scene = Scene(clips[0])
+    try:
+        features = np.asarray(scene.features, dtype=np.float64)
+        expected_norms = np.sum(features**2, axis=2)
+
+        # Overlapping ranges: the norms of each frame are computed once, by chunks of frames
+        np.testing.assert_allclose(scene.feature_squared_norms(2, 4, chunk_size), expected_norms[2:5], rtol=1e-12)
+        np.testing.assert_allclose(scene.feature_squared_norms(0, 3, chunk_size), expected_norms[:4], rtol=1e-12)
+        np.testing.assert_allclose(scene.feature_squared_norms(chunk_size=chunk_size), expected_norms, rtol=1e-12)
+    finally:
+        scene.close()
+
+
+def test_scene_cache_evicts_least_recently_used(clips):
+    a, b, c = clips
+    scene_nbytes = Scene(a).nbytes
+    cache = SceneCache(max_bytes=2 * scene_nbytes)
+    try:
+        cache.get(a)
+        cache.get(b)
+        # a is now more recently used than b
+        cache.get(a)
+        cache.get(c)
+        assert cache.stats()["clips"] == [a, c]
+        assert cache.nbytes == 2 * scene_nbytes
+
+        cache.get(b)
+        assert cache.stats()["clips"] == [c, b]
+
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"]) == (1, 4)
+    finally:
+        cache.clear()
+
+
+def test_scene_cache_evicts_scenes_that_grow(clips):
+    a, b, _ = clips
+    scene_nbytes = Scene(a).nbytes
+    cache = SceneCache(max_bytes=2 * scene_nbytes + 8)
+    try:
+        cache.get(a)
+        cache.get(b).feature_squared_norms()
+        assert cache.stats()["clips"] == [a, b]
+
+        # The budget is checked on each access: b has grown, a is evicted
+        cache.get(b)
+        assert cache.stats()["clips"] == [b]
+    finally:
+        cache.clear()
+
+
+def test_scene_cache_keeps_most_recent_scene(clips):
+    cache = SceneCache(max_bytes=0)
+    try:
+        for video_name in clips:
+            cache.get(video_name)
+        assert cache.stats()["clips"] == [clips[-1]]
+    finally:
+        cache.clear()
+
+
+def make_npz_arrays():
+    rng = np.random.default_rng(0)
+    return {
+        "masks": rng.random((5, 12)) > 0.5,
+        "positions": rng.normal(size=(5, 12, 3)),
+        "features": rng.normal(size=(4, 6)).astype(np.float32),
+        "fortran": np.asfortranarray(rng.normal(size=(7, 3))),
+        "big_endian": np.arange(10, dtype='>i4'),
+        "scalar": np.array(1.5),
+        "empty": np.empty((0, 3)),
+    }
+
+
+@pytest.mark.parametrize("name", list(make_npz_arrays().keys()))
+def test_load_npz_array_memory_maps_stored_archives(tmp_path, name):
+    npz_path = str(tmp_path / "arrays.npz")
+    np.savez(npz_path, **make_npz_arrays())
+
+    array = load_npz_array(npz_path, name)
+
+    assert isinstance(array, np.memmap)
+    with np.load(npz_path) as npz_archive:
+        expected_array = npz_archive[name]
+    assert array.dtype == expected_array.dtype
+    np.testing.assert_array_equal(array, expected_array)
+
+
+@pytest.mark.parametrize("name", list(make_npz_arrays().keys()))
+def test_load_npz_array_reads_compressed_archives(tmp_path, name):
+    npz_path = str(tmp_path / "arrays.npz")
+    np.savez_compressed(npz_path, **make_npz_arrays())
+
+    # Compressed members can't be memory-mapped: they are read
+    array = load_npz_array(npz_path, name)
+
+    assert not isinstance(array, np.memmap)
+    np.testing.assert_array_equal(array, make_npz_arrays()[name])
+
+
+def test_load_npz_array_errors(tmp_path):
+    npz_path = str(tmp_path / "arrays.npz")
+    np.savez(npz_path, objects=np.array([{"a": 1}, None], dtype=object))
+
+    with pytest.raises(KeyError):
+        load_npz_array(npz_path, "masks")
+    # Same error as np.load: object arrays are not unpickled
+    with pytest.raises(ValueError):
+        load_npz_array(npz_path, "objects")
+
+
+def test_frame_prefetcher_counts_hits_and_stalls(tmp_path):
+    frames = np.memmap(str(tmp_path / "frames.memmap"), dtype=np.float64, mode="w+", shape=(10, 16, 3))
+    frames[:] = 1
+    frames.flush()
+    prefetcher = FramePrefetcher({"frames": np.memmap(frames.filename, dtype=np.float64, mode="r", shape=frames.shape), "in_memory": np.ones((10, 4))}, depth=2)
+
+    def wait_for_reads():
+        for event in list(prefetcher._frames.values()):
+            event.wait()
+
+    try:
+        # Not prefetched yet: frames 1 and 2 are scheduled
+        prefetcher.fetch(0, ("frames",))
+        wait_for_reads()
+        prefetcher.fetch(1, ("frames",))
+        prefetcher.fetch(2, ("frames",))
+        assert prefetcher.stats() == {"hits": 2, "stalls": 1}
+
+        # Backward iteration, from a frame that was not prefetched
+        prefetcher.fetch(8, ("frames",), step=-1)
+        wait_for_reads()
+        prefetcher.fetch(7, ("frames",), step=-1)
+        # Frames past the end of the array are not scheduled
+        prefetcher.fetch(9, ("frames",))
+        assert ("frames", 10) not in prefetcher._frames
+        assert prefetcher.stats() == {"hits": 3, "stalls": 3}
+
+        # Arrays that are not memory-mapped are not prefetched (nor counted)
+        prefetcher.fetch(3, ("frames", "in_memory"))
+        assert prefetcher.stats() == {"hits": 4, "stalls": 3}
+    finally:
+        prefetcher.close()
+
+    # Closed: nothing is prefetched anymore
+    prefetcher.fetch(5, ("frames",))
+    assert prefetcher.stats() == {"hits": 4, "stalls": 3}
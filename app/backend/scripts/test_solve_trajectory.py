@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from . import tracking_position
+from .read_scene_data import get_scene
+from .solve_trajectory import find_group_motion_paths, find_positions
+from .state_management import unique_ID, update_canvas_state
+from .tracking_position import find_motion_path, optimize_trajectory
+
+# Run with:
+# cd app/backend
+# python3 -m pytest -q scripts
+
+
+clip_length = 24
+
+keyframes = [
+    {"t": 2, "pos_2d": np.array([0.3, 0.5])},
+    {"t": 7, "pos_2d": np.array([0.4, 0.5]), "pos_3d": np.array([-0.1, 0.0, 2.1])},
+    {"t": 11, "pos_2d": np.array([0.45, 0.4])},
+    {"t": 21, "pos_2d": np.array([0.6, 0.5])},
+]
+
+
+@pytest.fixture(scope="module")
+def motion_path(synthetic_clip):
+    return find_motion_path(synthetic_clip, keyframes)
+
+
+@pytest.mark.parametrize("presolved_frames", [[], [0, 1, 2], [15, 16, 17, 18]])
+def test_trajectory_system_matches_direct_solve(synthetic_clip, motion_path, presolved_frames, monkeypatch):
+    initial_positions, target_velocities = motion_path
+    is_presolved = np.zeros(clip_length, dtype=bool)
+    is_presolved[presolved_frames] = True
+
+    # Points block eliminated with the cached Laplacian factorization
+    positions = optimize_trajectory(synthetic_clip, keyframes, target_velocities, initial_positions, is_presolved, trajectory_basis="frames")
+
+    # Whole KKT system solved with spsolve
+    monkeypatch.setattr(tracking_position, "max_schur_complement_size", 0)
+    expected_positions = optimize_trajectory(synthetic_clip, keyframes, target_velocities, initial_positions, is_presolved, trajectory_basis="frames")
+
+    np.testing.assert_allclose(positions, expected_positions, rtol=0, atol=1e-9)
+
+
+def test_spline_trajectory_meets_hard_constraints(synthetic_clip, motion_path):
+    initial_positions, target_velocities = motion_path
+    is_presolved = np.zeros(clip_length, dtype=bool)
+    is_presolved[[15, 16]] = True
+
+    positions = optimize_trajectory(synthetic_clip, keyframes, target_velocities, initial_positions, is_presolved, trajectory_basis="spline", spline_control_points=6)
+
+    # Constrained frames are knots of the spline
+    np.testing.assert_allclose(positions[7], keyframes[1]["pos_3d"], atol=1e-9)
+    np.testing.assert_allclose(positions[[15, 16]], initial_positions[[15, 16]], atol=1e-9)
+
+
+def make_segments(dirty_segment_indices):
+    # Tracked segments between consecutive keyframes (and the clip ends), as sent by the web app
+    bounds = [0] + [kf["t"] for kf in keyframes] + [clip_length - 1]
+    return [{"start": start, "end": end, "mode": 1, "dirty": i in dirty_segment_indices} for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+
+@pytest.mark.parametrize("dirty_segment_indices", [[2], [0], [4], [1, 3]])
+def test_dirty_range_solve_matches_full_solve(synthetic_clip, dirty_segment_indices):
+    camera_data = {"down_scale_factor": 1.0}
+    state_per_canvas = {}
+    update_canvas_state(state_per_canvas, synthetic_clip, 0, clip_length)
+    all_segments = make_segments(range(5))
+
+    positions, solved_frames, velocities, _, tracking_cache, _ = find_positions(synthetic_clip, camera_data, keyframes, all_segments, state_per_canvas[unique_ID(synthetic_clip, 0)])
+    np.testing.assert_array_equal(solved_frames, np.arange(clip_length))
+    update_canvas_state(state_per_canvas, synthetic_clip, 0, clip_length, positions=positions, indices=solved_frames, tracking_cache=tracking_cache)
+    update_canvas_state(state_per_canvas, synthetic_clip, 0, clip_length, velocities=velocities)
+
+    # Same keyframes: solving only the dirty frames, with the positions around them as boundary constraints, gives the same positions
+    segments = make_segments(dirty_segment_indices)
+    dirty_positions, dirty_solved_frames, _, _, _, _ = find_positions(synthetic_clip, camera_data, keyframes, segments, state_per_canvas[unique_ID(synthetic_clip, 0)])
+
+    dirty_frames = np.unique(np.concatenate([np.arange(segment["start"], segment["end"] + 1) for segment in segments if segment["dirty"]]))
+    np.testing.assert_array_equal(dirty_solved_frames, dirty_frames)
+    np.testing.assert_allclose(dirty_positions, positions[dirty_frames], rtol=0, atol=1e-9)
+
+
+def test_group_motion_paths_solve_shared_intervals_once(synthetic_clip, monkeypatch):
+    camera_data = {"down_scale_factor": 1.0}
+    segments = make_segments(range(5))
+    # Second canvas: same keyframes but the last one, the intervals (0, 2), (2, 7) and (7, 11) are shared
+    other_keyframes = keyframes[:3] + [{"t": 21, "pos_2d": np.array([0.55, 0.45])}]
+
+    def solve_alone(canvas_keyframes):
+        state_per_canvas = {}
+        update_canvas_state(state_per_canvas, synthetic_clip, 0, clip_length)
+        return find_positions(synthetic_clip, camera_data, canvas_keyframes, segments, state_per_canvas[unique_ID(synthetic_clip, 0)])
+
+    expected_positions = [solve_alone(canvas_keyframes)[0] for canvas_keyframes in (keyframes, other_keyframes)]
+
+    # Record the intervals whose node costs are computed
+    scene = get_scene(synthetic_clip)
+    solved_intervals = []
+    feature_squared_norms = scene.feature_squared_norms
+    def record_feature_squared_norms(first_frame_idx=None, last_frame_idx=None, chunk_size=64):
+        solved_intervals.append((first_frame_idx, last_frame_idx))
+        return feature_squared_norms(first_frame_idx, last_frame_idx, chunk_size)
+    monkeypatch.setattr(scene, "feature_squared_norms", record_feature_squared_norms)
+
+    requests = [(canvas_keyframes, segments, "exact", {}) for canvas_keyframes in (keyframes, other_keyframes)]
+    tracking_cache = find_group_motion_paths(synthetic_clip, requests)
+
+    assert sorted(solved_intervals) == [(0, 2), (2, 7), (7, 11), (11, 21), (11, 21), (21, 23), (21, 23)]
+    assert len(tracking_cache) == 7
+
+    # The position solves of the canvases find all their intervals in the paths of the group
+    solved_intervals.clear()
+    for canvas_keyframes, canvas_expected_positions in zip((keyframes, other_keyframes), expected_positions):
+        state_per_canvas = {}
+        update_canvas_state(state_per_canvas, synthetic_clip, 0, clip_length)
+        positions = find_positions(synthetic_clip, camera_data, canvas_keyframes, segments, state_per_canvas[unique_ID(synthetic_clip, 0)], shared_tracking_cache=tracking_cache)[0]
+        np.testing.assert_allclose(positions, canvas_expected_positions, rtol=0, atol=1e-9)
+    assert solved_intervals == []
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+
+from .state_management import CanvasJobSlots
+from .utils import SolveCancelled
+
+# Run with:
+# cd app/backend
+# python3 -m pytest -q scripts
+
+
+class FakeSolves:
+    '''
+    Jobs that record their request and cancel event, and wait until they are released (or cancelled, like a real solve) before finishing.
+    The jobs of a batch first wait for the work shared by the batch, which records its requests.
+    '''
+
+    def __init__(self, error=None):
+        self.started = []
+        self.cancel_events = []
+        self.batches = []
+        self.batch_cancel_events = []
+        self.errors = []
+        self.error = error
+        self.release = None
+
+    async def run_batch(self, data_per_canvas, cancel_event):
+        self.batches.append(data_per_canvas)
+        self.batch_cancel_events.append(cancel_event)
+        while not self.release.is_set():
+            if cancel_event.is_set():
+                raise SolveCancelled()
+            await asyncio.sleep(0)
+
+    async def run_job(self, data, cancel_event, batch):
+        self.started.append(data)
+        self.cancel_events.append(cancel_event)
+        if batch is not None:
+            await batch.wait()
+        while not self.release.is_set():
+            if cancel_event.is_set():
+                raise SolveCancelled()
+            await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+
+    async def on_error(self, data, error):
+        self.errors.append((data, error))
+
+
+def run_jobs(solves, submit_requests):
+    async def main():
+        solves.release = asyncio.Event()
+        canvas_jobs = CanvasJobSlots(solves.run_job, threading.Event, solves.on_error, solves.run_batch)
+        submit_requests(canvas_jobs)
+        await asyncio.sleep(0)
+        solves.release.set()
+        while len(canvas_jobs.running) > 0:
+            await asyncio.sleep(0)
+        # Let the error callbacks run
+        await asyncio.sleep(0)
+        return canvas_jobs
+
+    return asyncio.run(main())
+
+
+def test_latest_request_wins():
+    solves = FakeSolves()
+
+    def submit_requests(canvas_jobs):
+        for request_idx in range(4):
+            canvas_jobs.submit("clip_0", {"canvasID": 0, "request": request_idx})
+        canvas_jobs.submit("clip_1", {"canvasID": 1, "request": 0})
+
+    canvas_jobs = run_jobs(solves, submit_requests)
+
+    # The first request was running: it is cancelled, and only the latest queued request is solved after it
+    assert [(data["canvasID"], data["request"]) for data in solves.started] == [(0, 0), (1, 0), (0, 3)]
+    assert [cancel_event.is_set() for cancel_event in solves.cancel_events] == [True, False, False]
+    assert len(canvas_jobs.pending) == 0
+    assert solves.errors == []
+
+
+def test_batch_keeps_latest_request_per_canvas():
+    solves = FakeSolves()
+
+    def submit_requests(canvas_jobs):
+        canvas_jobs.submit_batch([("clip_0", {"canvasID": 0, "request": 0}), ("clip_1", {"canvasID": 1, "request": 0}), ("clip_0", {"canvasID": 0, "request": 1})])
+
+    run_jobs(solves, submit_requests)
+
+    assert sorted((data["canvasID"], data["request"]) for data in solves.started) == [(0, 1), (1, 0)]
+    # The shared work is done once for the whole batch
+    assert len(solves.batches) == 1
+    assert sorted((data["canvasID"], data["request"]) for data in solves.batches[0]) == [(0, 1), (1, 0)]
+    assert not solves.batch_cancel_events[0].is_set()
+
+
+def test_batch_is_cancelled_when_no_canvas_needs_it():
+    solves = FakeSolves()
+
+    def submit_requests(canvas_jobs):
+        canvas_jobs.submit_batch([("clip_0", {"canvasID": 0, "request": 0}), ("clip_1", {"canvasID": 1, "request": 0})])
+        _, _, batch = canvas_jobs.running["clip_0"]
+        # Superseding one canvas keeps the work shared with the other one
+        canvas_jobs.submit("clip_0", {"canvasID": 0, "request": 1})
+        assert not batch.cancel_event.is_set()
+        canvas_jobs.submit("clip_1", {"canvasID": 1, "request": 1})
+        assert batch.cancel_event.is_set()
+
+    run_jobs(solves, submit_requests)
+
+    assert [(data["canvasID"], data["request"]) for data in solves.started] == [(0, 0), (1, 0), (0, 1), (1, 1)]
+    # Cancelled batches are not failures
+    assert solves.errors == []
+
+
+def test_cancel_all_cancels_running_and_queued_requests():
+    solves = FakeSolves()
+
+    def submit_requests(canvas_jobs):
+        canvas_jobs.submit("clip_0", {"canvasID": 0, "request": 0})
+        canvas_jobs.submit("clip_0", {"canvasID": 0, "request": 1})
+        canvas_jobs.cancel_all()
+
+    run_jobs(solves, submit_requests)
+
+    assert [data["request"] for data in solves.started] == [0]
+    assert solves.cancel_events[0].is_set()
+    # Cancelled solves are not failures
+    assert solves.errors == []
+
+
+def test_failed_solve_is_reported():
+    error = ValueError("no keyframe")
+    solves = FakeSolves(error)
+
+    def submit_requests(canvas_jobs):
+        canvas_jobs.submit("clip_0", {"canvasID": 0, "request": 0})
+        canvas_jobs.submit("clip_0", {"canvasID": 0, "request": 1})
+
+    run_jobs(solves, submit_requests)
+
+    # The first solve was cancelled, the second one failed
+    assert [data["request"] for data in solves.started] == [0, 1]
+    assert solves.errors == [({"canvasID": 0, "request": 1}, error)]
@@ -0,0 +1,273 @@
+import threading
+import tracemalloc
+
+import numpy as np
+import pytest
+from scipy.sparse import coo_matrix, csr_matrix
+
+from . import tracking_position
+from .read_scene_data import get_3D_point, get_scene
+from .tracking_position import find_motion_path, plan_motion_path
+from .utils import (ThreadBudget, compute_all_edge_weights,
+                    compute_edge_weights, raise_if_cancelled,
+                    sparse_min_plus_transition)
+
+# Run with:
+# cd app/backend
+# python3 -m pytest -q scripts
+
+
+def make_keyframes(*frames_and_positions):
+    return [{"t": t, "pos_2d": np.array(pos_2d)} for t, pos_2d in frames_and_positions]
+
+
+keyframes = make_keyframes((2, (0.3, 0.5)), (11, (0.45, 0.4)), (21, (0.6, 0.5)))
+
+
+@pytest.fixture(scope="module")
+def baseline_path(synthetic_clip):
+    # Generic shortest path solve over the whole graph, with dense edges
+    return find_motion_path(synthetic_clip, keyframes, targets_feature_similarity_weight=0.1, solver="graph")
+
+
+@pytest.mark.parametrize("options", [
+    {"solver": "dp"},
+    {"solver": "dp", "max_workers": 1, "feature_chunk_size": 1},
+    {"solver": "dp", "max_workers": 4, "feature_chunk_size": 5},
+    {"solver": "dp", "max_memory_bytes": 1024},
+    # All the nodes are neighbours
+    {"solver": "dp", "edge_mode": "knn", "knn_k": 10**6},
+    {"solver": "dp", "edge_mode": "lifted"},
+])
+def test_dp_matches_baseline_path(synthetic_clip, baseline_path, options):
+    positions, velocities = find_motion_path(synthetic_clip, keyframes, targets_feature_similarity_weight=0.1, **options)
+
+    np.testing.assert_array_equal(positions, baseline_path[0])
+    np.testing.assert_array_equal(velocities, baseline_path[1])
+
+
+def test_dp_reuses_cached_intervals(synthetic_clip):
+    path_cache = {}
+    find_motion_path(synthetic_clip, keyframes, targets_feature_similarity_weight=0.1, path_cache=path_cache)
+    assert len(path_cache) == 4
+
+    # Only the intervals around the moved keyframe are solved again
+    moved_keyframes = make_keyframes((2, (0.3, 0.5)), (11, (0.5, 0.4)), (21, (0.6, 0.5)))
+    positions, _ = find_motion_path(synthetic_clip, moved_keyframes, targets_feature_similarity_weight=0.1, path_cache=path_cache)
+    expected_positions, _ = find_motion_path(synthetic_clip, moved_keyframes, targets_feature_similarity_weight=0.1)
+
+    np.testing.assert_array_equal(positions, expected_positions)
+
+
+@pytest.mark.parametrize("max_memory_bytes", [None, 4096])
+def test_parallel_interval_solve_matches_serial_solve(synthetic_clip, max_memory_bytes, monkeypatch):
+    # 6 intervals
+    many_keyframes = make_keyframes((3, (0.3, 0.5)), (6, (0.35, 0.5)), (10, (0.4, 0.45)), (14, (0.45, 0.4)), (19, (0.6, 0.5)))
+    monkeypatch.setattr(tracking_position, "thread_budget", ThreadBudget(max_threads=4))
+
+    # Threads solving intervals (the solve checks for cancellation at each frame)
+    solver_threads = set()
+    def record_solver_thread(cancel_event):
+        if threading.current_thread() is not threading.main_thread():
+            solver_threads.add(threading.get_ident())
+        raise_if_cancelled(cancel_event)
+    monkeypatch.setattr(tracking_position, "raise_if_cancelled", record_solver_thread)
+
+    serial_path_cache, parallel_path_cache = {}, {}
+    positions, velocities = find_motion_path(synthetic_clip, many_keyframes, max_workers=1, max_memory_bytes=max_memory_bytes, path_cache=serial_path_cache)
+    assert len(solver_threads) == 1
+    solver_threads.clear()
+    parallel_positions, parallel_velocities = find_motion_path(synthetic_clip, many_keyframes, max_workers=4, max_memory_bytes=max_memory_bytes, path_cache=parallel_path_cache)
+    assert 1 < len(solver_threads) <= 4
+
+    np.testing.assert_array_equal(parallel_positions, positions)
+    np.testing.assert_array_equal(parallel_velocities, velocities)
+    assert serial_path_cache.keys() == parallel_path_cache.keys()
+    for key, (path_2d_positions, cost) in serial_path_cache.items():
+        np.testing.assert_array_equal(parallel_path_cache[key][0], path_2d_positions)
+        assert parallel_path_cache[key][1] == cost
+
+
+@pytest.mark.parametrize("options", [
+    {"solver": "dp"},
+    {"solver": "dp", "window_radius": 0.1},
+    {"solver": "dp", "edge_mode": "knn"},
+    {"solver": "dp", "edge_mode": "lifted"},
+    {"solver": "graph"},
+    {"solver": "beam"},
+])
+@pytest.mark.parametrize("frames", [
+    # Segment made only of keyframes
+    (5, 6),
+    # Adjacent keyframes in a longer segment
+    (5, 6, 12),
+    (3, 9, 10),
+])
+def test_adjacent_keyframes(synthetic_clip, options, frames):
+    adjacent_keyframes = make_keyframes(*[(t, (0.3 + 0.02 * i, 0.5)) for i, t in enumerate(frames)])
+
+    positions, velocities = find_motion_path(synthetic_clip, adjacent_keyframes, first_frame_idx=frames[0], last_frame_idx=frames[-1], **options)
+
+    assert positions.shape == (frames[-1] - frames[0] + 1, 3)
+    assert np.all(np.isfinite(positions)) and np.all(np.isfinite(velocities))
+    for kf in adjacent_keyframes:
+        np.testing.assert_array_equal(positions[kf["t"] - frames[0]], get_3D_point(synthetic_clip, kf["pos_2d"], kf["t"], 1, 1))
+
+
+def path_cost(video_name, keyframes, **options):
+    # Sum of the costs of the keyframe-to-keyframe intervals
+    path_cache = {}
+    find_motion_path(video_name, keyframes, path_cache=path_cache, **options)
+    return sum(interval_cost for _, interval_cost in path_cache.values())
+
+
+@pytest.mark.parametrize("prune_nodes", [0.9, 0.5, 0.0])
+@pytest.mark.parametrize("pyramid_levels", [2, 3])
+@pytest.mark.parametrize("coarse_to_fine_keyframes", [
+    keyframes,
+    # Adjacent keyframes
+    make_keyframes((5, (0.3, 0.5)), (6, (0.32, 0.5)), (12, (0.34, 0.5))),
+])
+def test_coarse_to_fine_cost_gap(synthetic_clip, prune_nodes, pyramid_levels, coarse_to_fine_keyframes):
+    first_frame_idx, last_frame_idx = coarse_to_fine_keyframes[0]["t"], coarse_to_fine_keyframes[-1]["t"]
+    cost = path_cost(synthetic_clip, coarse_to_fine_keyframes, prune_nodes=prune_nodes, first_frame_idx=first_frame_idx, last_frame_idx=last_frame_idx)
+
+    coarse_to_fine_cost = path_cost(synthetic_clip, coarse_to_fine_keyframes, prune_nodes=prune_nodes, first_frame_idx=first_frame_idx, last_frame_idx=last_frame_idx, pyramid_levels=pyramid_levels)
+
+    # The finer levels are not pruned, so the coarse-to-fine path can be better than the single resolution path with the same pruning
+    assert coarse_to_fine_cost <= 1.1 * cost
+
+
+@pytest.mark.parametrize("prune_nodes", [0.9, 0.5])
+@pytest.mark.parametrize("window_radius", [0, 1, 3])
+@pytest.mark.parametrize("window_keyframes", [
+    keyframes,
+    # Adjacent keyframes
+    make_keyframes((5, (0.3, 0.5)), (6, (0.32, 0.5)), (12, (0.34, 0.5))),
+])
+def test_search_window_cost_gap(synthetic_clip, prune_nodes, window_radius, window_keyframes):
+    first_frame_idx, last_frame_idx = window_keyframes[0]["t"], window_keyframes[-1]["t"]
+    cost = path_cost(synthetic_clip, window_keyframes, prune_nodes=prune_nodes, first_frame_idx=first_frame_idx, last_frame_idx=last_frame_idx)
+
+    window_cost = path_cost(synthetic_clip, window_keyframes, prune_nodes=prune_nodes, first_frame_idx=first_frame_idx, last_frame_idx=last_frame_idx, window_radius=window_radius)
+
+    # Nodes are pruned among the pixels of the windows instead of all the pixels, so the paths differ, but the windows grow until they contain the path
+    assert window_cost <= 1.1 * cost
+
+
+@pytest.mark.parametrize("prune_nodes", [0.9, 0.97, 0.99])
+def test_precomputed_edges_with_heavy_pruning(synthetic_clip, prune_nodes, capsys):
+    # The motion graph is computed over all pixels: with heavy pruning, most of the precomputed neighbours are pruned nodes
+    positions, velocities = find_motion_path(synthetic_clip, keyframes, prune_nodes=prune_nodes, edge_mode="precomputed")
+
+    assert "Full path cost inf" not in capsys.readouterr().out
+    assert np.all(np.isfinite(positions)) and np.all(np.isfinite(velocities))
+    for kf in keyframes:
+        np.testing.assert_array_equal(positions[kf["t"]], get_3D_point(synthetic_clip, kf["pos_2d"], kf["t"], 1, 1))
+
+
+def test_sparse_min_plus_transition_without_edges():
+    dist, backpointers = sparse_min_plus_transition(np.zeros(3), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0), 4)
+
+    np.testing.assert_array_equal(dist, np.full(4, np.inf))
+    np.testing.assert_array_equal(backpointers, np.full(4, -1))
+
+
+def test_plan_fits_memory_budget(synthetic_clip):
+    plan = plan_motion_path(synthetic_clip, keyframes, prune_nodes=0.5, solver="graph")
+    assert (plan["solver"], plan["max_memory_bytes"], plan["changes"]) == ("graph", None, [])
+
+    budget_bytes = plan["estimated_bytes"] // 50
+    plan = plan_motion_path(synthetic_clip, keyframes, prune_nodes=0.5, solver="graph", budget_bytes=budget_bytes)
+
+    assert plan["solver"] == "dp"
+    assert plan["max_memory_bytes"] == budget_bytes
+    assert "streaming" in plan["changes"]
+    assert plan["estimated_bytes"] <= budget_bytes
+
+
+def test_plan_selects_edge_mode(synthetic_clip, monkeypatch):
+    # Exact solves use the precomputed motion graph of the clip
+    plan = plan_motion_path(synthetic_clip, keyframes)
+    assert (plan["edge_mode"], plan["pyramid_levels"], plan["window_radius"]) == ("precomputed", 1, None)
+    # Previews only support dense edges
+    assert plan_motion_path(synthetic_clip, keyframes, solver="beam")["edge_mode"] == "dense"
+
+    # Configured strategy
+    monkeypatch.setattr(tracking_position, "motion_path_strategy", {"edge_mode": "knn", "pyramid_levels": 2, "window_radius": 3.0})
+    plan = plan_motion_path(synthetic_clip, keyframes)
+    assert (plan["edge_mode"], plan["pyramid_levels"], plan["window_radius"]) == ("knn", 2, 3.0)
+
+    # Clip without a motion graph
+    monkeypatch.setattr(tracking_position, "motion_path_strategy", {"edge_mode": "auto", "pyramid_levels": 1, "window_radius": None})
+    monkeypatch.setattr(get_scene(synthetic_clip), "motion_graph", None)
+    assert plan_motion_path(synthetic_clip, keyframes)["edge_mode"] == "dense"
+
+
+@pytest.mark.parametrize("solver, prune_nodes, budget_bytes", [
+    ("dp", 0.9, None),
+    ("dp", 0.0, None),
+    ("graph", 0.5, None),
+    ("beam", 0.0, None),
+    # Streaming
+    ("dp", 0.0, 200_000),
+    # Streaming and more pruning
+    ("graph", 0.5, 100_000),
+])
+def test_memory_estimate_bounds_peak_allocation(synthetic_clip, solver, prune_nodes, budget_bytes):
+    plan = plan_motion_path(synthetic_clip, keyframes, prune_nodes=prune_nodes, solver=solver, max_workers=1, budget_bytes=budget_bytes)
+    options = {key: plan[key] for key in ("prune_nodes", "solver", "edge_mode", "pyramid_levels", "window_radius", "max_workers", "max_memory_bytes")}
+
+    # The scene data computed on first use (feature norms) is not counted by the estimate
+    find_motion_path(synthetic_clip, keyframes, **options)
+    tracemalloc.start()
+    try:
+        find_motion_path(synthetic_clip, keyframes, **options)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # The estimate is within a factor 2 of the peak memory allocated by the solve
+    assert plan["estimated_bytes"] / 2 <= peak_bytes <= 2 * plan["estimated_bytes"]
+
+
+def test_csr_edge_weights_match_coo_construction():
+    rng = np.random.default_rng(0)
+    nb_nodes_per_frame = [3, 4, 2]
+    nodes_offsets = np.concatenate([[0], np.cumsum(nb_nodes_per_frame)])
+    graph_dim = nodes_offsets[-1]
+    frames = [(rng.normal(size=(n, 3)), rng.normal(size=(n, 8)), rng.normal(size=(n, 3)), rng.random(n)) for n in nb_nodes_per_frame]
+    weights = (1.0, 0.5, 0.1)
+
+    # Edges of each node at t to all nodes at t+1, as coordinates (rows of the nodes at t repeated, columns of the nodes at t+1 tiled)
+    data, rows, cols = [], [], []
+    for t in range(len(frames) - 1):
+        (prev_pos_3d, prev_features, flow, _), (curr_pos_3d, curr_features, _, curr_kf_cost) = frames[t], frames[t + 1]
+        prev_indices, curr_indices = np.arange(nodes_offsets[t], nodes_offsets[t + 1]), np.arange(nodes_offsets[t + 1], nodes_offsets[t + 2])
+        data.append(compute_edge_weights(prev_pos_3d, prev_features, flow, curr_pos_3d, curr_features, curr_kf_cost, *weights).ravel())
+        rows.append(np.repeat(prev_indices, len(curr_indices)))
+        cols.append(np.tile(curr_indices, len(prev_indices)))
+    expected_graph = coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=(graph_dim, graph_dim)).tocsr()
+
+    # Rows written in place in preallocated CSR arrays
+    nb_edges = sum(a * b for a, b in zip(nb_nodes_per_frame[:-1], nb_nodes_per_frame[1:]))
+    graph_matrix_data = np.full(nb_edges, np.nan, dtype=np.float32)
+    graph_matrix_indices = np.full(nb_edges, -1, dtype=np.int32)
+    current_nz_data_idx = 0
+    for t in range(len(frames) - 1):
+        (prev_pos_3d, prev_features, flow, _), (curr_pos_3d, curr_features, _, curr_kf_cost) = frames[t], frames[t + 1]
+        current_nz_data_idx = compute_all_edge_weights(
+            prev_pos_3d, prev_features, np.arange(nodes_offsets[t], nodes_offsets[t + 1]), flow,
+            curr_pos_3d, curr_features, np.arange(nodes_offsets[t + 1], nodes_offsets[t + 2]), curr_kf_cost,
+            *weights, graph_matrix_data, graph_matrix_indices, current_nz_data_idx)
+    assert current_nz_data_idx == nb_edges
+
+    rows_nb_edges = np.concatenate([np.repeat(nb_nodes_per_frame[1:], nb_nodes_per_frame[:-1]), np.zeros(nb_nodes_per_frame[-1], dtype=int)])
+    graph_matrix_indptr = np.concatenate([[0], np.cumsum(rows_nb_edges)]).astype(np.int32)
+    graph = csr_matrix((graph_matrix_data, graph_matrix_indices, graph_matrix_indptr), shape=(graph_dim, graph_dim))
+
+    assert graph.has_sorted_indices
+    np.testing.assert_array_equal(graph.indptr, expected_graph.indptr)
+    np.testing.assert_array_equal(graph.indices, expected_graph.indices)
+    # float32 weights
+    np.testing.assert_allclose(graph.data, expected_graph.data, rtol=1e-6)
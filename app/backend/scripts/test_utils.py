@@ -0,0 +1,36 @@
+import pytest
+
+from .utils import ThreadBudget
+
+# Run with:
+# cd app/backend
+# python3 -m pytest -q scripts
+
+
+def test_thread_budget_grants_remaining_threads():
+    thread_budget = ThreadBudget(max_threads=4)
+
+    with thread_budget.reserve(3) as nb_threads_a:
+        assert nb_threads_a == 3
+        with thread_budget.reserve(3) as nb_threads_b:
+            assert nb_threads_b == 1
+            # The budget is used up, but a solve can always run
+            with thread_budget.reserve(2) as nb_threads_c:
+                assert nb_threads_c == 1
+        with thread_budget.reserve(8) as nb_threads_d:
+            assert nb_threads_d == 1
+
+    # All threads are released
+    with thread_budget.reserve(8) as nb_threads:
+        assert nb_threads == 4
+
+
+def test_thread_budget_releases_threads_on_error():
+    thread_budget = ThreadBudget(max_threads=2)
+
+    with pytest.raises(ValueError):
+        with thread_budget.reserve(2):
+            raise ValueError()
+
+    with thread_budget.reserve(2) as nb_threads:
+        assert nb_threads == 2
@@ -9,7 +9,21 @@ from pymanopt.optimizers import SteepestDescent, TrustRegions
 from scipy.spatial.transform import Rotation as R
 from scipy.spatial.transform import Slerp
 
-from .utils import normalize
+from .utils import SolveCancelled, normalize
+
+
+class CancellableTrustRegions(TrustRegions):
+    '''
+    Trust regions optimizer that also stops between iterations when cancel_event is set.
+    '''
+    def __init__(self, *args, cancel_event=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cancel_event = cancel_event
+
+    def _check_stopping_criterion(self, **kwargs):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return "Terminated - solve was cancelled."
+        return super()._check_stopping_criterion(**kwargs)
 
 
 def skew(M):
@@ -158,7 +172,8 @@ def optimize_frames(
     discontinuity_threshold=0.2, 
     W_match=1, W_smooth=1, 
     stride=2,
-    quiet=False):
+    quiet=False,
+    cancel_event=None):
 
     stride = stride if (len(target_vectors) > stride + 1) else 1
     # Detect discontinuities in target vectors
@@ -244,7 +259,7 @@ def optimize_frames(
     )
 
     converged_grad_norm = 1e-06
-    optimizer = TrustRegions(verbosity=2 * int(not quiet), max_time=40, min_gradient_norm=converged_grad_norm)
+    optimizer = CancellableTrustRegions(verbosity=2 * int(not quiet), max_time=40, min_gradient_norm=converged_grad_norm, cancel_event=cancel_event)
 
     init_base_rots = initialize_base_rots(initial_rots, target_vectors, index_ranges)
     all_initial_rots = np.vstack([init_base_rots, initial_rots])
@@ -256,6 +271,9 @@ def optimize_frames(
 
     print(f"Orientation optimizer run time = {(time.time() - start_time):02f}s")
 
+    if cancel_event is not None and cancel_event.is_set():
+        raise SolveCancelled()
+
     if res.gradient_norm > converged_grad_norm:
         X = all_initial_rots
         print("Optimization is too slow => fall back to interpolation.")
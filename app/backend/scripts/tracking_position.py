@@ -1,17 +1,25 @@
 import os
+import tempfile
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 
 import numpy as np
-from scipy.sparse import bmat, csr_matrix
+from scipy.linalg import cho_solve_banded, cholesky_banded
+from scipy.interpolate import BSpline
+from scipy.sparse import (block_diag, bmat, csr_matrix, hstack, identity, kron,
+                          vstack)
 from scipy.sparse.csgraph import shortest_path
 from scipy.sparse.linalg import spsolve
 
-from .paths import backend_data_root_folder
-from .read_scene_data import (get_features, get_features_dims, get_flows,
-                              get_maps_dims, get_positions, index_into_data)
-from .utils import (compute_all_edge_weights, get_camera_ray, mse_mat,
-                    sparse_add_value)
+from .read_scene_data import (compute_feature_squared_norms, get_scene,
+                              index_into_data)
+from .utils import (compute_all_edge_weights, compute_edge_weights,
+                    compute_knn_edge_weights, get_camera_ray,
+                    lifted_min_plus_transition, project_points,
+                    raise_if_cancelled,
+                    sparse_min_plus_transition, thread_budget)
 
 
 def find_motion_path(
@@ -23,7 +31,21 @@ def find_motion_path(
       prune_nodes                      : float = 0.9,
       prune_edges                      : float = 0,
       first_frame_idx                  : int   = None,
-      last_frame_idx                   : int   = None
+      last_frame_idx                   : int   = None,
+      solver                           : str   = "dp",
+      edge_mode                        : str   = "dense",
+      knn_k                            : int   = 16,
+      beam_width                       : int   = 64,
+      beam_k                           : int   = 8,
+      feature_chunk_size               : int   = 64,
+      max_workers                      : int   = None,
+      max_memory_bytes                 : int   = None,
+      pyramid_levels                   : int   = 1,
+      corridor_radius                  : int   = 2,
+      window_radius                    : float = None,
+      window_growth                    : float = 0.5,
+      path_cache                       : dict  = None,
+      cancel_event                                 = None
     ) -> Tuple[np.ndarray, np.ndarray] : 
     '''
     Finds the shortest path through the "video volume", the directed graph that connects each pixel in frame t to every pixel in frame t+1.
@@ -37,9 +59,38 @@ def find_motion_path(
         feature_similarity_weight (float, optional): weight of the image feature term (between nodes) in the optimization. Defaults to 0.
         targets_feature_similarity_weight (float, optional): weight of the image feature term (between a node and target keyframes) in the optimization. Defaults to 0.
         prune_nodes (float, optional): Prune the X% lowest weight nodes at each frame (based on similarity with the best matching keyframe). Defaults to 0.9.
-        prune_edges (float, optional):Prune the X% lowest weight edges. Set to 0 to deactivate pruning. Defaults to 0.
+        prune_edges (float, optional):Prune the X% lowest weight edges. Set to 0 to deactivate pruning (only used by the "graph" solver). Defaults to 0.
         first_frame_idx (int, optional): frame at which to start tracking. Defaults to None (meaning we start at frame 0).
         last_frame_idx (int, optional): frame at which to end tracking. Defaults to None (meaning we end at the last frame of the video).
+        solver (str, optional): "dp" finds the shortest path by dynamic programming over the frames (the graph is a layered DAG),
+            "graph" builds the whole sparse graph and runs a generic shortest path solve (slower, uses much more memory),
+            "beam" finds an approximate shortest path by beam search (see beam_width and beam_k), much faster on long intervals, for previews. Defaults to "dp".
+        edge_mode (str, optional): "dense" connects every node at t to every node at t+1 (N_samples² edges per frame),
+            "knn" only connects each node at t to the knn_k nodes at t+1 that are closest to its advected 3D position (linear number of edges, so prune_nodes can be lowered).
+            "lifted" keeps all edges but computes the min over them exactly in O(N log N) per frame (see lifted_min_plus_transition), so node pruning can be dropped;
+            it requires feature_similarity_weight = 0 and proximity_weight > 0.
+            "precomputed" only uses the edges of the sparse motion graph computed during preprocessing (the k nearest neighbours of each pixel, see preprocess/motion_graph.py),
+            so no edge weight is computed on request; it requires feature_similarity_weight = 0 and proximity_weight > 0.
+            "knn", "lifted" and "precomputed" are only supported by the "dp" solver. Defaults to "dense".
+        knn_k (int, optional): number of neighbours per node in the "knn" edge mode. Defaults to 16.
+        beam_width (int, optional): number of partial paths kept at each frame by the "beam" solver. Defaults to 64.
+        beam_k (int, optional): number of nodes each partial path is extended to at the next frame by the "beam" solver. Defaults to 8.
+        feature_chunk_size (int, optional): number of frames of image features processed at once when computing keyframe feature costs (bounds memory use). Defaults to 64.
+        max_workers (int, optional): number of threads solving keyframe-to-keyframe intervals concurrently ("dp" and "beam" solvers), or computing the edge weights of pairs of frames concurrently ("graph" solver).
+            The threads are taken from the thread budget of the process (see utils.ThreadBudget), so fewer threads may be used when other solves are running. Defaults to None (number of CPUs).
+        max_memory_bytes (int, optional): approximate bound on the memory used by the "dp" solver, to track very long clips. When set, node costs are computed frame by frame,
+            transition costs are computed by chunks of nodes and the per-frame backpointers are spilled to temporary files if they don't fit. Defaults to None (no bound).
+        pyramid_levels (int, optional): number of levels of the coarse-to-fine solve ("dp" solver). The path is first found among the pixels of a grid downsampled 2^(levels-1) times
+            (pruned to the number of nodes kept by prune_nodes at full resolution), then at each finer level among the (unmasked) pixels of a corridor around the path of the coarser level.
+            Defaults to 1 (single resolution).
+        corridor_radius (int, optional): half-size of the square corridor around the coarser path, in pixels of the coarser level grid (so 2 * corridor_radius pixels of the finer level grid). Defaults to 2.
+        window_radius (float, optional): if set, the nodes of a frame are only selected among the pixels of a search window around the locations of the neighbouring keyframes,
+            propagated frame by frame with the 3D flow and the cameras ("dp" solver). Half-size of the window at a frame next to a keyframe, in pixels of the feature grid.
+            The windows of an interval are doubled (and the interval solved again) as long as its path goes through the border of a window. Defaults to None (no search window).
+        window_growth (float, optional): growth of the search window half-size per frame away from the keyframe, in pixels of the feature grid. Defaults to 0.5.
+        path_cache (dict, optional): paths of keyframe-to-keyframe intervals found by previous solves ("dp" and "beam" solvers). An interval whose endpoint keyframes and parameters did not change is not solved again,
+            and the paths of all intervals of this solve are (re)written in path_cache. Defaults to None (no caching).
+        cancel_event (optional): event checked between frames, the solve raises SolveCancelled as soon as it is set. Defaults to None.
 
     Returns:
         motion_path_3D_positions (np.ndarray): a (T, 3) array of 3D vectors corresponding to the 3D position of points along the trajectory at each of the T video frames
@@ -48,6 +99,23 @@ def find_motion_path(
 
     # print(proximity_weight, feature_similarity_weight, targets_feature_similarity_weight)
 
+    if solver not in ("dp", "graph", "beam"):
+        raise ValueError(f"Unsupported solver '{solver}'")
+    if solver == "beam" and (beam_width < 1 or beam_k < 1):
+        raise ValueError("The 'beam' solver requires beam_width >= 1 and beam_k >= 1")
+    if edge_mode not in ("dense", "knn", "lifted", "precomputed"):
+        raise ValueError(f"Unsupported edge mode '{edge_mode}'")
+    if edge_mode in ("lifted", "precomputed") and (feature_similarity_weight != 0 or proximity_weight <= 0):
+        raise ValueError(f"Edge mode '{edge_mode}' requires feature_similarity_weight = 0 and proximity_weight > 0")
+    if edge_mode != "dense" and solver != "dp":
+        raise ValueError(f"Edge mode '{edge_mode}' is only supported by the 'dp' solver")
+    if max_memory_bytes is not None and solver != "dp":
+        raise ValueError("A memory bound is only supported by the 'dp' solver")
+    if pyramid_levels > 1 and solver != "dp":
+        raise ValueError("Coarse-to-fine solves are only supported by the 'dp' solver")
+    if window_radius is not None and solver != "dp":
+        raise ValueError("Search windows are only supported by the 'dp' solver")
+
     # print(f"memory start: {Process().memory_info().rss:e}")
 
     # Filter out keyframes that don't contain position data
@@ -58,13 +126,12 @@ def find_motion_path(
     start_loading_data = time.time()
 
 
-    total_nb_frames, maps_res_x, maps_res_y = get_maps_dims(video_name)
-    maps_res = (maps_res_x, maps_res_y)
-    masks_archive = np.load(os.path.join(backend_data_root_folder, video_name, "masks.npz"))
-    masks = masks_archive["masks"]
+    scene = get_scene(video_name)
+    maps_res = scene.maps_res
+    masks = scene.masks
 
-    flow_3d_archive = get_flows(video_name, total_nb_frames, maps_res)
-    pos_3d_archive = get_positions(video_name, total_nb_frames, maps_res)
+    flow_3d_archive = scene.flows
+    pos_3d_archive = scene.positions
     # print(flow_3d_archive.shape, pos_3d_archive.shape)
 
     print(f"Time to load all data = {time.time() - start_loading_data:.2f}s")
@@ -79,9 +146,14 @@ def find_motion_path(
 
     # If we need videowalk features, load the pre-computed feature maps
     s = time.time()
-    T, res_x, res_y, d_feat = get_features_dims(video_name)
+    T, res_x, res_y, d_feat = scene.features_dims
     # print("feature maps dim", T, res_x, res_y, d_feat)
-    all_frames_features = get_features(video_name, T, (res_x, res_y), d_feat)
+    all_frames_features = scene.features
+
+    if edge_mode == "precomputed":
+        if scene.motion_graph is None:
+            raise ValueError(f"Edge mode 'precomputed' requires the motion graph of {video_name} (see preprocess/motion_graph.py)")
+        motion_graph_indices, motion_graph_weights = scene.motion_graph
     print(f"Time to load features = {time.time() - s:.4f}s")
     # print(f"memory after load (feature maps): {Process().memory_info().rss:e}")
 
@@ -89,54 +161,85 @@ def find_motion_path(
 
     # Compute image features at each keyframe
     max_feature_cost = 1e4
-    match_best_kf_feature_cost = np.ones((all_frames_features.shape[0], all_frames_features.shape[1]), dtype=all_frames_features.dtype) * max_feature_cost
     keyframe_times = np.array([kf["t"] for kf in keyframes])
-    keyframe_by_time = {}
-    nb_of_keyframe_influence = np.zeros(all_frames_features.shape[0])
+    keyframe_by_time = {kf["t"]: kf for kf in keyframes}
+
+    # Keyframes are single-node frames that every path goes through, so the problem splits exactly into independent keyframe-to-keyframe sub-problems ("dp" and "beam" solvers)
+    split_frames = [int(t) for t in keyframe_times if first_frame_idx < t < last_frame_idx]
+    interval_bounds = list(zip([int(first_frame_idx)] + split_frames, split_frames + [int(last_frame_idx)]))
+
+    def interval_cache_key(interval_first_frame_idx, interval_last_frame_idx):
+        # The path in an interval only depends on the keyframes at its ends (the node costs of its frames come from these keyframes only)
+        def endpoint(t):
+            return tuple(keyframe_by_time[t]["pos_2d"].tolist()) if t in keyframe_by_time else None
+        return (video_name, interval_first_frame_idx, interval_last_frame_idx, endpoint(interval_first_frame_idx), endpoint(interval_last_frame_idx),
+                proximity_weight, feature_similarity_weight, targets_feature_similarity_weight, prune_nodes, solver, edge_mode, knn_k, beam_width, beam_k, pyramid_levels, corridor_radius, window_radius, window_growth)
+
+    cached_intervals = {}
+    if solver in ("dp", "beam") and path_cache is not None:
+        for bounds in interval_bounds:
+            if interval_cache_key(*bounds) in path_cache:
+                cached_intervals[bounds] = path_cache[interval_cache_key(*bounds)]
+
+    # Frame ranges for which we need node costs
+    if solver in ("dp", "beam"):
+        dirty_intervals = [bounds for bounds in interval_bounds if bounds not in cached_intervals]
+    else:
+        dirty_intervals = [(first_frame_idx, last_frame_idx)]
+
+    keyframe_descriptors = []
     for kf_idx, kf in enumerate(keyframes):
-        start = time.time()
         kf_pos = kf["pos_2d"]
         kf_time = kf["t"]
-        keyframe_by_time[kf_time] = kf
 
         kf_flat_idx = index_into_data(kf_pos.reshape(1, 2), (1, 1), (res_x, res_y)).item()
-        kf_desc = all_frames_features[kf_time, kf_flat_idx]
+        kf_desc = all_frames_features[kf_time, kf_flat_idx].astype(np.float64)
 
         # Find out start/end of keyframe influence zone
         start_frame_idx = first_frame_idx if kf_idx == 0 else (keyframe_times[kf_idx - 1] + 1)
         end_frame_idx = last_frame_idx if kf_idx == (len(keyframes) - 1) else (keyframe_times[kf_idx + 1] - 1)
 
-        nb_of_keyframe_influence[start_frame_idx:end_frame_idx+1] += 1
-
-        # Compute L2 norm between all_frame_features and kf_desc
-        start_test = time.time()
-        match_kf_feature_cost = np.zeros((end_frame_idx + 1 - start_frame_idx, all_frames_features.shape[1]))
-        for t in range(start_frame_idx, end_frame_idx + 1):
-            match_kf_feature_cost[t - start_frame_idx] = mse_mat(all_frames_features[t], kf_desc.reshape((1, -1))).flatten()
-        # print(f"Time computing mse : {time.time() - start_test}")
-
-        # Keep the lowest cost per pixel
-        match_best_kf_feature_cost[start_frame_idx:end_frame_idx+1] = np.minimum(match_best_kf_feature_cost[start_frame_idx:end_frame_idx+1], match_kf_feature_cost)
-
-        print(f"Time computing per node cost for kf {kf_time} : {time.time() - start:.2f}s")
-
+        keyframe_descriptors.append((start_frame_idx, end_frame_idx, kf_desc, np.dot(kf_desc, kf_desc)))
+
+    def compute_kf_match_cost(chunk_start, chunk_end, features_squared_norms, kf_match_cost):
+        '''
+        Computes the cost of matching each pixel of frames [chunk_start, chunk_end) to the keyframes: the lowest squared L2 distance to the image feature of a keyframe influencing the frame,
+        computed as ||f||² - 2 f.kf_desc + ||kf_desc||². The costs are written in kf_match_cost (initialized with max_feature_cost).
+        '''
+        for start_frame_idx, end_frame_idx, kf_desc, kf_desc_squared_norm in keyframe_descriptors:
+            range_start = max(chunk_start, start_frame_idx)
+            range_end = min(chunk_end, end_frame_idx + 1)
+            if range_start >= range_end:
+                continue
 
-    start_graph_weights = time.time()
+            rows = slice(range_start - chunk_start, range_end - chunk_start)
+            match_kf_feature_cost = features_squared_norms[rows] - 2 * np.dot(all_frames_features[range_start:range_end], kf_desc) + kf_desc_squared_norm
+            # Prevent very small negative values /!\ they can arise due to floating point errors
+            np.clip(match_kf_feature_cost, 0, None, out=match_kf_feature_cost)
 
-    # Data about nodes
-    # - frame time
-    # - 2D pos (x, y) in pixels
-    nodes_2d_positions = np.empty((0, 2), dtype=int)
+            # Keep the lowest cost per pixel
+            np.minimum(kf_match_cost[rows], match_kf_feature_cost, out=kf_match_cost[rows], casting="same_kind")
 
-    source_dst_indices = []
-    sink_src_indices = []
+    # With a memory bound, node costs are computed frame by frame when selecting nodes.
+    # Otherwise, they are computed for all frames we need at once, by chunks of frames.
+    # Costs are only stored for the frames of the solve (row t - first_frame_idx for frame t), and only the features of these frames are read
+    if max_memory_bytes is None:
+        start = time.time()
+        match_best_kf_feature_cost = np.full((total_nb_frames, all_frames_features.shape[1]), max_feature_cost, dtype=all_frames_features.dtype)
+        for dirty_start_frame_idx, dirty_end_frame_idx in dirty_intervals:
+            features_squared_norms = scene.feature_squared_norms(dirty_start_frame_idx, dirty_end_frame_idx, feature_chunk_size)
+            for chunk_start in range(dirty_start_frame_idx, dirty_end_frame_idx + 1, feature_chunk_size):
+                raise_if_cancelled(cancel_event)
+                chunk_end = min(chunk_start + feature_chunk_size, dirty_end_frame_idx + 1)
+                compute_kf_match_cost(
+                    chunk_start, chunk_end,
+                    features_squared_norms[chunk_start - dirty_start_frame_idx:chunk_end - dirty_start_frame_idx],
+                    match_best_kf_feature_cost[chunk_start - first_frame_idx:chunk_end - first_frame_idx])
 
-    # store data of previous frame's nodes to compute edge weights
-    prev_frame_nodes_data = {}
+        print(f"Time computing per node costs : {time.time() - start:.2f}s")
 
-    current_node_idx = 0
-    current_nz_data_idx = 0
 
+    start_graph_weights = time.time()
 
     N_samples = int((res_x * res_y) * (1 - prune_nodes))
     nb_edges_to_prune = int(prune_edges * N_samples)
@@ -145,168 +248,591 @@ def find_motion_path(
 
     non_keyframed_frames_count = total_nb_frames - len(keyframes)
 
-    if non_keyframed_frames_count == 0:
-        # The shortest path is just the keyframes
-        shortest_path_2d_positions = np.empty((0, 2), dtype=int)
+    # Arrays read frame by frame when selecting nodes, they are read ahead by the prefetcher of the scene (see FramePrefetcher)
+    prefetched_arrays = ("positions", "flows", "masks")
+    if feature_similarity_weight > 0 or max_memory_bytes is not None:
+        prefetched_arrays += ("features",)
 
-        for kf in keyframes:
-            kf_pos = (np.round(kf["pos_2d"] * np.array([res_x, res_y]))).astype(int)
-            shortest_path_2d_positions = np.row_stack([shortest_path_2d_positions, kf_pos])
+    def select_frame_nodes(t, candidate_pixels=None, nb_nodes=N_samples):
+        '''
+        Selects the graph nodes at frame t: the keyframe pixel if t is keyframed, otherwise the N_samples pixels that best match the keyframes.
+        If candidate_pixels (flat pixel indices) is given, the nodes are the nb_nodes best candidates instead (all unmasked candidates if nb_nodes is None).
+        Returns the nodes 2D positions (in pixels), 3D positions, 3D flows (from t to t+1), image features and cost of matching to the keyframes.
+        '''
+        # is this frame keyframed?
+        if t in keyframe_times:
+            kf = keyframe_by_time[t]
 
-    else:
-        # Total number of nodes in the graph: nb_frames * nb_samples_per_frame + nb_keyframes + 2 (source/sink)
-        graph_dim = N_samples * non_keyframed_frames_count + len(keyframes) + 2
+            # kf_pos_maps = (np.round(kf["pos_2d"] * maps_res)).astype(int)
+            kf_pos_feats = (np.round(kf["pos_2d"] * np.array([res_x, res_y]))).astype(int)
 
-        source_idx = graph_dim - 2
-        sink_idx = graph_dim - 1
+            pixels_t = kf_pos_feats.reshape((1, 2))
+            pixels_t_3d = pos_3d_archive[(np.repeat(t, 1), index_into_data(kf["pos_2d"].reshape((1, 2)), (1, 1), maps_res))]
+            # flow_curr_to_next = flow_3d_archive[(np.repeat(t, 1), index_into_data(kf["pos_2d"].reshape((1, 2)), (1, 1), maps_res))]
 
-        # non-zero values: (dense samples => samples) * (nb connections)
-        # nb connections = (nb_frames - 1) => (remove connections on both sides of frames with keyframes)
-        nb_keyframe_src = np.count_nonzero(keyframe_times < last_frame_idx)
-        nb_keyframe_dst = np.count_nonzero(keyframe_times > first_frame_idx)
+            # We do not trust the flow coming from a keyframed pixel, since it might be lying on an unsafe region
+            # This flow value is only used for the proximity metric in the edge weights,
+            # this means that at the frame (k+1) right after a keyframe at (k), we directly compare positions V_{k+1} with V_k
+            flow_curr_to_next = np.zeros((pixels_t_3d.shape))
 
-        # Count adjacent keyframes
-        keyframe_time_diff = keyframe_times[1:] - keyframe_times[:-1]
-        nb_kf_kf_connexions = np.count_nonzero(keyframe_time_diff == 1)
+            kf_match_cost = np.zeros((1, 1))
 
-        # print("keyframe => keyframe", nb_kf_kf_connexions)
 
-        nb_keyframe_src -= nb_kf_kf_connexions
-        nb_keyframe_dst -= nb_kf_kf_connexions
+        else:
+            # s = time.time()
 
-        # print("frame => frame", total_nb_frames - 1 - (nb_keyframe_src + nb_keyframe_dst + nb_kf_kf_connexions))
+            feature_mask = masks[t]
 
-        graph_nz_count = N_samples * N_samples_dest * (total_nb_frames - 1 - (nb_keyframe_src + nb_keyframe_dst + nb_kf_kf_connexions)) \
-                        + nb_keyframe_src * N_samples_dest + nb_keyframe_dst * N_samples \
-                        + nb_kf_kf_connexions
+            # print("time computing mask", time.time() - s)
 
-        # Source and sink links
-        for t in [first_frame_idx, last_frame_idx]:
-            if t in keyframe_times:
-                graph_nz_count += 1
+            # Flat kf feature match cost for this frame
+            if max_memory_bytes is None:
+                kf_match_cost = match_best_kf_feature_cost[t - first_frame_idx]
             else:
-                graph_nz_count += N_samples
+                kf_match_cost = np.full((1, all_frames_features.shape[1]), max_feature_cost, dtype=all_frames_features.dtype)
+                compute_kf_match_cost(t, t + 1, compute_feature_squared_norms(all_frames_features[t:t + 1]), kf_match_cost)
+                kf_match_cost = kf_match_cost[0]
+
+            # Apply mask: put a super high cost on pixels that are unreliable
+            kf_match_cost[~feature_mask] = max_feature_cost
+
+            # Sort
+            if candidate_pixels is None:
+                sorted_pixel_idx = np.argsort(kf_match_cost)
+                to_keep_idx, to_prune_idx = np.split(sorted_pixel_idx, [N_samples])
+            else:
+                candidates_cost = kf_match_cost[candidate_pixels]
+                if nb_nodes is None:
+                    nb_nodes = max(1, np.count_nonzero(candidates_cost < max_feature_cost))
+                to_keep_idx = candidate_pixels[np.argsort(candidates_cost, kind="stable")[:nb_nodes]]
+
+            kf_match_cost = kf_match_cost[to_keep_idx]
+
+            # Read nodes 3D/flow data
+            pixels_y_t, pixels_x_t = np.unravel_index(np.arange(res_x * res_y, dtype=int)[to_keep_idx], (res_y, res_x), order='F')
+            pixels_t = np.column_stack([pixels_x_t, pixels_y_t])
 
-        graph_matrix_data = np.empty(graph_nz_count)
-        graph_matrix_row = np.empty(graph_nz_count, dtype=int)
-        graph_matrix_col = np.empty(graph_nz_count, dtype=int)
+            pixels_t_3d = pos_3d_archive[(np.repeat(t, len(pixels_t)), index_into_data(pixels_t, (res_x, res_y), maps_res))]
+            flow_curr_to_next = flow_3d_archive[(np.repeat(t, len(pixels_t)), index_into_data(pixels_t, (res_x, res_y), maps_res))]
 
-        # for every frame
-        # - find best matching image pixels (compared to keyframe pixels)
-        # - read data (3D pos, image fetures) and compute edge weights
-        for t in range(first_frame_idx, last_frame_idx + 1):
-            # print("Frame", t)
-            # is this frame keyframed?
-            if t in keyframe_times:
-                kf = keyframe_by_time[t]
+        # Image features
+        if feature_similarity_weight > 0:
+            pixels_t_features = all_frames_features[t, index_into_data(pixels_t, (res_x, res_y), (res_x, res_y))]
+        else:
+            pixels_t_features = None
 
-                # kf_pos_maps = (np.round(kf["pos_2d"] * maps_res)).astype(int)
-                kf_pos_feats = (np.round(kf["pos_2d"] * np.array([res_x, res_y]))).astype(int)
+        return pixels_t, pixels_t_3d, flow_curr_to_next, pixels_t_features, kf_match_cost
 
-                pixels_t = kf_pos_feats.reshape((1, 2))
-                pixels_t_3d = pos_3d_archive[(np.repeat(t, 1), index_into_data(kf["pos_2d"].reshape((1, 2)), (1, 1), maps_res))]
-                # flow_curr_to_next = flow_3d_archive[(np.repeat(t, 1), index_into_data(kf["pos_2d"].reshape((1, 2)), (1, 1), maps_res))]
+    if non_keyframed_frames_count == 0:
+        # The shortest path is just the keyframes
+        shortest_path_2d_positions = np.empty((0, 2), dtype=int)
 
-                # We do not trust the flow coming from a keyframed pixel, since it might be lying on an unsafe region
-                # This flow value is only used for the proximity metric in the edge weights,
-                # this means that at the frame (k+1) right after a keyframe at (k), we directly compare positions V_{k+1} with V_k
-                flow_curr_to_next = np.zeros((pixels_t_3d.shape))
+        for kf in keyframes:
+            kf_pos = (np.round(kf["pos_2d"] * np.array([res_x, res_y]))).astype(int)
+            shortest_path_2d_positions = np.concatenate([shortest_path_2d_positions, kf_pos.reshape((1, 2))])
 
-                kf_match_cost = np.zeros((1, 1))
+    elif solver in ("dp", "beam"):
+        # The graph is a layered DAG: nodes at frame t only connect to nodes at frame t+1 (plus source/sink links, that all have the same weight).
+        # So we find the shortest path by dynamic programming (Viterbi): going forward in time, we only keep the distance from the source to each node of the current frame,
+        # and for each node the index of its best predecessor in the previous frame. The path is then recovered by backtracking from the last frame.
+        nb_threads = max_workers if max_workers is not None else os.cpu_count()
+        nb_concurrent_intervals = max(1, min(nb_threads, len(dirty_intervals)))
 
+        def solve_interval(interval_first_frame_idx, interval_last_frame_idx, candidate_pixels_per_frame=None, nb_nodes=N_samples):
+            nb_frames = interval_last_frame_idx - interval_first_frame_idx + 1
 
+            # Upper bound on the number of nodes per frame
+            if candidate_pixels_per_frame is None:
+                max_nodes = N_samples
+            else:
+                # Keyframe layers have a single node (they have no candidates)
+                max_nodes = max(1, max(len(candidate_pixels) for candidate_pixels in candidate_pixels_per_frame))
+                if nb_nodes is not None:
+                    max_nodes = min(max_nodes, nb_nodes)
+
+            if max_memory_bytes is None:
+                spill_to_disk = False
+                rows_per_chunk = None
             else:
-                # s = time.time()
+                interval_memory_bytes = max_memory_bytes // nb_concurrent_intervals
+                # Half of the budget for the nodes 2D positions and backpointers (3 x int32 per node)
+                spill_to_disk = nb_frames * max_nodes * 3 * 4 > interval_memory_bytes // 2
+                # and the other half for a chunk of transition costs and the temporary arrays needed to compute it (~4 x float64 per edge)
+                rows_per_chunk = max(3, interval_memory_bytes // 2 // (4 * 8 * max_nodes))
+
+            def allocate(shape, dtype):
+                if spill_to_disk:
+                    return np.memmap(tempfile.TemporaryFile(), mode="w+", shape=shape, dtype=dtype)
+                return np.empty(shape, dtype=dtype)
+
+            # Keyframe layers only use the first node slot
+            nodes_2d_positions_per_frame = allocate((nb_frames, max_nodes, 2), np.int32)
+            backpointers_per_frame = allocate((nb_frames, max_nodes), np.int32)
+
+            for t in range(interval_first_frame_idx, interval_last_frame_idx + 1):
+                raise_if_cancelled(cancel_event)
+                scene.prefetcher.fetch(t, prefetched_arrays)
+
+                row = t - interval_first_frame_idx
+
+                if candidate_pixels_per_frame is None:
+                    pixels_t, pixels_t_3d, flow_curr_to_next, pixels_t_features, kf_match_cost = select_frame_nodes(t)
+                else:
+                    pixels_t, pixels_t_3d, flow_curr_to_next, pixels_t_features, kf_match_cost = select_frame_nodes(t, candidate_pixels_per_frame[row], nb_nodes)
+
+                if t == interval_first_frame_idx:
+                    dist = np.zeros(len(pixels_t))
+                elif edge_mode == "knn" and len(prev_pos_3d) > 1 and len(pixels_t) > 1:
+                    # Sparse min-plus product over the k nearest neighbours of each node at t-1
+                    # (edges from/to a keyframe layer stay dense, there are only N_samples of them)
+                    neighbours, weights = compute_knn_edge_weights(
+                        prev_pos_3d, prev_features, flow_prev_to_curr,
+                        pixels_t_3d, pixels_t_features, kf_match_cost, knn_k,
+                        proximity_weight, feature_similarity_weight, targets_feature_similarity_weight)
+                    edges_src = np.repeat(np.arange(len(prev_pos_3d), dtype=np.int32), neighbours.shape[1])
+                    dist, backpointers = sparse_min_plus_transition(dist, edges_src, neighbours.ravel(), weights.ravel(), len(pixels_t))
+                    backpointers_per_frame[row, :len(pixels_t)] = backpointers
+                elif edge_mode == "precomputed" and len(prev_pos_3d) > 1 and len(pixels_t) > 1:
+                    # Sparse min-plus product over the precomputed neighbours of each node at t-1 that are nodes at t
+                    # (next to keyframe layers, where the flow is not used and the keyframe may not be a neighbour, the edges stay dense)
+                    neighbour_pixels = motion_graph_indices[t - 1, index_into_data(prev_pixels, (res_x, res_y), (res_x, res_y))]
+                    neighbour_weights = motion_graph_weights[t - 1, index_into_data(prev_pixels, (res_x, res_y), (res_x, res_y))]
+
+                    node_idx_per_pixel = np.full(res_x * res_y, -1, dtype=np.int32)
+                    node_idx_per_pixel[index_into_data(pixels_t, (res_x, res_y), (res_x, res_y))] = np.arange(len(pixels_t))
+                    neighbours = node_idx_per_pixel[neighbour_pixels]
+                    is_edge = neighbours >= 0
+
+                    edges_src = np.repeat(np.arange(len(prev_pixels), dtype=np.int32), neighbours.shape[1]).reshape(neighbours.shape)
+                    weights = proximity_weight * neighbour_weights[is_edge].astype(np.float64)
+                    new_dist, backpointers = sparse_min_plus_transition(dist, edges_src[is_edge], neighbours[is_edge], weights, len(pixels_t))
+                    if np.isfinite(new_dist).any():
+                        if targets_feature_similarity_weight > 0:
+                            new_dist += targets_feature_similarity_weight * kf_match_cost.reshape(-1)
+                    else:
+                        # The motion graph is computed over all pixels: with heavy pruning, the precomputed neighbours of the reachable nodes at t-1 can all be pruned nodes.
+                        # No node at t is reached, so we use the edges to the k nearest neighbours for this pair of frames instead
+                        print(f"No precomputed edge reaches the nodes of frame {t}, using the {knn_k} nearest neighbours edges")
+                        neighbours, weights = compute_knn_edge_weights(
+                            prev_pos_3d, prev_features, flow_prev_to_curr,
+                            pixels_t_3d, pixels_t_features, kf_match_cost, knn_k,
+                            proximity_weight, feature_similarity_weight, targets_feature_similarity_weight)
+                        edges_src = np.repeat(np.arange(len(prev_pos_3d), dtype=np.int32), neighbours.shape[1])
+                        new_dist, backpointers = sparse_min_plus_transition(dist, edges_src, neighbours.ravel(), weights.ravel(), len(pixels_t))
+                    dist = new_dist
+                    backpointers_per_frame[row, :len(pixels_t)] = backpointers
+                elif edge_mode == "lifted":
+                    # Exact min-plus product as a nearest neighbour search, the feature term of the weights only depends on the node at t
+                    dist, backpointers = lifted_min_plus_transition(dist, prev_pos_3d + flow_prev_to_curr, pixels_t_3d, proximity_weight)
+                    if targets_feature_similarity_weight > 0:
+                        dist += targets_feature_similarity_weight * kf_match_cost.reshape(-1)
+                    backpointers_per_frame[row, :len(pixels_t)] = backpointers
+                else:
+                    # Min-plus product: distance to each node j at t = min_i (distance to node i at t-1 + w_ij)
+                    # computed by chunks of nodes at t-1 when memory is bounded
+                    chunk_starts = list(range(0, len(prev_pos_3d), rows_per_chunk or len(prev_pos_3d)))
+                    # mse_mat uses another formula for a single row: don't leave one alone in the last chunk, so that results don't depend on the chunking
+                    if len(chunk_starts) > 1 and len(prev_pos_3d) - chunk_starts[-1] == 1:
+                        chunk_starts[-1] -= 1
+
+                    new_dist = np.full(len(pixels_t), np.inf)
+                    backpointers = np.zeros(len(pixels_t), dtype=np.int32)
+                    for chunk_start, chunk_end in zip(chunk_starts, chunk_starts[1:] + [len(prev_pos_3d)]):
+                        transition_costs = compute_edge_weights(
+                            prev_pos_3d[chunk_start:chunk_end], None if prev_features is None else prev_features[chunk_start:chunk_end], flow_prev_to_curr[chunk_start:chunk_end],
+                            pixels_t_3d, pixels_t_features, kf_match_cost,
+                            proximity_weight, feature_similarity_weight, targets_feature_similarity_weight)
+                        transition_costs += dist[chunk_start:chunk_end, None]
+
+                        chunk_backpointers = np.argmin(transition_costs, axis=0)
+                        chunk_dist = transition_costs[chunk_backpointers, np.arange(len(pixels_t))]
+
+                        # Strict comparison: ties go to the lowest source index, as with a single argmin
+                        improved = chunk_dist < new_dist
+                        new_dist[improved] = chunk_dist[improved]
+                        backpointers[improved] = chunk_backpointers[improved] + chunk_start
+
+                    dist = new_dist
+                    backpointers_per_frame[row, :len(pixels_t)] = backpointers
+
+                nodes_2d_positions_per_frame[row, :len(pixels_t)] = pixels_t
+
+                prev_pixels = pixels_t
+                prev_pos_3d = pixels_t_3d
+                prev_features = pixels_t_features
+                flow_prev_to_curr = flow_curr_to_next
+
+            interval_cost = np.min(dist)
+
+            # Backtrack from the best node at the last frame
+            node_idx = np.argmin(dist)
+            interval_path_2d_positions = np.empty((nb_frames, 2), dtype=np.int32)
+            for row in reversed(range(nb_frames)):
+                if node_idx < 0 or not np.isfinite(interval_cost):
+                    raise ValueError(f"No path through the motion graph between frames {interval_first_frame_idx} and {interval_last_frame_idx} (edge mode '{edge_mode}'), try pruning fewer nodes")
+                interval_path_2d_positions[row] = nodes_2d_positions_per_frame[row, node_idx]
+                node_idx = backpointers_per_frame[row, node_idx]
+
+            return interval_path_2d_positions, interval_cost
+
+        def propagate_keyframe(kf, frames):
+            '''
+            Predicts the 2D location of a keyframed point at each of the given frames (consecutive frames, going away from the keyframe),
+            by moving its 3D position with the 3D flow and projecting it in the camera of the next frame.
+            Only forward flows (t -> t+1) are available: going backward, the flow from t-1 to t is approximately inverted by subtracting the forward flow of frame t-1
+            at the pixel of the point at frame t (instead of the pixel it comes from at t-1), so backward predictions are less accurate where the flow varies a lot.
+            '''
+            locations = []
+            location = kf["pos_2d"]
+            t = kf["t"]
+            for next_t in frames:
+                maps_idx = index_into_data(location.reshape((1, 2)), (1, 1), maps_res)
+                if next_t > t:
+                    point_3d = pos_3d_archive[t, maps_idx] + flow_3d_archive[t, maps_idx]
+                else:
+                    # We don't have backward flows: approximate with the forward flow of frame t-1 at the same pixel
+                    point_3d = pos_3d_archive[t, maps_idx] - flow_3d_archive[next_t, maps_idx]
+                location = np.clip(project_points(point_3d, next_t, scene.cameras)[0], 0, 1)
+                locations.append(location)
+                t = next_t
+            return locations
+
+        def search_window_candidates(interval_first_frame_idx, interval_last_frame_idx, window_scale=1):
+            '''
+            Candidate pixels at each frame of an interval: the pixels of search windows around the locations of the keyframes at the ends of the interval,
+            with a half-size that grows with the distance to the keyframe, multiplied by window_scale (no candidates for keyframed frames).
+            '''
+            nb_frames = interval_last_frame_idx - interval_first_frame_idx + 1
+            windows_per_frame = [[] for _ in range(nb_frames)]
+
+            if interval_first_frame_idx in keyframe_by_time:
+                forward_locations = propagate_keyframe(keyframe_by_time[interval_first_frame_idx], range(interval_first_frame_idx + 1, interval_last_frame_idx + 1))
+                for row, location in enumerate(forward_locations, start=1):
+                    windows_per_frame[row].append((location, (window_radius + window_growth * row) * window_scale))
+            if interval_last_frame_idx in keyframe_by_time:
+                backward_locations = propagate_keyframe(keyframe_by_time[interval_last_frame_idx], range(interval_last_frame_idx - 1, interval_first_frame_idx - 1, -1))
+                for distance, location in enumerate(backward_locations, start=1):
+                    windows_per_frame[nb_frames - 1 - distance].append((location, (window_radius + window_growth * distance) * window_scale))
+
+            candidate_pixels_per_frame = []
+            for row, windows in enumerate(windows_per_frame):
+                t = interval_first_frame_idx + row
+                if t in keyframe_by_time:
+                    candidate_pixels_per_frame.append(np.empty(0, dtype=int))
+                    continue
+                if len(windows) == 0:
+                    # No keyframe to propagate from: all pixels
+                    candidate_pixels_per_frame.append(np.arange(res_x * res_y))
+                    continue
+
+                window_pixels = []
+                for location, radius in windows:
+                    center = location * np.array([res_x, res_y])
+                    min_corner = np.clip(np.ceil(center - radius), 0, [res_x - 1, res_y - 1]).astype(int)
+                    max_corner = np.clip(np.floor(center + radius), 0, [res_x - 1, res_y - 1]).astype(int)
+                    xs, ys = np.meshgrid(np.arange(min_corner[0], max_corner[0] + 1), np.arange(min_corner[1], max_corner[1] + 1))
+                    window_pixels.append(np.column_stack([xs.flatten(), ys.flatten()]))
+                window_pixels = np.concatenate(window_pixels)
+                candidate_pixels_per_frame.append(np.unique(index_into_data(window_pixels, (res_x, res_y), (res_x, res_y))))
+
+            return candidate_pixels_per_frame
+
+        def path_on_window_border(interval_path_2d_positions, candidate_pixels_per_frame):
+            '''
+            Whether the path goes through a pixel on the border of the search windows (a pixel with a neighbour in the grid that is not a candidate) at some frame.
+            '''
+            neighbour_offsets = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1]), axis=-1).reshape((-1, 2))
+            for path_pixel, candidate_pixels in zip(interval_path_2d_positions, candidate_pixels_per_frame):
+                # Keyframed frames have no candidates
+                if len(candidate_pixels) == 0:
+                    continue
+                neighbour_pixels = np.clip(path_pixel + neighbour_offsets, [0, 0], [res_x - 1, res_y - 1])
+                if not np.all(np.isin(index_into_data(neighbour_pixels, (res_x, res_y), (res_x, res_y)), candidate_pixels)):
+                    return True
+            return False
+
+        def solve_interval_coarse_to_fine(interval_first_frame_idx, interval_last_frame_idx):
+            if window_radius is None:
+                return solve_interval_levels(interval_first_frame_idx, interval_last_frame_idx)
+
+            # The windows follow approximate locations of the keyframes (see propagate_keyframe): while the path found in the windows touches their border,
+            # the optimum may be outside, so the windows are doubled and the interval solved again (at worst until the windows cover the whole grid)
+            window_scale = 1
+            nb_previous_candidates = None
+            while True:
+                window_candidate_pixels_per_frame = search_window_candidates(interval_first_frame_idx, interval_last_frame_idx, window_scale)
+                nb_candidates = sum(len(candidate_pixels) for candidate_pixels in window_candidate_pixels_per_frame)
+                if nb_candidates == nb_previous_candidates:
+                    # The windows don't grow (zero size)
+                    return interval_path_2d_positions, interval_cost
+                interval_path_2d_positions, interval_cost = solve_interval_levels(interval_first_frame_idx, interval_last_frame_idx, window_candidate_pixels_per_frame)
+                if not path_on_window_border(interval_path_2d_positions, window_candidate_pixels_per_frame):
+                    return interval_path_2d_positions, interval_cost
+                window_scale *= 2
+                nb_previous_candidates = nb_candidates
+
+        def solve_interval_levels(interval_first_frame_idx, interval_last_frame_idx, window_candidate_pixels_per_frame=None):
+            if pyramid_levels <= 1:
+                if window_candidate_pixels_per_frame is None:
+                    return solve_interval(interval_first_frame_idx, interval_last_frame_idx)
+                return solve_interval(interval_first_frame_idx, interval_last_frame_idx, window_candidate_pixels_per_frame, N_samples)
+
+            nb_frames = interval_last_frame_idx - interval_first_frame_idx + 1
+            # The coarser path is only known to a pixel of the coarser grid (2 pixels of the finer grid): the corridor radius is scaled by the downsampling factor between levels
+            level_corridor_radius = 2 * corridor_radius
+            corridor_offsets = np.stack(np.meshgrid(np.arange(-level_corridor_radius, level_corridor_radius + 1), np.arange(-level_corridor_radius, level_corridor_radius + 1)), axis=-1).reshape((-1, 2))
+
+            interval_path_2d_positions = None
+            for level in reversed(range(pyramid_levels)):
+                level_res = (max(1, round(res_x / 2**level)), max(1, round(res_y / 2**level)))
+
+                if interval_path_2d_positions is None:
+                    # Coarsest level: all pixels of the level grid, pruned to the number of nodes of a single resolution solve
+                    # (pruning the same fraction of the much smaller grid would leave a handful of nodes, and a path far from the optimum)
+                    level_pixels = np.stack(np.meshgrid(np.arange(level_res[0]), np.arange(level_res[1])), axis=-1).reshape((-1, 2))
+                    level_candidates = np.unique(index_into_data(level_pixels, level_res, (res_x, res_y)))
+                    candidate_pixels_per_frame = [level_candidates] * nb_frames
+                    if window_candidate_pixels_per_frame is not None:
+                        # Restricted to the search windows (if a window misses all the pixels of the level grid, we keep the window)
+                        candidate_pixels_per_frame = []
+                        for window_candidates in window_candidate_pixels_per_frame:
+                            level_window_candidates = np.intersect1d(level_candidates, window_candidates)
+                            candidate_pixels_per_frame.append(level_window_candidates if len(level_window_candidates) > 0 else window_candidates)
+                    nb_nodes = max(1, min(len(level_candidates), N_samples))
+                else:
+                    # Finer levels: pixels of the level grid in a corridor around the path found at the coarser level
+                    path_level_pixels = np.round(interval_path_2d_positions * np.array([level_res[0] / res_x, level_res[1] / res_y])).astype(int)
+                    candidate_pixels_per_frame = []
+                    for path_level_pixel in path_level_pixels:
+                        corridor_pixels = np.clip(path_level_pixel + corridor_offsets, [0, 0], [level_res[0] - 1, level_res[1] - 1])
+                        candidate_pixels_per_frame.append(np.unique(index_into_data(corridor_pixels, level_res, (res_x, res_y))))
+                    nb_nodes = None
+
+                interval_path_2d_positions, interval_cost = solve_interval(interval_first_frame_idx, interval_last_frame_idx, candidate_pixels_per_frame, nb_nodes)
+
+            return interval_path_2d_positions, interval_cost
+
+        def solve_interval_beam(interval_first_frame_idx, interval_last_frame_idx):
+            '''
+            Approximate solve of an interval by beam search ("beam" solver): only the beam_width best partial paths (scored by their accumulated edge weights) are kept at each frame,
+            and each of them is only extended to the beam_k nodes closest to its advected 3D position, so the search computes O(nb_frames * beam_width * beam_k) edge weights.
+            Beams start from the keyframes at the ends of the interval (forward from the first one, backward from the last one) and are joined halfway.
+            '''
+            def frame_nodes(t, step):
+                raise_if_cancelled(cancel_event)
+                scene.prefetcher.fetch(t, prefetched_arrays, step)
+                pixels_t, pixels_t_3d, flow_curr_to_next, pixels_t_features, kf_match_cost = select_frame_nodes(t)
+                return pixels_t, pixels_t_3d, flow_curr_to_next, pixels_t_features, kf_match_cost.reshape(-1)
+
+            def subset(nodes, indices):
+                return tuple(None if nodes_data is None else nodes_data[indices] for nodes_data in nodes)
+
+            def extend_beam(beam, beam_scores, nodes, forward):
+                # Edges from each path of the beam to the nodes of the next frame (forward: beam at t-1 -> nodes at t, backward: nodes at t -> beam at t+1)
+                _, beam_3d, beam_flows, beam_features, beam_kf_match_cost = beam
+                _, nodes_3d, nodes_flows, nodes_features, nodes_kf_match_cost = nodes
+
+                # Enough neighbours to fill the beam, even when starting from a single keyframe node
+                k = max(beam_k, -(-beam_width // len(beam_3d)))
+
+                if forward:
+                    neighbours, weights = compute_knn_edge_weights(
+                        beam_3d, beam_features, beam_flows,
+                        nodes_3d, nodes_features, nodes_kf_match_cost, k,
+                        proximity_weight, feature_similarity_weight, targets_feature_similarity_weight)
+                else:
+                    # Nodes at t whose advected positions are the closest to the beam positions at t+1 (the keyframe/target term belongs to the node at t+1)
+                    neighbours, weights = compute_knn_edge_weights(
+                        beam_3d, beam_features, np.zeros(beam_3d.shape),
+                        nodes_3d + nodes_flows, nodes_features, None, k,
+                        proximity_weight, feature_similarity_weight, 0)
+                    if targets_feature_similarity_weight > 0:
+                        weights += targets_feature_similarity_weight * beam_kf_match_cost[:, None]
+
+                edges_src = np.repeat(np.arange(len(beam_3d), dtype=np.int32), neighbours.shape[1])
+                dist, backpointers = sparse_min_plus_transition(beam_scores, edges_src, neighbours.ravel(), weights.ravel(), len(nodes_3d))
+
+                # Best reached nodes (one path per node)
+                reached = np.flatnonzero(np.isfinite(dist))
+                kept = reached[np.argsort(dist[reached], kind="stable")[:beam_width]]
+
+                return subset(nodes, kept), dist[kept], backpointers[kept]
+
+            def run_beam(frames, forward):
+                # Beams along the given frames (in the order of the search), with pointers from each path of a beam to the path it extends in the previous beam
+                step = 1 if forward else -1
+                beam = frame_nodes(frames[0], step)
+                if frames[0] not in keyframe_by_time:
+                    # No keyframe to start from: best matching nodes
+                    beam = subset(beam, np.arange(min(beam_width, len(beam[0]))))
+                beam_scores = np.zeros(len(beam[0]))
+                beams, pointers = [beam], [None]
+                for t in frames[1:]:
+                    beam, beam_scores, beam_pointers = extend_beam(beam, beam_scores, frame_nodes(t, step), forward)
+                    beams.append(beam)
+                    pointers.append(beam_pointers)
+                return beams, beam_scores, pointers
+
+            def backtrack(pointers, path_idx):
+                path_indices = [path_idx]
+                for beam_pointers in reversed(pointers[1:]):
+                    path_indices.append(beam_pointers[path_indices[-1]])
+                return path_indices[::-1]
+
+            frames = list(range(interval_first_frame_idx, interval_last_frame_idx + 1))
+            starts_at_keyframe = interval_first_frame_idx in keyframe_by_time
+            ends_at_keyframe = interval_last_frame_idx in keyframe_by_time
+
+            if starts_at_keyframe and ends_at_keyframe:
+                # Forward beam on the first half of the frames, backward beam on the second half, joined by the edges between the two middle beams
+                middle = len(frames) // 2
+                forward_beams, forward_scores, forward_pointers = run_beam(frames[:middle], forward=True)
+                backward_beams, backward_scores, backward_pointers = run_beam(frames[middle:][::-1], forward=False)
+
+                _, forward_3d, forward_flows, forward_features, _ = forward_beams[-1]
+                _, backward_3d, _, backward_features, backward_kf_match_cost = backward_beams[-1]
+                join_costs = forward_scores[:, None] + compute_edge_weights(
+                    forward_3d, forward_features, forward_flows,
+                    backward_3d, backward_features, backward_kf_match_cost,
+                    proximity_weight, feature_similarity_weight, targets_feature_similarity_weight) + backward_scores[None, :]
+
+                forward_idx, backward_idx = np.unravel_index(np.argmin(join_costs), join_costs.shape)
+                interval_cost = join_costs[forward_idx, backward_idx]
+
+                forward_path = backtrack(forward_pointers, forward_idx)
+                backward_path = backtrack(backward_pointers, backward_idx)[::-1]
+                interval_path_2d_positions = np.concatenate(
+                    [beam[0][[idx]] for beam, idx in zip(forward_beams, forward_path)] +
+                    [beam[0][[idx]] for beam, idx in zip(backward_beams[::-1], backward_path)])
+            else:
+                # A single beam, from the keyframe (if there is one)
+                forward = starts_at_keyframe or not ends_at_keyframe
+                beams, beam_scores, pointers = run_beam(frames if forward else frames[::-1], forward)
 
-                feature_mask = masks[t]
+                path_idx = np.argmin(beam_scores)
+                interval_cost = beam_scores[path_idx]
+                interval_path_2d_positions = np.concatenate([beam[0][[idx]] for beam, idx in zip(beams, backtrack(pointers, path_idx))])
+                if not forward:
+                    interval_path_2d_positions = interval_path_2d_positions[::-1]
 
-                # print("time computing mask", time.time() - s)
+            return interval_path_2d_positions, interval_cost
 
-                # Flat kf feature match cost for this frame
-                kf_match_cost = match_best_kf_feature_cost[t]
+        print(f"Solving for the shortest path in {len(interval_bounds)} independent intervals: {interval_bounds} ({len(cached_intervals)} found in cache)")
 
-                # Apply mask: put a super high cost on pixels that are unreliable
-                kf_match_cost[~feature_mask] = max_feature_cost
+        with thread_budget.reserve(nb_concurrent_intervals) as nb_granted_threads, ThreadPoolExecutor(max_workers=nb_granted_threads) as pool:
+            solve = solve_interval_beam if solver == "beam" else solve_interval_coarse_to_fine
+            solved_intervals = dict(zip(dirty_intervals, pool.map(lambda bounds: solve(*bounds), dirty_intervals)))
 
-                # Sort
-                sorted_pixel_idx = np.argsort(kf_match_cost)
-                to_keep_idx, to_prune_idx = np.split(sorted_pixel_idx, [N_samples])
-                keep_indices = np.zeros(len(sorted_pixel_idx), dtype=bool)
-                keep_indices[to_keep_idx] = True
+        interval_results = [cached_intervals[bounds] if bounds in cached_intervals else solved_intervals[bounds] for bounds in interval_bounds]
 
-                kf_match_cost = kf_match_cost[to_keep_idx]
+        if path_cache is not None:
+            for bounds, interval_result in zip(interval_bounds, interval_results):
+                path_cache[interval_cache_key(*bounds)] = interval_result
 
-                # Read nodes 3D/flow data
-                pixels_y_t, pixels_x_t = np.unravel_index(np.arange(res_x * res_y, dtype=int)[to_keep_idx], (res_y, res_x), order='F')
-                pixels_t = np.column_stack([pixels_x_t, pixels_y_t])
+        print(f"Time to solve for the shortest path ({'beam search' if solver == 'beam' else 'dynamic programming'}) {time.time() - start_graph_weights:.2f}s")
 
-                pixels_t_3d = pos_3d_archive[(np.repeat(t, len(pixels_t)), index_into_data(pixels_t, (res_x, res_y), maps_res))]
-                flow_curr_to_next = flow_3d_archive[(np.repeat(t, len(pixels_t)), index_into_data(pixels_t, (res_x, res_y), maps_res))]
+        print("Full path cost", sum(interval_cost for _, interval_cost in interval_results))
 
-            nodes_2d_positions = np.row_stack([nodes_2d_positions, pixels_t])
+        # Stitch intervals (consecutive intervals share their keyframe)
+        shortest_path_2d_positions = np.concatenate(
+            [interval_results[0][0]] + [interval_path_2d_positions[1:] for interval_path_2d_positions, _ in interval_results[1:]]
+        )
 
-            # Image features
-            if feature_similarity_weight > 0:
-                pixels_t_features = all_frames_features[t, index_into_data(pixels_t, (res_x, res_y), (res_x, res_y))]
-            else:
-                pixels_t_features = None
+    else:
+        # The graph is built in two phases: nodes are first selected at every frame, then the edge weights of each pair of frames (t, t+1) are computed in a thread pool.
+        # Edges of each pair of frames are written in their own (disjoint) slice of the sparse graph matrix arrays, so the threads don't need to synchronize.
+        nb_threads = max_workers if max_workers is not None else os.cpu_count()
 
-            nodes_indices_t = current_node_idx + np.arange(len(pixels_t))
+        with thread_budget.reserve(nb_threads) as nb_granted_threads, ThreadPoolExecutor(max_workers=nb_granted_threads) as pool:
+            def select_nodes_if_not_cancelled(t):
+                raise_if_cancelled(cancel_event)
+                scene.prefetcher.fetch(t, prefetched_arrays)
+                return select_frame_nodes(t)
 
-            # Compute edge weights with nodes from prev frame
-            if t > first_frame_idx:
-                s = time.time()
+            # Phase 1: select nodes at every frame
+            frames_nodes = list(pool.map(select_nodes_if_not_cancelled, range(first_frame_idx, last_frame_idx + 1)))
 
-                prev_pos_3d = prev_frame_nodes_data["pos_3d"]
-                prev_features = prev_frame_nodes_data["features"]
-                prev_indices = prev_frame_nodes_data["indices"]
+            # Data about nodes
+            # - 2D pos (x, y) in pixels
+            nodes_2d_positions = np.concatenate([pixels_t for pixels_t, *_ in frames_nodes])
 
+            nb_nodes_per_frame = np.array([len(pixels_t) for pixels_t, *_ in frames_nodes])
+            nodes_offsets = np.concatenate([[0], np.cumsum(nb_nodes_per_frame)])
 
-                current_nz_data_idx = compute_all_edge_weights(
-                    prev_pos_3d, prev_features, prev_indices, flow_prev_to_curr,
-                    pixels_t_3d, pixels_t_features, nodes_indices_t, kf_match_cost,
-                    proximity_weight, feature_similarity_weight, targets_feature_similarity_weight, 
-                    graph_matrix_data, graph_matrix_row, graph_matrix_col, 
-                    current_nz_data_idx)
+            # Total number of nodes in the graph: nodes of all frames + 2 (source/sink)
+            graph_dim = nodes_offsets[-1] + 2
 
-                # print("time computing edge weights", time.time() - s)
+            source_idx = graph_dim - 2
+            sink_idx = graph_dim - 1
 
-            prev_frame_nodes_data = {"pos_3d": pixels_t_3d, "features": pixels_t_features, "indices": nodes_indices_t, "features_to_kf": kf_match_cost}
-            current_node_idx += len(nodes_indices_t)
+            # The graph matrix is assembled directly in CSR format: since nodes are numbered frame by frame, the rows of the nodes of frame t are consecutive
+            # and they only contain edges to the nodes of frame t+1 (in order). So all rows can be laid out before computing any weight:
+            # - rows of nodes at frame t < T-1: one edge to each node at t+1
+            # - rows of nodes at the last frame: one edge to the sink
+            # - row of the source: one edge to each node at the first frame
+            # - row of the sink: empty
+            nb_edges_per_frame_pair = nb_nodes_per_frame[:-1] * nb_nodes_per_frame[1:]
+            edges_offsets = np.concatenate([[0], np.cumsum(nb_edges_per_frame_pair)])
 
-            flow_prev_to_curr = flow_curr_to_next
+            source_dst_indices = np.arange(nodes_offsets[0], nodes_offsets[1])
+            sink_src_indices = np.arange(nodes_offsets[-2], nodes_offsets[-1])
 
-            # Set source/sink for first/last frames
-            if t == first_frame_idx:
-                source_dst_indices = prev_frame_nodes_data["indices"]
-            if t == last_frame_idx:
-                sink_src_indices = prev_frame_nodes_data["indices"]
+            graph_nz_count = edges_offsets[-1] + len(sink_src_indices) + len(source_dst_indices)
 
+            # int32 indices unless the graph is too big for them
+            graph_index_dtype = np.int32 if max(graph_nz_count, graph_dim) < np.iinfo(np.int32).max else np.int64
 
-        print(f"Time to compute all edge weights {time.time() - start_graph_weights:.2f}s")
+            rows_nb_edges = np.concatenate([np.repeat(nb_nodes_per_frame[1:], nb_nodes_per_frame[:-1]), np.ones(len(sink_src_indices), dtype=int), [len(source_dst_indices), 0]])
+            graph_matrix_indptr = np.zeros(graph_dim + 1, dtype=graph_index_dtype)
+            np.cumsum(rows_nb_edges, out=graph_matrix_indptr[1:])
 
-        # Add source and sink links
-        # - source
-        graph_matrix_data[current_nz_data_idx:current_nz_data_idx+len(source_dst_indices)] = 1
-        graph_matrix_row[current_nz_data_idx:current_nz_data_idx+len(source_dst_indices)] = source_idx
-        graph_matrix_col[current_nz_data_idx:current_nz_data_idx+len(source_dst_indices)] = source_dst_indices
+            graph_matrix_data = np.empty(graph_nz_count, dtype=np.float32)
+            graph_matrix_indices = np.empty(graph_nz_count, dtype=graph_index_dtype)
 
-        current_nz_data_idx += len(source_dst_indices)
+            # Phase 2: compute edge weights between nodes of frames t and t+1 (read data (3D pos, image fetures) and compute edge weights)
+            def compute_frame_pair_edge_weights(pair_idx):
+                raise_if_cancelled(cancel_event)
+
+                _, prev_pos_3d, flow_prev_to_curr, prev_features, _ = frames_nodes[pair_idx]
+                _, pixels_t_3d, _, pixels_t_features, kf_match_cost = frames_nodes[pair_idx + 1]
+
+                compute_all_edge_weights(
+                    prev_pos_3d, prev_features, np.arange(nodes_offsets[pair_idx], nodes_offsets[pair_idx + 1]), flow_prev_to_curr,
+                    pixels_t_3d, pixels_t_features, np.arange(nodes_offsets[pair_idx + 1], nodes_offsets[pair_idx + 2]), kf_match_cost,
+                    proximity_weight, feature_similarity_weight, targets_feature_similarity_weight,
+                    graph_matrix_data, graph_matrix_indices,
+                    edges_offsets[pair_idx])
 
+            # Consume the iterator so that exceptions raised in the threads (e.g. cancellation) are propagated here
+            for _ in pool.map(compute_frame_pair_edge_weights, range(total_nb_frames - 1)):
+                pass
+
+        print(f"Time to compute all edge weights {time.time() - start_graph_weights:.2f}s ({nb_granted_threads} threads)")
+
+        current_nz_data_idx = edges_offsets[-1]
+
+        # Add source and sink links
         # - sink
         graph_matrix_data[current_nz_data_idx:current_nz_data_idx+len(sink_src_indices)] = 1
-        graph_matrix_row[current_nz_data_idx:current_nz_data_idx+len(sink_src_indices)] = sink_src_indices
-        graph_matrix_col[current_nz_data_idx:current_nz_data_idx+len(sink_src_indices)] = sink_idx
+        graph_matrix_indices[current_nz_data_idx:current_nz_data_idx+len(sink_src_indices)] = sink_idx
 
         current_nz_data_idx += len(sink_src_indices)
 
+        # - source
+        graph_matrix_data[current_nz_data_idx:current_nz_data_idx+len(source_dst_indices)] = 1
+        graph_matrix_indices[current_nz_data_idx:current_nz_data_idx+len(source_dst_indices)] = source_dst_indices
+
+        current_nz_data_idx += len(source_dst_indices)
+
         if (np.any(graph_matrix_data < 0)):
             print(f"WARNING: some graph weights are < 0! min value = {np.min(graph_matrix_data)}. Clipping to zero to prevent failure in graph shortest path solve.")
-            graph_matrix_data = np.clip(graph_matrix_data, a_min=0, a_max=None)
+            np.clip(graph_matrix_data, a_min=0, a_max=None, out=graph_matrix_data)
 
-        start_graph_build = time.time()
-        graph_csr = csr_matrix((graph_matrix_data, (graph_matrix_row, graph_matrix_col)), shape=(graph_dim,graph_dim))
-        print(f"Time creating graph matrix: {time.time() - start_graph_build:.2f}s")
+        raise_if_cancelled(cancel_event)
+
+        # Wrap the arrays (no copy, no sorting)
+        graph_csr = csr_matrix((graph_matrix_data, graph_matrix_indices, graph_matrix_indptr), shape=(graph_dim,graph_dim))
+        print(f"Graph matrix: {graph_dim} nodes, {graph_nz_count} edges ({(graph_matrix_data.nbytes + graph_matrix_indices.nbytes + graph_matrix_indptr.nbytes) / 1024**2:.0f}MB)")
 
         # Find the shortest path from source to sink
         start = time.time()
@@ -366,18 +892,411 @@ def find_motion_path(
                                                                             shortest_path_3d_velocities[kf['t'] - first_frame_idx + 1]
                                                                         ], axis = 0)
 
+    print(f"Frame prefetching for clip {video_name}: {scene.prefetcher.hits} hits, {scene.prefetcher.stalls} stalls (since the clip was loaded)")
+
     # print(f"memory end: {Process().memory_info().rss:e}")
     
 
     return shortest_path_3d_positions, shortest_path_3d_velocities
 
 
+# Memory budget of the motion path solves of each process (see plan_motion_path), None means no budget
+motion_path_memory_budget = None
+
+def configure_motion_path_memory_budget(max_bytes):
+    global motion_path_memory_budget
+    motion_path_memory_budget = max_bytes
+
+
+# Edge mode, number of coarse-to-fine levels and search window of the "dp" motion path solves of each process (see plan_motion_path),
+# the "auto" edge mode uses the precomputed motion graph of a clip if there is one, and dense edges otherwise
+motion_path_strategy = {"edge_mode": "auto", "pyramid_levels": 1, "window_radius": None}
+
+def configure_motion_path_strategy(edge_mode="auto", pyramid_levels=1, window_radius=None):
+    if edge_mode not in ("auto", "dense", "knn", "lifted", "precomputed"):
+        raise ValueError(f"Unknown edge mode {edge_mode}, expected 'auto', 'dense', 'knn', 'lifted' or 'precomputed'")
+    if pyramid_levels < 1:
+        raise ValueError(f"The number of coarse-to-fine levels must be at least 1, got {pyramid_levels}")
+    if window_radius is not None and window_radius <= 0:
+        raise ValueError(f"The search window radius must be positive, got {window_radius}")
+    motion_path_strategy.update(edge_mode=edge_mode, pyramid_levels=pyramid_levels, window_radius=window_radius)
+
+
+def estimate_motion_path_memory(
+      nb_frames_per_interval: List[int],
+      nb_pixels             : int,
+      prune_nodes           : float,
+      solver                : str,
+      edge_mode             : str,
+      knn_k                 : int,
+      nb_threads            : int,
+      max_memory_bytes      : int = None,
+      beam_width            : int = 64,
+      beam_k                : int = 8,
+      feature_dim           : int = 0,
+      feature_chunk_size    : int = 64
+    ) -> int:
+    '''
+    Estimates the peak memory used by find_motion_path (arrays allocated by the solve only, scene data is not counted).
+    The estimate is meant as an upper bound: keyframe layers are counted as full layers. Small allocations (per node of a single frame) are not counted,
+    so on very small problems (a few hundred pixels) the estimate can be below the actual peak.
+
+    Args:
+        nb_frames_per_interval (List[int]): number of frames of each keyframe-to-keyframe interval of the solved range
+        nb_pixels (int): number of pixels of the feature grid
+        prune_nodes, solver, edge_mode, knn_k, max_memory_bytes, beam_width, beam_k, feature_chunk_size: see find_motion_path
+        nb_threads (int): number of threads of the solve
+        feature_dim (int, optional): dimension of the image features. Defaults to 0 (the temporary arrays of the keyframe feature costs are not counted).
+
+    Returns:
+        int: estimated peak memory in bytes
+    '''
+    nb_nodes = max(1, int(nb_pixels * (1 - prune_nodes)))
+    float64_size = np.dtype(np.float64).itemsize
+    int32_size = np.dtype(np.int32).itemsize
+
+    nb_frames = sum(nb_frames_per_interval) - (len(nb_frames_per_interval) - 1)
+
+    # Node costs: keyframe match costs (float32) and feature squared norms (float64) of all frames of the solve,
+    # computed frame by frame with a memory bound.
+    # Computing them makes float64 copies of the image features of a chunk of frames (of one frame per thread with a memory bound) and a few float64 temporaries per pixel:
+    # before the solve (they are freed when it starts), or while selecting nodes with a memory bound
+    if max_memory_bytes is None:
+        node_costs_bytes = nb_frames * nb_pixels * (np.dtype(np.float32).itemsize + float64_size)
+        features_bytes = min(feature_chunk_size, max(nb_frames_per_interval) if solver != "graph" else nb_frames) * nb_pixels * (feature_dim + 3) * float64_size
+    else:
+        node_costs_bytes = nb_pixels * (np.dtype(np.float32).itemsize + float64_size) + nb_threads * nb_pixels * (feature_dim + 4) * float64_size
+        features_bytes = 0
+
+    # Selecting the nodes of a frame sorts the costs of all its pixels (a few int64/float64 arrays per pixel) in each thread
+    node_costs_bytes += nb_threads * nb_pixels * 4 * float64_size
+
+    if solver == "graph":
+        nb_graph_nodes = nb_frames * nb_nodes
+        nb_graph_edges = (nb_frames - 1) * nb_nodes**2 + 2 * nb_nodes
+        # CSR matrix (float32 weights, int32 indices), float64 copy of the weights made by the shortest path solve,
+        # nodes data (2D/3D positions and flows), distances/predecessors and the edge weights being computed by each thread
+        graph_bytes = nb_graph_edges * (np.dtype(np.float32).itemsize + int32_size + float64_size) \
+            + nb_graph_nodes * (int32_size + 2 * 8 + 6 * float64_size + float64_size + int32_size) \
+            + nb_threads * 4 * float64_size * nb_nodes**2
+        return node_costs_bytes + max(features_bytes, graph_bytes)
+
+    nb_concurrent_intervals = max(1, min(nb_threads, len(nb_frames_per_interval)))
+    largest_intervals = sorted(nb_frames_per_interval, reverse=True)[:nb_concurrent_intervals]
+
+    if solver == "beam":
+        # Beams of all frames of each interval (2D/3D positions, flows, matching costs and pointers of beam_width nodes),
+        # the nodes of the frame being extended to and the weights of the beam_width * beam_k edges (or beam_width² edges when joining the forward and backward beams, ~4 x float64 per edge)
+        beam_bytes = [nb_frames * beam_width * (2 * 8 + 7 * float64_size + int32_size) for nb_frames in largest_intervals]
+        frame_bytes = nb_nodes * (2 * 8 + 7 * float64_size) + 4 * float64_size * beam_width * max(beam_k, beam_width)
+        return node_costs_bytes + max(features_bytes, sum(beam_bytes) + nb_concurrent_intervals * frame_bytes)
+
+    # "dp" solver: nodes 2D positions and backpointers of each interval (3 x int32 per node),
+    # and transition costs of one pair of frames (~4 x float64 per edge, see solve_interval)
+    if edge_mode == "dense":
+        nb_edges = nb_nodes**2
+    elif edge_mode in ("knn", "precomputed"):
+        nb_edges = nb_nodes * knn_k
+    else:
+        nb_edges = nb_nodes
+
+    interval_bytes = [nb_frames * nb_nodes * 3 * int32_size for nb_frames in largest_intervals]
+    transition_bytes = 4 * float64_size * nb_edges
+
+    if max_memory_bytes is not None:
+        # Same bounds as in solve_interval: backpointers are spilled to disk beyond half of the interval budget,
+        # transition costs are computed by chunks of at least 3 rows
+        interval_memory_bytes = max_memory_bytes // nb_concurrent_intervals
+        interval_bytes = [b if b <= interval_memory_bytes // 2 else 0 for b in interval_bytes]
+        if edge_mode == "dense":
+            transition_bytes = 4 * float64_size * nb_nodes * min(nb_nodes, max(3, interval_memory_bytes // 2 // (4 * float64_size * nb_nodes)))
+
+    return node_costs_bytes + max(features_bytes, sum(interval_bytes) + nb_concurrent_intervals * transition_bytes)
+
+
+def plan_motion_path(
+      video_name      : str,
+      keyframes       : List[dict],
+      first_frame_idx : int   = None,
+      last_frame_idx  : int   = None,
+      prune_nodes     : float = 0.9,
+      solver          : str   = "dp",
+      edge_mode       : str   = None,
+      knn_k           : int   = 16,
+      max_workers     : int   = None,
+      max_memory_bytes: int   = None,
+      beam_width      : int   = 64,
+      beam_k          : int   = 8,
+      pyramid_levels  : int   = None,
+      window_radius   : float = None,
+      budget_bytes    : int   = None
+    ) -> dict:
+    '''
+    Chooses how to run find_motion_path within a memory budget. The peak memory of the requested strategy is estimated (see estimate_motion_path_memory),
+    and if it is over the budget, cheaper strategies are tried in order until one fits:
+    - the "dp" solver instead of the "graph" solver,
+    - solving the keyframe-to-keyframe intervals one at a time instead of concurrently,
+    - the streaming mode of the "dp" solver (max_memory_bytes set to the budget),
+    - more node pruning (halving the number of nodes per frame).
+
+    Args:
+        video_name, keyframes, first_frame_idx, last_frame_idx, prune_nodes, solver, knn_k, max_workers, max_memory_bytes, beam_width, beam_k: requested arguments of find_motion_path
+        edge_mode, pyramid_levels, window_radius (optional): requested arguments of find_motion_path. Default to None (for the "dp" solver, the strategy configured for the process
+            with configure_motion_path_strategy, where the "auto" edge mode is "precomputed" if the motion graph of the clip was computed and "dense" otherwise;
+            for the other solvers, dense edges at a single resolution without search windows).
+        budget_bytes (int, optional): memory budget. Defaults to None (the budget configured for the process with configure_motion_path_memory_budget,
+            if there is none the requested strategy is kept).
+
+    Returns:
+        dict: arguments of find_motion_path to use ("prune_nodes", "solver", "edge_mode", "pyramid_levels", "window_radius", "max_workers", "max_memory_bytes"),
+            the estimated peak memory ("estimated_bytes"), the budget ("budget_bytes"), the list of changes made to fit the budget ("changes")
+            and a one-line description of the plan ("summary")
+    '''
+    if budget_bytes is None:
+        budget_bytes = motion_path_memory_budget
+
+    scene = get_scene(video_name)
+    _, res_x, res_y, feature_dim = scene.features_dims
+    nb_pixels = int(res_x * res_y)
+
+    if first_frame_idx is None:
+        first_frame_idx = 0
+    if last_frame_idx is None:
+        last_frame_idx = len(scene.positions) - 1
+
+    # Keyframe layout: the "dp" solver solves keyframe-to-keyframe intervals independently
+    split_frames = [int(kf["t"]) for kf in keyframes if first_frame_idx < kf["t"] < last_frame_idx]
+    nb_frames_per_interval = [b - a + 1 for a, b in zip([first_frame_idx] + split_frames, split_frames + [last_frame_idx])]
+
+    # Sparse edges, coarse-to-fine levels and search windows are only supported by the "dp" solver
+    strategy = motion_path_strategy if solver == "dp" else {"edge_mode": "dense", "pyramid_levels": 1, "window_radius": None}
+    if edge_mode is None:
+        edge_mode = strategy["edge_mode"]
+    if edge_mode == "auto":
+        edge_mode = "precomputed" if scene.motion_graph is not None else "dense"
+    if pyramid_levels is None:
+        pyramid_levels = strategy["pyramid_levels"]
+    if window_radius is None:
+        window_radius = strategy["window_radius"]
+
+    plan = {
+        "prune_nodes": prune_nodes,
+        "solver": solver,
+        "edge_mode": edge_mode,
+        "pyramid_levels": pyramid_levels,
+        "window_radius": window_radius,
+        "max_workers": max_workers,
+        "max_memory_bytes": max_memory_bytes,
+        "budget_bytes": budget_bytes,
+        "changes": []
+    }
+
+    def estimate():
+        # The solve can't use more threads than the thread budget of the process
+        nb_threads = min(plan["max_workers"] if plan["max_workers"] is not None else os.cpu_count(), thread_budget.max_threads)
+        return int(estimate_motion_path_memory(nb_frames_per_interval, nb_pixels, plan["prune_nodes"], plan["solver"], plan["edge_mode"], knn_k, nb_threads, plan["max_memory_bytes"], beam_width, beam_k, int(feature_dim)))
+
+    def fits():
+        return budget_bytes is None or estimate() <= budget_bytes
+
+    def try_change(key, value, description):
+        # Only keep changes that lower the estimate
+        previous_value, previous_estimate = plan[key], estimate()
+        plan[key] = value
+        if estimate() < previous_estimate:
+            plan["changes"].append(description)
+        else:
+            plan[key] = previous_value
+
+    if not fits() and plan["solver"] == "graph":
+        try_change("solver", "dp", "dp solver")
+
+    if not fits() and plan["solver"] in ("dp", "beam") and plan["max_workers"] != 1:
+        try_change("max_workers", 1, "one interval at a time")
+
+    if not fits() and plan["solver"] == "dp" and plan["max_memory_bytes"] is None:
+        try_change("max_memory_bytes", budget_bytes, "streaming")
+
+    nb_nodes = int(nb_pixels * (1 - plan["prune_nodes"]))
+    while not fits() and nb_nodes > 1:
+        nb_nodes //= 2
+        # Half a node more, so that find_motion_path (which truncates nb_pixels * (1 - prune_nodes)) keeps nb_nodes nodes despite rounding errors
+        plan["prune_nodes"] = 1 - (nb_nodes + 0.5) / nb_pixels
+    if plan["prune_nodes"] != prune_nodes:
+        plan["changes"].append(f"{plan['prune_nodes']:.1%} of nodes pruned")
+
+    plan["estimated_bytes"] = estimate()
+
+    summary = f"{plan['solver']} solver ({plan['edge_mode']} edges), estimated memory {plan['estimated_bytes'] / 1024**2:.1f}MB"
+    if budget_bytes is not None:
+        summary += f" (budget {budget_bytes / 1024**2:.1f}MB"
+        summary += f", changed to fit: {', '.join(plan['changes'])})" if len(plan["changes"]) > 0 else ")"
+        if not fits():
+            summary += ", over budget"
+    plan["summary"] = summary
+
+    return plan
+
+
+# Banded Cholesky factors of the velocity Laplacian (which only depends on the number of trajectory points), most recently used last
+laplacian_factorizations = OrderedDict()
+max_cached_laplacian_factorizations = 16
+
+# Beyond this number of constraint rows, the Schur complement is too large to be worth it and the whole system is solved with spsolve
+max_schur_complement_size = 512
+
+def get_laplacian_factorization(N):
+    '''
+    Factorizes (banded Cholesky) the velocity Laplacian of a trajectory of N points, for one coordinate, with its first point pinned to make it invertible.
+    Factorizations are cached per trajectory length.
+
+    Args:
+        N (int): number of trajectory points
+
+    Returns:
+        laplacian_factor (np.ndarray): upper banded Cholesky factor (see scipy.linalg.cholesky_banded) of L + e_0 e_0^T
+    '''
+    if N in laplacian_factorizations:
+        laplacian_factorizations.move_to_end(N)
+        return laplacian_factorizations[N]
+
+    pinned_laplacian = np.zeros((2, N))
+    pinned_laplacian[0, 1:] = -1
+    pinned_laplacian[1] = 2
+    pinned_laplacian[1, -1] = 1 if N > 1 else 2
+
+    laplacian_factor = cholesky_banded(pinned_laplacian)
+    laplacian_factorizations[N] = laplacian_factor
+    while len(laplacian_factorizations) > max_cached_laplacian_factorizations:
+        laplacian_factorizations.popitem(last=False)
+
+    return laplacian_factor
+
+
+def solve_trajectory_system(
+    M             : csr_matrix,
+    rhs           : np.ndarray,
+    N             : int,
+    diag_offsets  : np.ndarray
+    ):
+    '''
+    Solves the trajectory KKT system by eliminating the trajectory points: the block of points is the per-coordinate velocity Laplacian (factorized once per N)
+    plus a few diagonal terms, and the remaining rows (keyframe ray parameters and hard constraints) are solved as a small dense Schur complement.
+    This costs O(N * k) for k constrained frames, instead of a sparse LU of the whole system.
+    Falls back to spsolve when the Schur complement is too large or singular.
+
+    Args:
+        M (csr_matrix): the whole system matrix, trajectory points coordinates (3 * N first rows/columns) first
+        rhs (np.ndarray): right-hand side of the system
+        N (int): number of trajectory points
+        diag_offsets (np.ndarray): per point difference between the diagonal of the points block and the Laplacian, same for all coordinates
+
+    Returns:
+        X (np.ndarray): solution of the system
+    '''
+    nb_points_rows = 3 * N
+
+    # The factorized Laplacian has its first point pinned: unpin it with a diagonal offset
+    diag_offsets = diag_offsets.copy()
+    diag_offsets[0] -= 1
+    updated_points = np.flatnonzero(diag_offsets)
+    updated_rows = (3 * updated_points[:, None] + np.arange(3)).ravel()
+    nb_updated_rows = len(updated_rows)
+    nb_other_rows = len(rhs) - nb_points_rows
+
+    if nb_updated_rows + nb_other_rows > max_schur_complement_size:
+        return spsolve(M, rhs)
+
+    laplacian_factor = get_laplacian_factorization(N)
+
+    def solve_points_block(points_rhs):
+        # Same system for each coordinate: points_rhs is (N, nb_rhs)
+        return cho_solve_banded((laplacian_factor, False), points_rhs)
+
+    # Bordered system, the points block being the pinned Laplacian: each diagonal offset d_i of a point coordinate x_i adds a variable z_i = d_i * x_i
+    updates = csr_matrix((np.ones(nb_updated_rows), (updated_rows, np.arange(nb_updated_rows))), shape=(nb_points_rows, nb_updated_rows))
+    M_points_others = hstack([updates, M[:nb_points_rows, nb_points_rows:]], format="csr")
+    M_others_points = vstack([updates.T.multiply(np.repeat(diag_offsets[updated_points], 3)[:, None]), M[nb_points_rows:, :nb_points_rows]], format="csr")
+    M_others = np.zeros((nb_updated_rows + nb_other_rows, nb_updated_rows + nb_other_rows))
+    M_others[:nb_updated_rows, :nb_updated_rows] = -np.eye(nb_updated_rows)
+    M_others[nb_updated_rows:, nb_updated_rows:] = M[nb_points_rows:, nb_points_rows:].toarray()
+    others_rhs = np.concatenate([np.zeros(nb_updated_rows), rhs[nb_points_rows:]])
+
+    # Schur complement: only needs the inverse of the points block between the coordinates the other rows/columns are coupled with
+    coupled_rows = np.unique(M_points_others.nonzero()[0])
+    coupled_cols = np.unique(M_others_points.nonzero()[1])
+    coupled_points, coupled_points_idx = np.unique(coupled_rows // 3, return_inverse=True)
+    unit_cols = np.zeros((N, len(coupled_points)))
+    unit_cols[coupled_points, np.arange(len(coupled_points))] = 1
+    points_block_inv_cols = solve_points_block(unit_cols)
+    points_block_inv = points_block_inv_cols[(coupled_cols // 3)[:, None], coupled_points_idx[None, :]] * (coupled_cols[:, None] % 3 == coupled_rows[None, :] % 3)
+
+    schur_complement = M_others - M_others_points[:, coupled_cols].toarray() @ points_block_inv @ M_points_others[coupled_rows, :].toarray()
+
+    points_sol = solve_points_block(rhs[:nb_points_rows].reshape((N, 3))).ravel()
+    try:
+        others_sol = np.linalg.solve(schur_complement, others_rhs - M_others_points @ points_sol)
+    except np.linalg.LinAlgError:
+        return spsolve(M, rhs)
+    points_sol -= solve_points_block((M_points_others @ others_sol).reshape((N, 3))).ravel()
+
+    return np.concatenate([points_sol, others_sol[nb_updated_rows:]])
+
+
+# Default basis of the trajectories solved by optimize_trajectory: one point per frame ("frames"), or cubic B-spline control points ("spline")
+default_trajectory_basis = "frames"
+
+def configure_trajectory_basis(trajectory_basis):
+    if trajectory_basis not in ("frames", "spline"):
+        raise ValueError(f"Unknown trajectory basis {trajectory_basis}, expected 'frames' or 'spline'")
+    global default_trajectory_basis
+    default_trajectory_basis = trajectory_basis
+
+
+def spline_trajectory_basis(
+    target_velocities : np.ndarray,
+    constrained_frames: np.ndarray,
+    nb_control_points : int
+    ):
+    '''
+    Cubic B-spline basis of a trajectory with adaptively placed knots: knots are denser where the target velocities change quickly,
+    and every constrained frame (keyframe or presolved position) is a knot so that the constraints can be met.
+
+    Args:
+        target_velocities (np.ndarray): target velocities of the N trajectory points
+        constrained_frames (np.ndarray): frames of the hard constraints
+        nb_control_points (int): number of control points of the adaptive knots (the constrained frames add more)
+
+    Returns:
+        basis (csr_matrix): (N, nb of control points) matrix that evaluates the spline at each frame
+    '''
+    N = len(target_velocities)
+
+    # Knot density between consecutive frames: half uniform, half proportional to the change of target velocity
+    velocity_changes = np.linalg.norm(np.diff(target_velocities[:N-1], axis=0), axis=1)
+    velocity_changes = np.concatenate([velocity_changes, velocity_changes[-1:]]) if len(velocity_changes) > 0 else np.ones(N - 1)
+    knot_density = velocity_changes + np.mean(velocity_changes) + 1e-12
+    cumulated_density = np.concatenate([[0], np.cumsum(knot_density)])
+
+    nb_adaptive_knots = max(nb_control_points - 4, 0)
+    adaptive_knots = np.interp(np.linspace(0, cumulated_density[-1], nb_adaptive_knots + 2)[1:-1], cumulated_density, np.arange(N))
+    constrained_frames = constrained_frames[(constrained_frames > 0) & (constrained_frames < N - 1)]
+    interior_knots = np.unique(np.concatenate([adaptive_knots, constrained_frames]))
+
+    knots = np.concatenate([np.zeros(4), interior_knots, np.full(4, N - 1)])
+
+    return BSpline.design_matrix(np.arange(N, dtype=float), knots, 3).tocsr()
+
+
 def optimize_trajectory(
     video_name       : str,
     keyframes        : List[dict],
     target_velocities: np.ndarray,
     initial_positions: np.ndarray,
-    is_presolved     : np.ndarray
+    is_presolved     : np.ndarray,
+    first_frame_idx  : int = 0,
+    trajectory_basis : str = None,
+    spline_control_points: int = 256
     ): 
     '''
     Recovers a stable 3D trajectory by solving the Poisson problem to best match the target velocities (found via tracking)
@@ -390,201 +1309,131 @@ def optimize_trajectory(
         target_velocities (np.ndarray): scene flow that we will aim to match with the solved trajectory
         initial_positions (np.ndarray): initial 3D positions (these are only used at presolved frames or as soft objectives at keyframes that have only a 2D position constraint)
         is_presolved (np.ndarray): array of boolean flags that indicate whether the position at each frame is presolved (eg, in the case where the user specifies they want linear interpolation instead of tracking)
+        first_frame_idx (int): frame of the first trajectory point, the arrays above cover frames [first_frame_idx, first_frame_idx + len(initial_positions) - 1]
+        trajectory_basis (str): solve for one point per frame ("frames") or for the control points of a cubic B-spline with adaptive knots ("spline"),
+            which has far fewer unknowns on long shots (defaults to the configured basis, see configure_trajectory_basis)
+        spline_control_points (int): number of adaptively placed control points of the "spline" basis, in addition to one per constrained frame
 
     Returns:
         trajectory_pts (np.ndarray): the optimized 3D trajectory points
     '''
 
+    if trajectory_basis is None:
+        trajectory_basis = default_trajectory_basis
+    if trajectory_basis not in ("frames", "spline"):
+        raise ValueError(f"Unknown trajectory basis {trajectory_basis}, expected 'frames' or 'spline'")
+
+    # Keep keyframes in the solved frames, with frames relative to the first one
+    keyframes = [dict(kf, t=kf['t'] - first_frame_idx) for kf in keyframes if 0 <= kf['t'] - first_frame_idx < len(initial_positions)]
+
     # Filter out keyframes that don't contain position data or are at presolved positions
     keyframes = [kf for kf in keyframes if (not is_presolved[kf['t']] and ("pos_3d" in kf.keys() or "pos_2d" in kf.keys()))]
 
     # Data
-    camera_data = np.load(os.path.join(backend_data_root_folder, video_name, "cameras.npz"))
+    scene = get_scene(video_name)
+    camera_data = scene.cameras
 
-    total_nb_frames, maps_res_x, maps_res_y = get_maps_dims(video_name)
-    maps_res = (maps_res_x, maps_res_y)
+    maps_res = scene.maps_res
 
     res_x, res_y = maps_res
 
-    # Build linear system matrix
-    A_data = []
-    A_row = []
-    A_col = []
-
     N = len(initial_positions)
 
-    b = np.zeros((N, 3))
-
-    # SOFT VELOCITY CSTR => velocity should match 3D flow vectors
-    # Case i = 1
-    # if 0 not in keyframe_times:
-    sparse_add_value(1, 0, 0, A_data, A_row, A_col, flat=True)
-    sparse_add_value(-1, 0, 1, A_data, A_row, A_col, flat=True)
-
-    b[0, :] += -target_velocities[0, :]
-
-    for i in range(1, N-1):
-        # nb_soft_cstr = 0
-        # if i not in keyframe_times:
-        b[i, :] += -target_velocities[i, :]
-        sparse_add_value(-1, i, i+1, A_data, A_row, A_col, flat=True)
-            # nb_soft_cstr += 1 
-
-        # if (i-1) not in keyframe_times:
-        sparse_add_value(-1, i, i-1, A_data, A_row, A_col, flat=True)
-        b[i, :] += target_velocities[i-1, :]
-            # nb_soft_cstr += 1 
-
-        # if nb_soft_cstr > 0:
-        sparse_add_value(2, i, i, A_data, A_row, A_col, flat=True)
-        
-
-    # Case i = N-1
-    # if (N-2) not in keyframe_times:
-    sparse_add_value(-1, N-1, N-2, A_data, A_row, A_col, flat=True)
-    sparse_add_value(1, N-1, N-1, A_data, A_row, A_col, flat=True)
+    # The system is assembled from arrays of (row, column, value) triplets, built in bulk.
+    # Unknowns: the 3 coordinates of each point (rows 3 * i + c), then one ray parameter per keyframe defined as a 2D position only
+    def expand_coords(rows, cols, values):
+        # Same value for the 3 coordinates of points: point indices => flat indices
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        coords = np.arange(3)
+        return (3 * rows[:, None] + coords).ravel(), (3 * cols[:, None] + coords).ravel(), np.repeat(np.broadcast_to(values, rows.shape), 3)
 
-    b[N-1, :] += target_velocities[N-2, :]
+    # Keyframes defined as a 2D position only: the ray parameter is a variable
+    keyframes_2d = [kf for kf in keyframes if "pos_3d" not in kf.keys()]
+    system_current_nb_rows = 3 * N + len(keyframes_2d)
+    nb_hard_cstr = len(keyframes) + np.count_nonzero(is_presolved)
 
-    b_flat = b.flatten()
+    # Right-hand side of the whole system (soft constraints, then hard constraints)
+    b_flat = np.zeros(system_current_nb_rows + 3 * nb_hard_cstr)
 
-    system_current_nb_rows = 3 * N
-
-    # Add rows for keyframe ray parameter variables
-    # if keyframe is defined as a 2D position only (ie, ray parameter is a variable)
+    # SOFT VELOCITY CSTR => velocity should match 3D flow vectors
+    # Laplacian: tridiagonal, with 1 on the diagonal for the end points and 2 for the other points
+    points = np.arange(N)
+    laplacian_diag = np.full(N, 2.0)
+    laplacian_diag[[0, -1]] = 1
+    A_row, A_col, A_data = expand_coords(
+        np.concatenate([points, points[1:], points[:-1]]),
+        np.concatenate([points, points[:-1], points[1:]]),
+        np.concatenate([laplacian_diag, -np.ones(2 * (N - 1))]))
+
+    b = b_flat[:3 * N].reshape((N, 3))
+    b[:N-1] += -target_velocities[:N-1]
+    b[1:] += target_velocities[:N-1]
+
+    # Rays of keyframes defined as a 2D position only, and rows of their ray parameter variables
     system_row_index_per_keyframe = []
+    kf_rays = []
     for kf in keyframes:
-
         if "pos_3d" not in kf.keys():
-            kf_frame = kf["t"]
-            kf_pos = kf["pos_2d"]
-            next_frame = kf_frame + 1
-            prev_frame = kf_frame - 1
-            kf_row_index = system_current_nb_rows
-            system_row_index_per_keyframe.append(kf_row_index)
-            system_current_nb_rows += 1
-
-            kf_ray_origin, kf_ray_dir = get_camera_ray(kf_pos, kf_frame, camera_data)
-
-            b_kf = 0
-
-            if kf_frame < N-1:
-                # print("low")
-                # derivative wrt keyframe
-                sparse_add_value(
-                    kf_ray_dir.T @ kf_ray_dir, 
-                    kf_row_index,
-                    kf_row_index,
-                    A_data, A_row, A_col,
-                    flat=False
-                )
-                for i in range(3):
-                    sparse_add_value(
-                        -kf_ray_dir[i], 
-                        kf_row_index,
-                        3 * next_frame + i,
-                        A_data, A_row, A_col,
-                        flat=False
-                    )
-                b_kf += -kf_ray_origin.T @ kf_ray_dir - target_velocities[kf_frame, :].T @ kf_ray_dir
-
-            if kf_frame > 0:
-                # print("high")
-
-                sparse_add_value(
-                    kf_ray_dir.T @ kf_ray_dir, 
-                    kf_row_index,
-                    kf_row_index,
-                    A_data, A_row, A_col,
-                    flat=False
-                )
-                for i in range(3):
-                    sparse_add_value(
-                        -kf_ray_dir[i], 
-                        kf_row_index,
-                        3 * prev_frame + i,
-                        A_data, A_row, A_col,
-                        flat=False
-                    )
-            
-                b_kf += -kf_ray_origin.T @ kf_ray_dir + target_velocities[prev_frame, :].T @ kf_ray_dir
-
-            b_flat = np.append(b_flat, b_kf)
+            system_row_index_per_keyframe.append(3 * N + len(kf_rays))
+            kf_rays.append(get_camera_ray(kf["pos_2d"], first_frame_idx + kf["t"], camera_data))
         else:
             system_row_index_per_keyframe.append(-1)
 
-        
-
-    A = csr_matrix((A_data, (A_row, A_col)), shape=(system_current_nb_rows, system_current_nb_rows), dtype=float)
+    kf_2d_frames = np.array([kf["t"] for kf in keyframes_2d], dtype=int)
+    kf_2d_rows = 3 * N + np.arange(len(keyframes_2d))
+    kf_ray_origins = np.array([ray_origin for ray_origin, _ in kf_rays]).reshape((-1, 3))
+    kf_ray_dirs = np.array([ray_dir for _, ray_dir in kf_rays]).reshape((-1, 3))
+    kf_ray_squared_norms = np.array([ray_dir.T @ ray_dir for _, ray_dir in kf_rays])
 
-    # Add hard constraints (lagrange multipliers method)
-    C_data = []
-    C_row = []
-    C_col = []
+    # Velocity terms between the keyframe point (on its ray) and its next/previous points
+    for has_neighbour, neighbour_frames in [(kf_2d_frames < N-1, kf_2d_frames + 1), (kf_2d_frames > 0, kf_2d_frames - 1)]:
+        rows = kf_2d_rows[has_neighbour]
+        A_row = np.concatenate([A_row, rows, np.repeat(rows, 3)])
+        A_col = np.concatenate([A_col, rows, (3 * neighbour_frames[has_neighbour, None] + np.arange(3)).ravel()])
+        A_data = np.concatenate([A_data, kf_ray_squared_norms[has_neighbour], -kf_ray_dirs[has_neighbour].ravel()])
 
-    hard_cstr_row_idx = 0
-    for kf, kf_row_index in zip(keyframes, system_row_index_per_keyframe):
+    for kf_row_index, kf, (kf_ray_origin, kf_ray_dir) in zip(kf_2d_rows, keyframes_2d, kf_rays):
         kf_frame = kf["t"]
-        # Case where the keyframe is a 2D position: add ray constraint
-        # pos_3d = ray_origin + ray_dir * ray_param
-        if "pos_3d" not in kf.keys():
-            if "pos_2d" not in kf.keys():
-                continue
-            kf_pos = kf["pos_2d"]
+        b_kf = 0
+        if kf_frame < N-1:
+            b_kf += -kf_ray_origin.T @ kf_ray_dir - target_velocities[kf_frame, :].T @ kf_ray_dir
+        if kf_frame > 0:
+            b_kf += -kf_ray_origin.T @ kf_ray_dir + target_velocities[kf_frame - 1, :].T @ kf_ray_dir
+        b_flat[kf_row_index] = b_kf
 
-            sparse_add_value(-1.0, hard_cstr_row_idx, kf_frame, C_data, C_row, C_col, flat=True)
-            kf_ray_origin, kf_ray_dir = get_camera_ray(kf_pos, kf_frame, camera_data)
+    A = csr_matrix((A_data, (A_row, A_col)), shape=(system_current_nb_rows, system_current_nb_rows), dtype=float)
 
-            for i in range(3):
-                sparse_add_value(kf_ray_dir[i], 3 * hard_cstr_row_idx + i, kf_row_index, C_data, C_row, C_col, flat=False)
-            b_flat = np.append(b_flat, -kf_ray_origin)
-        # Case where the keyframe is a 3D position: add hard match constraint
-        else:
-            # Add hard 3D constraint
-            kf_pt = kf["pos_3d"]
-            sparse_add_value(1.0, hard_cstr_row_idx, kf_frame, C_data, C_row, C_col, flat=True)
-            b_flat = np.append(b_flat, kf_pt)
-        hard_cstr_row_idx += 1
-    
-    # Presolved positions
+    # Add hard constraints (lagrange multipliers method): one per keyframe (in order), then one per presolved position
     presolved_indices = np.flatnonzero(is_presolved)
-    for idx in presolved_indices:
-        # Add hard 3D constraint
-        init_pt = initial_positions[idx]
-        sparse_add_value(1.0, hard_cstr_row_idx, idx, C_data, C_row, C_col, flat=True)
-        b_flat = np.append(b_flat, init_pt)
-        hard_cstr_row_idx += 1
-
+    hard_cstr_frames = np.concatenate([np.array([kf["t"] for kf in keyframes], dtype=int), presolved_indices])
+    is_kf_2d = np.array(["pos_3d" not in kf.keys() for kf in keyframes] + [False] * len(presolved_indices), dtype=bool)
+
+    # - 3D positions (keyframes defined in 3D, presolved positions): hard match constraint
+    # - 2D positions: ray constraint, pos_3d = ray_origin + ray_dir * ray_param
+    C_row, C_col, C_data = expand_coords(np.arange(nb_hard_cstr), hard_cstr_frames, np.where(is_kf_2d, -1.0, 1.0))
+    kf_2d_cstr_rows = np.flatnonzero(is_kf_2d)
+    C_row = np.concatenate([C_row, (3 * kf_2d_cstr_rows[:, None] + np.arange(3)).ravel()])
+    C_col = np.concatenate([C_col, np.repeat(kf_2d_rows, 3)])
+    C_data = np.concatenate([C_data, kf_ray_dirs.ravel()])
+
+    b_hard = b_flat[system_current_nb_rows:].reshape((nb_hard_cstr, 3))
+    b_hard[kf_2d_cstr_rows] = -kf_ray_origins
+    kf_3d_cstr_rows = np.flatnonzero(~is_kf_2d[:len(keyframes)])
+    b_hard[kf_3d_cstr_rows] = np.array([keyframes[i]["pos_3d"] for i in kf_3d_cstr_rows]).reshape((-1, 3))
+    b_hard[len(keyframes):] = initial_positions[presolved_indices]
 
     C = csr_matrix((C_data, (C_row, C_col)), shape=(3*(len(keyframes) + len(presolved_indices)), system_current_nb_rows), dtype=float)
 
-    # print(C.todense())
-
     # Second soft cstr: 3D end points should be close to the corresponding positions of graph nodes on shortest path
-    A_prox_data = []
-    A_prox_row = []
-    A_prox_col = []
+    A_prox_row, A_prox_col, A_prox_data = expand_coords(kf_2d_frames, kf_2d_frames, 1.0)
+    A_prox_row = np.concatenate([A_prox_row, kf_2d_rows])
+    A_prox_col = np.concatenate([A_prox_col, kf_2d_rows])
+    A_prox_data = np.concatenate([A_prox_data, kf_ray_squared_norms])
 
     b_prox = np.zeros(len(b_flat))
-    for kf, kf_row_index in zip(keyframes, system_row_index_per_keyframe):
-        if "pos_3d" not in kf.keys():
-            kf_frame = kf["t"]
-            # kf_pos = (kf["pos_2d"] * np.array([res_x, res_y])).astype(int)
-            kf_pos = kf["pos_2d"]
-
-            sparse_add_value(1.0, kf_frame, kf_frame, A_prox_data, A_prox_row, A_prox_col, flat=True)
-            b_prox[[3 * kf_frame + 0, 3 * kf_frame + 1, 3 * kf_frame + 2]] += initial_positions[kf_frame]
-
-            kf_ray_origin, kf_ray_dir = get_camera_ray(kf_pos, kf_frame, camera_data)
-
-            sparse_add_value(
-                kf_ray_dir.T @ kf_ray_dir, 
-                kf_row_index,
-                kf_row_index,
-                A_prox_data, A_prox_row, A_prox_col,
-                flat=False
-            )
-            b_prox[kf_row_index] += initial_positions[kf_frame].T @ kf_ray_dir - kf_ray_origin.T @ kf_ray_dir
+    b_prox[:3 * N].reshape((N, 3))[kf_2d_frames] += initial_positions[kf_2d_frames]
+    for kf_row_index, kf, (kf_ray_origin, kf_ray_dir) in zip(kf_2d_rows, keyframes_2d, kf_rays):
+        b_prox[kf_row_index] += initial_positions[kf["t"]].T @ kf_ray_dir - kf_ray_origin.T @ kf_ray_dir
 
     A_prox = csr_matrix((A_prox_data, (A_prox_row, A_prox_col)), shape=(system_current_nb_rows, system_current_nb_rows), dtype=float)
 
@@ -593,7 +1442,21 @@ def optimize_trajectory(
     M = bmat([[A + prox_weight * A_prox, C.T], [C, None]],format = 'csr')
 
     # Solve linear system
-    X = spsolve(M, b_flat + prox_weight * b_prox)
+    # The block of trajectory points is the velocity Laplacian, plus the proximity terms at keyframes defined as a 2D position
+    points_diag_offsets = np.zeros(N)
+    points_diag_offsets[kf_2d_frames] += prox_weight
+    rhs = b_flat + prox_weight * b_prox
+    if trajectory_basis == "spline" and spline_control_points + len(hard_cstr_frames) < N:
+        # Reduced basis: points are the spline evaluated at each frame, points = basis @ control points (for each coordinate).
+        # Galerkin projection of the system: the points rows are projected on the basis, the other rows (ray parameters, hard constraints) are kept
+        basis = spline_trajectory_basis(target_velocities, hard_cstr_frames, spline_control_points)
+        nb_other_rows = M.shape[0] - 3 * N
+        projection = block_diag([kron(basis, identity(3)), identity(nb_other_rows)], format="csr")
+        X_reduced = spsolve((projection.T @ M @ projection).tocsc(), projection.T @ rhs)
+        X = projection @ X_reduced
+        print(f"Solved the trajectory for {basis.shape[1]} spline control points ({N} frames)")
+    else:
+        X = solve_trajectory_system(M, rhs, N, points_diag_offsets)
 
     # Extract result: 3D trajectory points
     pts = X[:3*N].reshape((N, 3))
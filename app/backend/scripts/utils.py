@@ -1,8 +1,63 @@
+import os
+import threading
+from contextlib import contextmanager
 import numpy as np
 from typing import List, Tuple
+from scipy.spatial import cKDTree
 from scipy.spatial.transform import Rotation as R
 from scipy.spatial.transform import Slerp
 
+class SolveCancelled(Exception):
+    '''Raised inside a solve when it was cancelled (superseded by a newer request for the same canvas).'''
+    pass
+
+def raise_if_cancelled(cancel_event) -> None:
+    '''
+    Cooperative cancellation point for long solves.
+
+    Args:
+        cancel_event: an event-like object (with an is_set method), or None if the solve can't be cancelled
+    '''
+    if cancel_event is not None and cancel_event.is_set():
+        raise SolveCancelled()
+
+class ThreadBudget:
+    '''
+    Bounds the total number of threads used by the thread pools of all solves running concurrently in a process
+    (e.g. the interval pool of the "dp" solver and the edge weights pool of the "graph" solver).
+    '''
+
+    def __init__(self, max_threads=None):
+        self.max_threads = max_threads if max_threads is not None else os.cpu_count()
+        self._nb_reserved = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def reserve(self, nb_threads):
+        '''
+        Reserves threads for the duration of the context.
+
+        Args:
+            nb_threads (int): number of threads requested
+
+        Returns:
+            int: number of threads granted, at most nb_threads and what is left in the budget, but at least 1 so that a solve can always run
+        '''
+        with self._lock:
+            nb_granted = max(1, min(nb_threads, self.max_threads - self._nb_reserved))
+            self._nb_reserved += nb_granted
+        try:
+            yield nb_granted
+        finally:
+            with self._lock:
+                self._nb_reserved -= nb_granted
+
+# Shared by all solves running in this process
+thread_budget = ThreadBudget()
+
+def configure_thread_budget(max_threads):
+    thread_budget.max_threads = max_threads
+
 def normalize(vectors):
     if len(vectors.shape) > 1:
         norms = np.linalg.norm(vectors, axis = 1)
@@ -41,58 +96,44 @@ def mse_mat(A : np.ndarray, B : np.ndarray) -> np.ndarray :
 
 
 def assign_edge_indices(
-      prev_indices       : np.ndarray,
-      curr_indices       : np.ndarray,
-      current_nz_data_idx: int,
-      graph_matrix_row   : np.ndarray,
-      graph_matrix_col   : np.ndarray
-    ) -> None            : 
+      prev_indices        : np.ndarray,
+      curr_indices        : np.ndarray,
+      current_nz_data_idx : int,
+      graph_matrix_indices: np.ndarray
+    ) -> None             : 
     '''
-    Adds values to sparse matrix data (graph_matrix_row, graph_matrix_col) to represent edges going from each node i in prev_indices to each node j in curr_indices
+    Adds values to CSR sparse matrix data (graph_matrix_indices) to represent edges going from each node i in prev_indices to each node j in curr_indices.
+    The rows of the nodes in prev_indices are assumed to be consecutive and to start at current_nz_data_idx (one row of len(curr_indices) edges per node).
 
     Args:
         prev_indices (np.ndarray): source node indices
         curr_indices (np.ndarray): target node indices
         current_nz_data_idx (int): lowest index in graph matrix data arrays that is unassigned yet
-        graph_matrix_row (np.ndarray): sparse graph matrix data (non-zero row indices)
-        graph_matrix_col (np.ndarray): sparse graph matrix data (non-zero column indices)
+        graph_matrix_indices (np.ndarray): CSR sparse graph matrix data (column indices of non-zero values)
     '''
 
-    # s = time.time()
-
-    for i, idx in enumerate(prev_indices):
-        start_idx = current_nz_data_idx + i * len(curr_indices)
-        end_idx = start_idx + len(curr_indices)
-        graph_matrix_row[start_idx:end_idx] = idx
-        graph_matrix_col[start_idx:end_idx] = curr_indices
-    # print("time to assign all edge indices (loop)", time.time() - s)
+    end_idx = current_nz_data_idx + len(prev_indices) * len(curr_indices)
+    # Broadcast the target indices to all rows (no temporary array)
+    graph_matrix_indices[current_nz_data_idx:end_idx].reshape((len(prev_indices), len(curr_indices)))[:] = curr_indices
 
 
-def compute_all_edge_weights(
+def compute_edge_weights(
     prev_pos_3d  : np.ndarray,
     prev_features: np.ndarray,
-    prev_indices : np.ndarray,
 
     flow_prev_to_curr: np.ndarray,
 
     curr_pos_3d  : np.ndarray,
     curr_features: np.ndarray,
-    curr_indices : np.ndarray,
 
     curr_features_to_kf:np.ndarray, 
 
     proximity_weight                : float,
     feature_similarity_weight       : float,
-    target_feature_similarity_weight: float,
-
-    graph_matrix_data: np.ndarray,
-    graph_matrix_row : np.ndarray,
-    graph_matrix_col : np.ndarray,
-
-    current_nz_data_idx:int
-    ) -> int:
+    target_feature_similarity_weight: float
+    ) -> np.ndarray:
     '''
-    Computes edge weights between nodes at frame t and nodes at frame t+1.
+    Computes the matrix of edge weights between nodes at frame t and nodes at frame t+1.
     For nodes i (at t) and j (at t+1):
     w_ij = proximity_weight * (pos_i + flow_i - pos_j)**2  \
             + feature_similarity_weight * (feat_i - feat_j)**2 \
@@ -103,38 +144,21 @@ def compute_all_edge_weights(
         feature_similarity_weight        = 0 ,
         target_feature_similarity_weight = 0 .
 
-    Assigns edge weights and edge indices in the arrays describing the sparse graph matrix.
-    
-
     Args:
         prev_pos_3d (np.ndarray): nodes 3D positions at frame t
         prev_features (np.ndarray): nodes image features at frame t
-        prev_indices (np.ndarray): nodes indices at frame t
         flow_prev_to_curr (np.ndarray): 3D flows at nodes at frame t (flow from t to t+1)
         curr_pos_3d (np.ndarray): nodes 3D positions at frame t+1
         curr_features (np.ndarray): nodes image features at frame t+1
-        curr_indices (np.ndarray): nodes indices at frame t+1
         curr_features_to_kf (np.ndarray): mse of the image feature of each node to the most similar neighboring keyframe image feature 
         proximity_weight (float): weight of the 3D distance term in the optimization
         feature_similarity_weight (float): weight of the image feature term (between nodes) in the optimization
         target_feature_similarity_weight (float): weight of the image feature term (between a node and target keyframes) in the optimization
-        graph_matrix_data (np.ndarray): sparse graph matrix data (non-zero data values)
-        graph_matrix_row (np.ndarray): sparse graph matrix data (non-zero row indices)
-        graph_matrix_col (np.ndarray): sparse graph matrix data (non-zero column indices)
-        current_nz_data_idx (int): lowest index in graph matrix data arrays that is unassigned yet
 
     Returns:
-        int: lowest index in graph matrix data arrays that is unassigned after the assignment of new edges
+        np.ndarray: a matrix with dimensions (nb nodes at t, nb nodes at t+1)
     '''
 
-    # s = time.time()
-    assign_edge_indices(prev_indices, curr_indices, current_nz_data_idx, graph_matrix_row, graph_matrix_col)
-    end_idx = current_nz_data_idx + len(prev_indices) * len(curr_indices)
-    # print("time assigning indices", time.time() - s)
-
-    # print("count src =", len(prev_indices))
-    # print("count dst =", len(curr_indices))
-
     prev_pos_advected = prev_pos_3d + flow_prev_to_curr
 
     # print(prev_pos_advected.shape, curr_pos_3d.shape, curr_pos_3d.dtype, prev_pos_advected.dtype)
@@ -154,47 +178,208 @@ def compute_all_edge_weights(
     if target_feature_similarity_weight > 0:
         weights_mat += target_feature_similarity_weight * curr_features_to_kf.reshape((1, -1))
 
-    graph_matrix_data[current_nz_data_idx:end_idx] = weights_mat.flatten()
+    return weights_mat
 
-    # print("computing edge weights values", time.time() - start_all)
-    
 
-    return end_idx
+def compute_knn_edge_weights(
+    prev_pos_3d  : np.ndarray,
+    prev_features: np.ndarray,
 
+    flow_prev_to_curr: np.ndarray,
 
+    curr_pos_3d  : np.ndarray,
+    curr_features: np.ndarray,
 
+    curr_features_to_kf:np.ndarray, 
 
-def sparse_add_value(
-        value      : float,
-        i          : int,
-        j          : int,
-        data       : List[float],
-        row_indices: List[int],
-        col_indices: List[int],
-        flat       : bool = False
-    ) -> None: 
+    k: int,
+
+    proximity_weight                : float,
+    feature_similarity_weight       : float,
+    target_feature_similarity_weight: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
     '''
-    Add a non-zero value at [i, j] to the sparse matrix representation (data, row indices, column indices).
-    We assume that this final sparse matrix as a shape (3xN, 3xN), with N the total number of 3D points.
-    If flat is set to true, we can set values in the sparse matrix by indexing based on point index (and set the same value for all 3 diagonal coords of this point).
+    Sparse version of compute_edge_weights: each node i at frame t is only connected to the k nodes at frame t+1 that are closest (in 3D) to its advected position pos_i + flow_i.
+    The neighbours are found with a KD-tree built on the nodes at t+1, the weights of the kept edges are the same as in compute_edge_weights.
 
     Args:
-        value (float): _description_
-        i (int): _description_
-        j (int): _description_
-        data (List[float]): _description_
-        row_indices (List[int]): _description_
-        col_indices (List[int]): _description_
-        flat (bool, optional): _description_. Defaults to False.
+        prev_pos_3d (np.ndarray): nodes 3D positions at frame t
+        prev_features (np.ndarray): nodes image features at frame t
+        flow_prev_to_curr (np.ndarray): 3D flows at nodes at frame t (flow from t to t+1)
+        curr_pos_3d (np.ndarray): nodes 3D positions at frame t+1
+        curr_features (np.ndarray): nodes image features at frame t+1
+        curr_features_to_kf (np.ndarray): mse of the image feature of each node to the most similar neighboring keyframe image feature 
+        k (int): number of neighbours of each node at frame t (clamped to the number of nodes at t+1)
+        proximity_weight (float): weight of the 3D distance term in the optimization
+        feature_similarity_weight (float): weight of the image feature term (between nodes) in the optimization
+        target_feature_similarity_weight (float): weight of the image feature term (between a node and target keyframes) in the optimization
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: indices of the neighbours at t+1 and edge weights, both with dimensions (nb nodes at t, k)
     '''
-    if flat:
-        data.extend(np.repeat(value, 3))
-        row_indices.extend([3 * i, 3 * i + 1, 3 * i + 2])
-        col_indices.extend([3 * j, 3 * j + 1, 3 * j + 2])
-    else:
-        data.append(value)
-        row_indices.append(i)
-        col_indices.append(j)
+
+    k = min(k, len(curr_pos_3d))
+
+    prev_pos_advected = prev_pos_3d + flow_prev_to_curr
+
+    distances, neighbours = cKDTree(curr_pos_3d).query(prev_pos_advected, k=k)
+    distances = distances.reshape((len(prev_pos_3d), k))
+    neighbours = neighbours.reshape((len(prev_pos_3d), k))
+
+    weights = proximity_weight * distances**2
+
+    if feature_similarity_weight > 0:
+        weights += feature_similarity_weight * np.sum((prev_features[:, None, :] - curr_features[neighbours])**2, axis=-1)
+
+    if target_feature_similarity_weight > 0:
+        weights += target_feature_similarity_weight * curr_features_to_kf.reshape(-1)[neighbours]
+
+    return neighbours, weights
+
+
+def sparse_min_plus_transition(
+    prev_dist: np.ndarray,
+    edges_src: np.ndarray,
+    edges_dst: np.ndarray,
+    weights  : np.ndarray,
+    nb_dst   : int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Min-plus transition over a sparse set of edges between nodes at frame t and nodes at frame t+1:
+    dist_j = min over edges (i, j) of (prev_dist_i + w_ij)
+
+    Args:
+        prev_dist (np.ndarray): distance from the source to each node at frame t
+        edges_src (np.ndarray): index of the node at frame t of each edge
+        edges_dst (np.ndarray): index of the node at frame t+1 of each edge
+        weights (np.ndarray): weight of each edge
+        nb_dst (int): number of nodes at frame t+1
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: distance from the source to each node at frame t+1 (inf for nodes that no edge reaches),
+            and index of its best predecessor at frame t (-1 for nodes that no edge reaches)
+    '''
+    dist = np.full(nb_dst, np.inf)
+    backpointers = np.full(nb_dst, -1, dtype=np.int32)
+    if len(edges_src) == 0:
+        return dist, backpointers
+
+    candidates = prev_dist[edges_src] + weights
+
+    # Best candidate per destination node (lexsort is stable: ties go to the first edge, as with argmin)
+    order = np.lexsort((candidates, edges_dst))
+    sorted_dst = edges_dst[order]
+    is_best = np.concatenate([[True], sorted_dst[1:] != sorted_dst[:-1]])
+    best = order[is_best]
+
+    dist[edges_dst[best]] = candidates[best]
+    backpointers[edges_dst[best]] = edges_src[best]
+
+    return dist, backpointers
+
+
+def lifted_min_plus_transition(
+    prev_dist        : np.ndarray,
+    prev_pos_advected: np.ndarray,
+    curr_pos_3d      : np.ndarray,
+    proximity_weight : float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Exact min-plus transition with proximity edge weights only, without forming the matrix of edge weights:
+    dist_j = min_i (prev_dist_i + proximity_weight * (pos_i + flow_i - pos_j)**2)
+
+    Lifting each node i at frame t to 4D as (pos_i + flow_i, h_i), with h_i = sqrt((prev_dist_i - min(prev_dist)) / proximity_weight), we have
+    prev_dist_i + proximity_weight * (pos_i + flow_i - pos_j)**2 = min(prev_dist) + proximity_weight * |(pos_i + flow_i, h_i) - (pos_j, 0)|**2
+    so the best predecessor of node j is the nearest neighbour of (pos_j, 0) among the lifted nodes, found with a KD-tree in O(N log N).
+
+    Args:
+        prev_dist (np.ndarray): distance from the source to each node at frame t
+        prev_pos_advected (np.ndarray): nodes 3D positions at frame t, advected by their 3D flows (pos_i + flow_i)
+        curr_pos_3d (np.ndarray): nodes 3D positions at frame t+1
+        proximity_weight (float): weight of the 3D distance term in the optimization (must be > 0)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: distance from the source to each node at frame t+1, and index of its best predecessor at frame t
+    '''
+
+    heights = np.sqrt((prev_dist - np.min(prev_dist)) / proximity_weight)
+    lifted_prev_pos = np.column_stack([prev_pos_advected, heights])
+    lifted_curr_pos = np.column_stack([curr_pos_3d, np.zeros(len(curr_pos_3d))])
+
+    _, backpointers = cKDTree(lifted_prev_pos).query(lifted_curr_pos, k=1)
+
+    # Exact cost of the selected edges
+    dist = prev_dist[backpointers] + proximity_weight * np.sum((prev_pos_advected[backpointers] - curr_pos_3d)**2, axis=-1)
+
+    return dist, backpointers.astype(np.int32)
+
+
+def compute_all_edge_weights(
+    prev_pos_3d  : np.ndarray,
+    prev_features: np.ndarray,
+    prev_indices : np.ndarray,
+
+    flow_prev_to_curr: np.ndarray,
+
+    curr_pos_3d  : np.ndarray,
+    curr_features: np.ndarray,
+    curr_indices : np.ndarray,
+
+    curr_features_to_kf:np.ndarray, 
+
+    proximity_weight                : float,
+    feature_similarity_weight       : float,
+    target_feature_similarity_weight: float,
+
+    graph_matrix_data   : np.ndarray,
+    graph_matrix_indices: np.ndarray,
+
+    current_nz_data_idx:int
+    ) -> int:
+    '''
+    Computes edge weights between nodes at frame t and nodes at frame t+1 (see compute_edge_weights).
+    Assigns edge weights and edge indices in the arrays describing the sparse graph matrix (CSR format, the rows of the nodes at frame t start at current_nz_data_idx).
+    
+
+    Args:
+        prev_pos_3d (np.ndarray): nodes 3D positions at frame t
+        prev_features (np.ndarray): nodes image features at frame t
+        prev_indices (np.ndarray): nodes indices at frame t
+        flow_prev_to_curr (np.ndarray): 3D flows at nodes at frame t (flow from t to t+1)
+        curr_pos_3d (np.ndarray): nodes 3D positions at frame t+1
+        curr_features (np.ndarray): nodes image features at frame t+1
+        curr_indices (np.ndarray): nodes indices at frame t+1
+        curr_features_to_kf (np.ndarray): mse of the image feature of each node to the most similar neighboring keyframe image feature 
+        proximity_weight (float): weight of the 3D distance term in the optimization
+        feature_similarity_weight (float): weight of the image feature term (between nodes) in the optimization
+        target_feature_similarity_weight (float): weight of the image feature term (between a node and target keyframes) in the optimization
+        graph_matrix_data (np.ndarray): CSR sparse graph matrix data (non-zero data values)
+        graph_matrix_indices (np.ndarray): CSR sparse graph matrix data (column indices of non-zero values)
+        current_nz_data_idx (int): lowest index in graph matrix data arrays that is unassigned yet
+
+    Returns:
+        int: lowest index in graph matrix data arrays that is unassigned after the assignment of new edges
+    '''
+
+    # s = time.time()
+    assign_edge_indices(prev_indices, curr_indices, current_nz_data_idx, graph_matrix_indices)
+    end_idx = current_nz_data_idx + len(prev_indices) * len(curr_indices)
+    # print("time assigning indices", time.time() - s)
+
+    # print("count src =", len(prev_indices))
+    # print("count dst =", len(curr_indices))
+
+    weights_mat = compute_edge_weights(
+        prev_pos_3d, prev_features, flow_prev_to_curr,
+        curr_pos_3d, curr_features, curr_features_to_kf,
+        proximity_weight, feature_similarity_weight, target_feature_similarity_weight)
+
+    graph_matrix_data[current_nz_data_idx:end_idx] = weights_mat.ravel()
+
+    # print("computing edge weights values", time.time() - start_all)
+    
+
+    return end_idx
 
 
 
@@ -237,6 +422,35 @@ def get_camera_ray(
 
 
 
+def project_points(
+        points_3d: np.ndarray,
+        frame_idx: int,
+        cameras_data: dict
+    ) -> np.ndarray:
+    '''Projects 3D points (in default, unscaled space) to screen space for a given frame/camera (inverse of the unprojection in get_camera_ray).
+
+    Args:
+        points_3d (np.ndarray): a (N, 3) array of 3D points
+        frame_idx (int): frame of the camera
+        cameras_data (dict): cameras data, as read from cameras.npz
+
+    Returns:
+        np.ndarray: a (N, 2) array of 2D points in screen space (in [0, 1] inside of the frame)
+    '''
+    R = cameras_data["Rs"][frame_idx]
+    translation = cameras_data["ts"][frame_idx]
+    cam_res = cameras_data["res"]
+    K = cameras_data["Ks"][frame_idx]
+
+    # Row vectors: (X - t) @ R = R^T (X - t)
+    pts_cam = (points_3d / cameras_data["down_scale_factor"] - translation) @ R
+    pix_coords = pts_cam @ K.T
+    pix_coords = pix_coords[:, :2] / pix_coords[:, 2:3]
+
+    return pix_coords / np.array([cam_res[0], cam_res[1]])
+
+
+
 # Spherical Linear Interpolation of Rotations
 def orientation_slerp(
     keyframes: List[dict],
@@ -7,10 +7,14 @@ import { Matrix3 } from 'three';
 import { Matrix4 } from 'three';
 
 const websocket = new WebSocket(getWebSocketServer());
+// Trajectories are received as binary messages (see decodeBinaryMessage)
+websocket.binaryType = "arraybuffer";
 
 const connectionPromise = new Promise((resolve, reject) => {
   websocket.onopen = () => {
     console.log("connected");
+    // Negotiate the binary protocol: this must be the first message sent
+    websocket.send(JSON.stringify({ "action": "SET_PROTOCOL", "protocol": "binary" }));
     resolve(websocket);
   };
   websocket.onerror = error => {
@@ -25,11 +29,24 @@ const connectionPromise = new Promise((resolve, reject) => {
   }
 })
 
+// Split a flat Float32Array (binary protocol) in rows of the given size
+const unflatten = ((array, rowSize) => {
+  let rows = [];
+  for (let i = 0; i < array.length; i += rowSize) {
+    rows.push(array.subarray(i, i + rowSize));
+  }
+  return rows;
+});
+
 const parseTrajectory = ((trajectory) => {
+  if (ArrayBuffer.isView(trajectory))
+    trajectory = unflatten(trajectory, 3);
   return trajectory.map(xyz => new Vector3(xyz[0], xyz[1], xyz[2]))
 });
 
 const parseOrientationTrajectory = ((trajectory) => {
+  if (ArrayBuffer.isView(trajectory))
+    trajectory = unflatten(trajectory, 9);
   return trajectory.map(e => { 
     let m = new Matrix3(); 
     m.set(...e);
@@ -38,6 +55,27 @@ const parseOrientationTrajectory = ((trajectory) => {
     return m4; });
 })
 
+// Binary message layout: header length (uint32) | JSON header (padded to 4 bytes) | float32 buffers
+const decodeBinaryMessage = ((buffer) => {
+  const headerLength = new DataView(buffer).getUint32(0, true);
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+  const payloadOffset = 4 + headerLength;
+
+  header["buffers"].forEach((b) => {
+    header[b["name"]] = new Float32Array(buffer, payloadOffset + b["offset"], b["length"]);
+  });
+
+  // Expand frame index ranges [start, end] (inclusive)
+  let frameIndices = [];
+  header["frameRanges"].forEach(([start, end]) => {
+    for (let i = start; i <= end; i++)
+      frameIndices.push(i);
+  });
+  header["frameIndices"] = frameIndices;
+
+  return header;
+});
+
 function getWebSocketServer() {
   if (window.location.host.includes("devbox.training.adobesensei.io")) {
     console.log("Connecting to socket at: " + "wss://" + window.location.host + "/backend");
@@ -61,6 +99,10 @@ const expectedKeysPerStatus = {
     "message",
     "videosList"
   ],
+  'PROTOCOL': [
+    "message",
+    "protocol"
+  ],
   'ESTIMATION_POSITION_SUCCESS': [
     "message",
     "canvasID",
@@ -92,7 +134,7 @@ const expectedKeysPerStatus = {
 
 websocket.addEventListener("message", ({ data }) => {
 
-  const d = JSON.parse(data);
+  const d = (data instanceof ArrayBuffer) ? decodeBinaryMessage(data) : JSON.parse(data);
 
   console.log("received ");
   console.log(d);
@@ -124,6 +166,11 @@ websocket.addEventListener("message", ({ data }) => {
     return;
   }
 
+  if (status == "PROTOCOL") {
+    console.log(`Using ${d["protocol"]} protocol.`);
+    return;
+  }
+
   if (status == "VIDEO_LIST") {
     console.log("list of videos:")
     console.log(d["videosList"])
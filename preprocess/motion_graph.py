@@ -0,0 +1,77 @@
+import numpy as np
+import os
+from scipy.spatial import cKDTree
+
+from videodepth_video import VideoData
+
+
+# From the 3D maps (positions+flows) and the feature maps resolution, precompute a sparse motion graph used in the tracking code:
+# for each pixel at frame t, its k nearest neighbours at frame t+1 (in 3D, after advecting the pixel by its 3D flow) and the corresponding edge weights.
+# With the weights we use in practice (only the 3D proximity term), edge weights don't depend on keyframes, so they can be computed once per video.
+
+
+def feature_pixels_to_maps_indices(features_res, maps_res):
+    # Same as index_into_data in the backend: flat index (x * res_y + y) in the 3D maps for each pixel of the feature grid
+    feats_res_x, feats_res_y = features_res
+    maps_res_x, maps_res_y = maps_res
+
+    pixels_y, pixels_x = np.unravel_index(np.arange(feats_res_x * feats_res_y), (feats_res_y, feats_res_x), order='F')
+    pixels = np.column_stack([pixels_x, pixels_y])
+
+    rescaled_pixels = np.round(pixels * np.array([maps_res_x / feats_res_x, maps_res_y / feats_res_y])).astype(int)
+    rescaled_pixels = np.clip(rescaled_pixels, [0, 0], [maps_res_x - 1, maps_res_y - 1])
+
+    return np.ravel_multi_index([rescaled_pixels[:, 0], rescaled_pixels[:, 1]], (maps_res_x, maps_res_y))
+
+
+def prepare_motion_graph(
+        video            : VideoData,
+        backend_data_path: str,
+        k                : int = 16
+    ):
+
+    video_data_path = os.path.join(backend_data_path, video.video_name)
+
+    # The graph is built at the working resolution of the tracking code (the feature maps resolution), from the 3D maps created at previous steps
+    total_nb_frames, maps_res_x, maps_res_y = np.load(os.path.join(video_data_path, "maps_dim.npy")).astype(int)
+    _, feats_res_x, feats_res_y, _ = np.load(os.path.join(video_data_path, "features_dim.npy")).astype(int)
+
+    maps_shape = (total_nb_frames, maps_res_x * maps_res_y, 3)
+    pos_memmap = np.memmap(os.path.join(video_data_path, "pos.memmap"), mode='r', shape=maps_shape, dtype=np.float64)
+    flow_memmap = np.memmap(os.path.join(video_data_path, "flow.memmap"), mode='r', shape=maps_shape, dtype=np.float64)
+
+    nb_pixels = feats_res_x * feats_res_y
+    k = min(k, nb_pixels)
+    maps_indices = feature_pixels_to_maps_indices((feats_res_x, feats_res_y), (maps_res_x, maps_res_y))
+
+    graph_shape = (total_nb_frames - 1, nb_pixels, k)
+
+    np.save(
+        os.path.join(video_data_path, "motion_graph_dim.npy"),
+        np.array(graph_shape, dtype=np.uint64)
+    )
+
+    indices_memmap = np.memmap(
+        os.path.join(video_data_path, "motion_graph_indices.memmap"),
+        dtype=np.int32,
+        mode="w+",
+        shape=graph_shape
+    )
+    weights_memmap = np.memmap(
+        os.path.join(video_data_path, "motion_graph_weights.memmap"),
+        dtype=np.float32,
+        mode="w+",
+        shape=graph_shape
+    )
+
+    for t in range(total_nb_frames - 1):
+        advected_positions = pos_memmap[t, maps_indices] + flow_memmap[t, maps_indices]
+        next_positions = pos_memmap[t + 1, maps_indices]
+
+        distances, neighbours = cKDTree(next_positions).query(advected_positions, k=k)
+
+        indices_memmap[t] = neighbours.reshape((nb_pixels, k))
+        weights_memmap[t] = (distances**2).reshape((nb_pixels, k))
+
+    indices_memmap.flush()
+    weights_memmap.flush()
@@ -15,6 +15,7 @@ from frames import prepare_frames
 from videowalk_features import prepare_features
 from tracking_maps import prepare_tracking_maps
 from tracking_masks import prepare_masks
+from motion_graph import prepare_motion_graph
 
 from default_paths import default_backend_data_folder, default_frontend_data_folder, data_root_folder
 
@@ -38,29 +39,33 @@ def prepare_all(
     print(f"Preparing all data for video {video_name}...")
 
     if only_do_step is None or only_do_step == 1:
-        print(f"- (1/6) Preparing frames for {video_name}")
+        print(f"- (1/7) Preparing frames for {video_name}")
         prepare_frames(video_data, ui_data_path)
 
     if only_do_step is None or only_do_step == 2:
-        print(f"- (2/6) Preparing cameras for {video_name}")
+        print(f"- (2/7) Preparing cameras for {video_name}")
         prepare_cameras(video_data, ui_data_path, backend_data_path)
 
     if only_do_step is None or only_do_step == 3:
-        print(f"- (3/6) Preparing depth for {video_name}")
+        print(f"- (3/7) Preparing depth for {video_name}")
         prepare_depth_maps(video_data, ui_data_path)
 
     if only_do_step is None or only_do_step == 4:
-        print(f"- (4/6) Preparing deep image feature maps for {video_name}")
+        print(f"- (4/7) Preparing deep image feature maps for {video_name}")
         feat_width, feat_height = prepare_features(video_data, backend_data_path)
 
     if only_do_step is None or only_do_step == 5:
-        print(f"- (5/6) Preparing 3D maps (positions+flows) for {video_name}")
+        print(f"- (5/7) Preparing 3D maps (positions+flows) for {video_name}")
         prepare_tracking_maps(video_data, backend_data_path)
 
     if only_do_step is None or only_do_step == 6:
-        print(f"- (6/6) Preparing binary masks to indicate pixels with untrustworthy 3D flow for {video_name}")
+        print(f"- (6/7) Preparing binary masks to indicate pixels with untrustworthy 3D flow for {video_name}")
         prepare_masks(video_data, backend_data_path, (feat_width, feat_height))
 
+    if only_do_step is None or only_do_step == 7:
+        print(f"- (7/7) Preparing the sparse motion graph (nearest neighbours in 3D between consecutive frames) for {video_name}")
+        prepare_motion_graph(video_data, backend_data_path)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()